@@ -0,0 +1,274 @@
+from sql_schema_builder.MigrationEvents import EventDispatcher
+from sql_schema_builder.MySQLSchema import MySQLSchema, ONLINE_DDL_POLICIES
+from sql_schema_builder.PgSQLSchema import PgSQLSchema
+from sql_schema_builder.SchemaVersionCache import GetProcessCache
+from sql_schema_builder.SQLSchemaBuilder import CFG_DBASE_SCHEMA, GetSchemaFingerprint
+
+import inspect
+import pymysql
+import psycopg
+
+# Async MySQL driver is optional, it's needed only for db_type="mysql".
+try:
+    import aiomysql
+except ImportError:
+    aiomysql = None
+
+
+# Asynchronous variant of SQLSchemaBuilder for asyncio applications. Uses psycopg AsyncConnection (PostgreSQL)
+# or aiomysql (MySQL) and the same diff logic as SQLSchemaBuilder: catalog is read with async queries and
+# changes are planned by MySQLSchema/PgSQLSchema from the catalog snapshot, without blocking the event loop.
+class AsyncSQLSchemaBuilder():
+
+    # Supported db_type: "mysql", "pgsql".
+    # conn - already opened psycopg.AsyncConnection or aiomysql connection to use instead of connecting.
+    def __init__(self, host=None, port=3306, user=None,
+                       passwd=None, password=None,
+                       db=None, database=None,
+                       conn=None, db_type="mysql", online_ddl=None, concurrent_indexes=False,
+                       version_cache=None, listeners=None):
+        self._conn = conn
+        self._owns_conn = conn is None
+        if db_type not in ["mysql", "pgsql"]:
+            raise NotImplementedError(f"Unsupported db_type: {db_type}!")
+        if db_type == "mysql" and conn is None and aiomysql is None:
+            raise NotImplementedError("Asynchronous MySQL requires aiomysql package!")
+        self.db_type = db_type
+        if online_ddl is not None and online_ddl not in ONLINE_DDL_POLICIES:
+            raise ValueError(f"Unsupported online_ddl policy: {online_ddl}!")
+        self._online_ddl = online_ddl
+        self.online_ddl_report = []
+        self._concurrent_indexes = concurrent_indexes
+        self._version_cache = GetProcessCache() if version_cache is True else (version_cache or None)
+        self.events = EventDispatcher(listeners)
+        self._conn_params = {
+            'host': host,
+            'port': port,
+            'user': user,
+            'passwd': passwd or password,
+            'db': db or database,
+        }
+
+    async def _connect_to_database(self):
+
+        if self._conn is not None:
+            return self._conn
+
+        if self.db_type == "mysql":
+            self._conn = await aiomysql.connect(
+                host=self._conn_params['host'],
+                port=self._conn_params['port'],
+                user=self._conn_params['user'],
+                password=self._conn_params['passwd'] or "",
+                db=self._conn_params['db'],
+                charset='utf8mb4',
+                connect_timeout=5,
+                autocommit=False)
+        elif self.db_type == "pgsql":
+            self._conn = await psycopg.AsyncConnection.connect(
+                host=self._conn_params['host'],
+                port=self._conn_params['port'],
+                user=self._conn_params['user'],
+                password=self._conn_params['passwd'],
+                dbname=self._conn_params['db'] or "postgres",
+                connect_timeout=5,
+                autocommit=False)
+
+        return self._conn
+
+    # Closes connection opened by the builder (connection passed by the caller is left open).
+    async def Close(self):
+        if self._conn is None or not self._owns_conn:
+            return
+        conn, self._conn = self._conn, None
+        if self.db_type == "mysql":
+            conn.close()
+        else:
+            await conn.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.Close()
+
+    def _get_dsn(self):
+        params = self._conn_params
+        if params['host'] is None and self._conn is not None and self.db_type == "mysql":
+            db = self._conn.db.decode() if isinstance(self._conn.db, bytes) else self._conn.db
+            return f"{self.db_type}://{self._conn.user}@{self._conn.host}:{self._conn.port}/{db}"
+        if params['host'] is None and self._conn is not None and self.db_type == "pgsql":
+            info = self._conn.info
+            return f"{self.db_type}://{info.user}@{info.host}:{info.port}/{info.dbname}"
+        return f"{self.db_type}://{params['user']}@{params['host']}:{params['port']}/{params['db']}"
+
+    def _get_db_schema(self):
+        # Dialects only plan changes from the catalog snapshot, all queries are executed here.
+        if self.db_type == "mysql":
+            return MySQLSchema(self._conn, online_ddl=self._online_ddl, events=self.events)
+        elif self.db_type == "pgsql":
+            return PgSQLSchema(self._conn, concurrent_indexes=self._concurrent_indexes, events=self.events)
+
+    #-----------------------------------------------------------------------------------------------------------
+
+    async def _load_catalog_snapshot(self, db_schema, cursor, table_names):
+        table_names = list(table_names)
+        results = []
+        with self.events.Timed('introspection') as event:
+            for sql, params in db_schema.GetCatalogQueries(table_names):
+                await cursor.execute(sql, params)
+                results.append(await cursor.fetchall())
+            event['rowcount'] = sum(len(rows) for rows in results)
+        return db_schema.BuildCatalogSnapshot(table_names, results)
+
+    async def _get_cfg_version(self, cursor, name):
+        try:
+            sql = "SELECT value FROM cfg_dbase WHERE name = %s"
+            with self.events.Timed('version_check', name=name, sql=sql):
+                await cursor.execute(sql, (name,))
+                return float((await cursor.fetchone())[0] or 0)
+        except (TypeError, pymysql.err.ProgrammingError, psycopg.errors.UndefinedTable):
+            if self.db_type == "pgsql":
+                await self._conn.rollback()
+            return 0.000
+
+    async def _set_cfg_value(self, cursor, name, value):
+        if self.db_type == "mysql":
+            sql = "REPLACE cfg_dbase (name, value) VALUES (%s, %s)"
+            await cursor.execute(sql, (name, value))
+        elif self.db_type == "pgsql":
+            sql = """
+                INSERT INTO cfg_dbase (name, value)
+                     VALUES (%s, %s)
+                ON CONFLICT (name) DO UPDATE
+                        SET value = %s
+            """
+            await cursor.execute(sql, (name, value, value))
+
+    # Callbacks can be plain functions or coroutine functions, both get the async cursor.
+    async def _call_callback(self, name, callback, db_schema_version, cursor):
+        with self.events.Timed('callback', name=name):
+            result = callback(db_schema_version, cursor)
+            if inspect.isawaitable(result):
+                result = await result
+        return result
+
+    async def _execute_ddl(self, cursor, table_name, sql):
+        with self.events.Timed('ddl', table=table_name, sql=sql) as event:
+            await cursor.execute(sql)
+            event['rowcount'] = cursor.rowcount
+
+    async def _execute_online_ddl(self, db_schema, cursor, plan, sql):
+
+        error = None
+        for online_sql, algorithm, lock in db_schema.GetOnlineDDLAttempts(plan, sql):
+            try:
+                await self._execute_ddl(cursor, plan.table_name, online_sql)
+            except pymysql.err.MySQLError as e:
+                if not db_schema.IsOnlineDDLRefused(e):
+                    raise
+                error = e
+                continue
+
+            db_schema.ReportOnlineDDL(plan, online_sql, algorithm, lock)
+            return
+
+        raise db_schema.GetOnlineDDLError(plan, error)
+
+    async def _update_table_schema(self, db_schema, cursor, table_name, table_schema):
+
+        plan = db_schema.PlanTableSchema(table_name, table_schema)
+        for sql in db_schema.RenderTablePlan(plan):
+            if self.db_type == "mysql" and self._online_ddl is not None and not plan.is_new_table:
+                await self._execute_online_ddl(db_schema, cursor, plan, sql)
+            else:
+                await self._execute_ddl(cursor, table_name, sql)
+
+    async def _update_indexes_concurrently(self, schema_dict):
+
+        await self._conn.commit()
+        autocommit = self._conn.autocommit
+        await self._conn.set_autocommit(True)
+        try:
+            db_schema = PgSQLSchema(self._conn, concurrent_indexes=True, events=self.events)
+            async with self._conn.cursor() as cursor:
+                await self._load_catalog_snapshot(db_schema, cursor, schema_dict.keys())
+                for table_name, table_schema in schema_dict.items():
+                    plan = db_schema.PlanTableSchema(table_name, table_schema)
+                    for sql in db_schema.GetConcurrentIndexStatements(plan):
+                        await self._execute_ddl(cursor, table_name, sql)
+        finally:
+            await self._conn.set_autocommit(autocommit)
+
+    #-----------------------------------------------------------------------------------------------------------
+
+    # Same as SQLSchemaBuilder.UpdateSchema(), but awaitable. Many databases can be checked concurrently
+    # from one event loop, e.g. with asyncio.gather() of builders of the individual databases.
+    async def UpdateSchema(self, schema_dict, schema_version, post_migrate_callback=None, pre_migrate_callback=None):
+        with self.events.Timed('migration'):
+            return await self._update_schema(schema_dict, schema_version, post_migrate_callback, pre_migrate_callback)
+
+    async def _update_schema(self, schema_dict, schema_version, post_migrate_callback, pre_migrate_callback):
+
+        fingerprint = None
+        if schema_dict is not None and schema_version is not None:
+            fingerprint = GetSchemaFingerprint(schema_dict, schema_version)
+            if self._version_cache is not None and self._version_cache.IsCurrent(self._get_dsn(), fingerprint):
+                return True
+
+        await self._connect_to_database()
+        if self._conn is None:
+            return False
+
+        if schema_dict is None or schema_version is None:
+            return True
+
+        if 'cfg_dbase' in schema_dict:
+            return False
+
+        schema_dict = dict(schema_dict)
+        schema_dict['cfg_dbase'] = CFG_DBASE_SCHEMA
+
+        #-----------------------------------------------------------------------------------------------------------
+
+        async with self._conn.cursor() as cursor:
+
+            db_schema_version = await self._get_cfg_version(cursor, 'schema_version')
+
+            if db_schema_version < schema_version:
+                db_schema = self._get_db_schema()
+                self.online_ddl_report = getattr(db_schema, 'online_ddl_report', [])
+
+                if pre_migrate_callback is not None:
+                    migration_success = await self._call_callback(
+                        'pre_migrate_callback', pre_migrate_callback, db_schema_version, cursor)
+                    if migration_success == False:
+                        await self._conn.rollback()
+                        return False
+
+                await self._load_catalog_snapshot(db_schema, cursor, schema_dict.keys())
+
+                for table_name, table_schema in schema_dict.items():
+                    await self._update_table_schema(db_schema, cursor, table_name, table_schema)
+
+                if post_migrate_callback is not None:
+                    migration_success = await self._call_callback(
+                        'post_migrate_callback', post_migrate_callback, db_schema_version, cursor)
+                    if migration_success == False:
+                        await self._conn.rollback()
+                        return False
+
+                await self._set_cfg_value(cursor, 'schema_version', schema_version)
+                await self._set_cfg_value(cursor, 'schema_fingerprint', fingerprint)
+                await self._conn.commit()
+
+            if self.db_type == "pgsql" and self._concurrent_indexes:
+                if await self._get_cfg_version(cursor, 'concurrent_indexes_version') < schema_version:
+                    await self._update_indexes_concurrently(schema_dict)
+                    await self._set_cfg_value(cursor, 'concurrent_indexes_version', schema_version)
+                    await self._conn.commit()
+
+        if self._version_cache is not None:
+            self._version_cache.MarkCurrent(self._get_dsn(), fingerprint)
+
+        return True
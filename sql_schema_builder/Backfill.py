@@ -0,0 +1,128 @@
+import json
+import time
+
+
+# Prefix of cfg_dbase names with checkpoints of backfills, they are deleted once the schema version is increased.
+CHECKPOINT_PREFIX = 'backfill:'
+
+# Size of name and value columns of cfg_dbase (see CFG_DBASE_SCHEMA), checkpoints have to fit in them.
+CFG_VALUE_LENGTH = 64
+
+
+# Helper passed to post_migrate_callback with 3 parameters, which updates big tables in small batches
+# with commit after every batch, instead of one huge transaction.
+class Backfill():
+
+    # get_cfg_value(cursor, name)/set_cfg_value(cursor, name, value) - access to cfg_dbase where checkpoints are stored.
+    def __init__(self, conn, get_cfg_value, set_cfg_value, events):
+        self._conn = conn
+        self._get_cfg_value = get_cfg_value
+        self._set_cfg_value = set_cfg_value
+        self._events = events
+        # Number of batches and rows processed by each backfill (by name).
+        self.stats = {}
+
+    #-----------------------------------------------------------------------------------------------------------
+
+    def _get_checkpoint(self, cursor, name):
+        value = self._get_cfg_value(cursor, CHECKPOINT_PREFIX + name)
+        return json.loads(value) if value is not None else None
+
+    def _fetch_batch(self, cursor, table_name, key_column, columns, where, last_key, batch_size):
+
+        conditions = []
+        params = []
+        if last_key is not None:
+            conditions.append('{0} > %s'.format(key_column))
+            params.append(last_key)
+        if where:
+            conditions.append('({0})'.format(where))
+
+        sql = 'SELECT {0} FROM {1}'.format(', '.join([key_column] + list(columns)), table_name)
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY {0} LIMIT {1:d}'.format(key_column, batch_size)
+
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+    # Waits until replica lag (in seconds, returned by get_replica_lag()) drops below max_replica_lag.
+    def _wait_for_replicas(self, get_replica_lag, max_replica_lag, poll_interval):
+        while True:
+            lag = get_replica_lag()
+            if lag is None or lag <= max_replica_lag:
+                return
+            time.sleep(poll_interval)
+
+    #-----------------------------------------------------------------------------------------------------------
+
+    # Forgets checkpoint of the backfill, so that next Run() starts from the beginning.
+    def Reset(self, name):
+        with self._conn.cursor() as cursor:
+            self._set_cfg_value(cursor, CHECKPOINT_PREFIX + name, json.dumps(None))
+
+    # Iterates rows of the table in ranges of primary key (key_column, which has to be unique and sortable)
+    # and calls process_batch(cursor, rows) for every batch. Each row is a tuple (key, *columns).
+    # If update_sql is given, process_batch returns list of its parameters which are executed with executemany().
+    # After every batch the last key is checkpointed in cfg_dbase (under the backfill name, max 55 characters,
+    # as JSON of max 64 characters, e.g. long string keys don't fit) and committed, so interrupted backfill
+    # continues where it stopped when UpdateSchema() is run again.
+    # Throttling:
+    #   target_batch_time - batch size is adjusted (between min_batch_size and max_batch_size), so that
+    #                       a batch takes about that many seconds
+    #   sleep             - seconds to wait after every batch
+    #   get_replica_lag   - callable returning replication lag in seconds, next batch waits until it's at most
+    #                       max_replica_lag (e.g. reads Seconds_Behind_Source from replica connection)
+    # Returns number of processed rows.
+    def Run(self, name, table_name, key_column, process_batch, columns=(), where=None, update_sql=None,
+            batch_size=1000, min_batch_size=10, max_batch_size=100000, target_batch_time=None, sleep=0,
+            get_replica_lag=None, max_replica_lag=1.0, replica_poll_interval=1.0):
+
+        if len(CHECKPOINT_PREFIX + name) > CFG_VALUE_LENGTH:
+            raise ValueError('Backfill name is too long: ' + name)
+
+        stats = self.stats.setdefault(name, {'batches': 0, 'rows': 0})
+        with self._conn.cursor() as cursor:
+            last_key = self._get_checkpoint(cursor, name)
+            while True:
+                if get_replica_lag is not None:
+                    self._wait_for_replicas(get_replica_lag, max_replica_lag, replica_poll_interval)
+
+                start = time.monotonic()
+                with self._events.Timed('backfill', table=table_name, name=name) as event:
+                    rows = self._fetch_batch(cursor, table_name, key_column, columns, where, last_key, batch_size)
+                    if not rows:
+                        event['rowcount'] = 0
+                        break
+
+                    # Checked before the batch is processed, truncated checkpoint couldn't be resumed from.
+                    checkpoint = json.dumps(rows[-1][0], default=str)
+                    if len(checkpoint) > CFG_VALUE_LENGTH:
+                        raise ValueError('Key {0} of backfill {1} is too long for checkpoint ({2} characters '
+                                         'of JSON, max {3})'.format(rows[-1][0], name, len(checkpoint),
+                                                                    CFG_VALUE_LENGTH))
+
+                    params = process_batch(cursor, rows)
+                    if update_sql is not None and params:
+                        cursor.executemany(update_sql, params)
+
+                    last_key = rows[-1][0]
+                    self._set_cfg_value(cursor, CHECKPOINT_PREFIX + name, checkpoint)
+                    self._conn.commit()
+                    event['rowcount'] = len(rows)
+
+                stats['batches'] += 1
+                stats['rows'] += len(rows)
+                if len(rows) < batch_size:
+                    break
+
+                if target_batch_time is not None:
+                    # Limit the change, so that one slow or fast batch doesn't swing the size too much.
+                    ratio = target_batch_time / max(time.monotonic() - start, 0.001)
+                    ratio = min(max(ratio, 0.5), 2.0)
+                    batch_size = int(min(max(batch_size * ratio, min_batch_size), max_batch_size))
+
+                if sleep:
+                    time.sleep(sleep)
+
+        return stats['rows']
@@ -0,0 +1,152 @@
+import hashlib
+import json
+import os
+import tempfile
+
+from sql_schema_builder.DDLParser import IndexDef
+
+# msgpack is optional, it's needed only for snapshot files with .msgpack extension.
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# Version of serialized snapshot format.
+SNAPSHOT_FORMAT = 2
+
+
+class CatalogSnapshot():
+
+    def __init__(self, tables=None, db_type=None, server_info=None, checksum=None):
+        # Maps table name to {'columns': {...}, 'indexes': {...}, 'partitioning': {...}}, where columns, indexes
+        # and partitioning have exactly the same shape as returned by _get_table_columns()/_get_table_indexes()/
+        # _get_table_partitioning() of MySQLSchema/PgSQLSchema.
+        # Tables that were looked up but don't exist in the database are stored with empty columns and indexes.
+        self._tables = tables if tables is not None else {}
+        # "mysql" or "pgsql" and version of the server the snapshot was read from.
+        self.db_type = db_type
+        self.server_info = server_info
+        # Checksum of the catalog computed by the server (see GetCatalogChecksum() of the dialects), used to verify
+        # that saved snapshot still describes the database.
+        self.checksum = checksum
+
+    #-----------------------------------------------------------------------------------------------------------
+
+    def AddTable(self, table_name):
+        self._tables[table_name] = {'columns': {}, 'indexes': {}, 'partitioning': None}
+        return self._tables[table_name]
+
+    def HasTable(self, table_name):
+        return table_name in self._tables
+
+    def GetTableNames(self):
+        return list(self._tables.keys())
+
+    # Returned dicts are shared with the snapshot, callers must not modify them.
+    def GetTableColumns(self, table_name):
+        return self._tables[table_name]['columns']
+
+    def GetTableIndexes(self, table_name):
+        return self._tables[table_name]['indexes']
+
+    def GetTablePartitioning(self, table_name):
+        return self._tables[table_name]['partitioning']
+
+    def SetTablePartitioning(self, table_name, partitioning):
+        self._tables[table_name]['partitioning'] = partitioning
+
+    # Called whenever table is altered, so that the next lookup falls back to querying the database.
+    def InvalidateTable(self, table_name):
+        self._tables.pop(table_name, None)
+
+    #-----------------------------------------------------------------------------------------------------------
+
+    def ToDict(self):
+        tables = {}
+        for table_name, table in self._tables.items():
+            tables[table_name] = {
+                # Columns keep their order, which matters for MySQL column positions.
+                'columns': [dict(column, name=name) for name, column in table['columns'].items()],
+                'indexes': {index_name: {'type': index.type, 'columns': list(index.columns),
+                                         'is_valid': index.is_valid,
+                                         'lengths': list(index.lengths) if index.lengths is not None else None,
+                                         'descending': list(index.descending) if index.descending is not None
+                                                       else None,
+                                         'include': list(index.include), 'where': index.where,
+                                         'method': index.method}
+                            for index_name, index in table['indexes'].items()},
+                'partitioning': table['partitioning'],
+            }
+        return {
+            'format': SNAPSHOT_FORMAT,
+            'db_type': self.db_type,
+            'server_info': self.server_info,
+            'checksum': self.checksum,
+            'tables': tables,
+        }
+
+    @classmethod
+    def FromDict(cls, data):
+        if data.get('format') != SNAPSHOT_FORMAT:
+            raise ValueError('Unsupported catalog snapshot format: {0}'.format(data.get('format')))
+
+        tables = {}
+        for table_name, table in data['tables'].items():
+            columns = {}
+            for column in table['columns']:
+                column = dict(column)
+                columns[column.pop('name')] = column
+            indexes = {index_name: IndexDef(index['type'], list(index['columns']), is_valid=index['is_valid'],
+                                            lengths=index.get('lengths'), descending=index.get('descending'),
+                                            include=list(index.get('include') or []), where=index.get('where'),
+                                            method=index.get('method'))
+                       for index_name, index in table['indexes'].items()}
+            tables[table_name] = {'columns': columns, 'indexes': indexes, 'partitioning': table['partitioning']}
+
+        return cls(tables, db_type=data.get('db_type'), server_info=data.get('server_info'),
+                   checksum=data.get('checksum'))
+
+    # Hash of the snapshot contents, e.g. to find tenants with identical catalogs.
+    def GetContentHash(self):
+        data = self.ToDict()
+        return hashlib.sha256(json.dumps(data['tables'], sort_keys=True).encode()).hexdigest()
+
+    # Saves snapshot as JSON, or msgpack if the path ends with .msgpack.
+    def Save(self, path):
+
+        if path.endswith('.msgpack'):
+            if msgpack is None:
+                raise NotImplementedError("Saving catalog snapshot as msgpack requires msgpack package!")
+            content = msgpack.packb(self.ToDict(), use_bin_type=True)
+        else:
+            content = json.dumps(self.ToDict(), separators=(',', ':')).encode()
+
+        # Write to temporary file and rename it, so that readers never see partially written file.
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.catalog-snapshot-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        except OSError:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    @classmethod
+    def Load(cls, path):
+
+        with open(path, 'rb') as f:
+            content = f.read()
+
+        if path.endswith('.msgpack'):
+            if msgpack is None:
+                raise NotImplementedError("Loading catalog snapshot from msgpack requires msgpack package!")
+            data = msgpack.unpackb(content, raw=False)
+        else:
+            data = json.loads(content)
+
+        return cls.FromDict(data)
@@ -0,0 +1,489 @@
+import functools
+import re
+
+
+FIELD_PATTERN = re.compile(r'^\s*(\w+)\s+(\w+)(\(([^)]+)\))?(\s+UNSIGNED)?(\s+AUTO_INCREMENT)?(\s+NOTNULL)?(\s+DEFAULT\s+\'?([\w\.]*)\'?)?(\s+RENAMED_FROM\s+(\w+))?\s*$')
+INDEX_PATTERN = re.compile(r'^\s*INDEX\s+((PRIMARY|UNIQUE)\s+)?((\w+)\s*)?(USING\s+(\w+)\s*)?'
+                           r'\(((?:[^()]|\(\s*\d+\s*\))+)\)(\s+INCLUDE\s*\(([^)]+)\))?(\s+WHERE\s+(.+?))?'
+                           r'(\s+RENAMED_FROM\s+(\w+))?\s*$')
+INDEX_COLUMN_PATTERN = re.compile(r'^(\w+)\s*(\(\s*(\d+)\s*\))?(\s+(ASC|DESC))?$')
+ENUM_VALUE_PATTERN = re.compile(r"'([^']*?)'")
+PARTITION_BY_PATTERN = re.compile(r'^\s*PARTITION\s+BY\s+(RANGE|LIST|HASH)\s*\(\s*(\w+)\s*\)((\s+\w+\s+\d+)*)\s*$')
+PARTITION_OPTION_PATTERN = re.compile(r'(\w+)\s+(\d+)')
+PARTITION_PATTERN = re.compile(r'^\s*PARTITION\s+(\w+)\s+VALUES\s*\(([^)]+)\)\s*$')
+LIST_VALUE_PATTERN = re.compile(r"'((?:[^']|'')*)'|(-?\d+)")
+
+# Options of PARTITION BY clause allowed for each partitioning method.
+PARTITION_OPTIONS = {
+    'RANGE': ('INTERVAL', 'PRECREATE', 'RETENTION'),
+    'LIST': (),
+    'HASH': ('PARTITIONS',),
+}
+
+# Number of future range partitions kept created ahead by default.
+DEFAULT_PRECREATE_PARTITIONS = 3
+
+INTEGER_COLUMN_TYPES = ('I', 'I1', 'I2', 'I8')
+
+# Maps column types (and their aliases) accepted in DDL to canonical type names used by the dialects.
+COLUMN_TYPES = {
+    'I': 'I',
+    'I1': 'I1',
+    'I2': 'I2',
+    'I8': 'I8',
+    'F': 'F',
+    'N': 'N',
+
+    'C': 'C',
+    'MX': 'MX',
+    'X': 'X',
+    'MB': 'MB',
+    'B': 'B',
+    'J': 'J',
+    'BIN': 'BIN',
+
+    'D': 'D',
+    'T': 'T',
+
+    'ENUM': 'ENUM',
+
+    'INT8': 'I1',
+    'INT16': 'I2',
+    'INT32': 'I',
+    'INT64': 'I8',
+    'CHAR': 'C',
+    'DOUBLE': 'F',
+    'TEXT': 'X',
+    'BLOB': 'B',
+    'JSON': 'J',
+    'BOOL': 'BOOL',
+    'BOOLEAN': 'BOOL',
+}
+
+
+class ColumnDef():
+
+    __slots__ = ('name', 'type', 'type_arguments', 'is_unsigned', 'is_autoincrement', 'is_notnull', 'default_value',
+                 'renamed_from')
+
+    def __init__(self, name, type, type_arguments=None, is_unsigned=False, is_autoincrement=False,
+                 is_notnull=False, default_value=None, renamed_from=None):
+        self.name = name
+        # Canonical type name (key of COLUMN_TYPES values), e.g. 'I8' or 'C'.
+        self.type = type
+        # Size of C/BIN columns, or comma separated quoted values of ENUM column.
+        self.type_arguments = type_arguments
+        self.is_unsigned = is_unsigned
+        self.is_autoincrement = is_autoincrement
+        self.is_notnull = is_notnull
+        self.default_value = default_value
+        # Previous name of the column (RENAMED_FROM), existing column with that name is renamed instead of dropped.
+        self.renamed_from = renamed_from
+
+    def __eq__(self, other):
+        if not isinstance(other, ColumnDef):
+            return NotImplemented
+        return all(getattr(self, x) == getattr(other, x) for x in self.__slots__)
+
+    def __hash__(self):
+        return hash(tuple(getattr(self, x) for x in self.__slots__))
+
+    def __repr__(self):
+        return 'ColumnDef({0})'.format(', '.join('{0}={1!r}'.format(x, getattr(self, x)) for x in self.__slots__))
+
+
+class IndexDef():
+
+    __slots__ = ('type', 'columns', 'is_valid', 'name', 'renamed_from', 'lengths', 'descending', 'include', 'where',
+                 'method')
+
+    # Name is not part of index identity (equality), indexes with the same definition are the same index.
+    def __init__(self, type, columns, is_valid=True, name=None, renamed_from=None, lengths=None, descending=None,
+                 include=(), where=None, method=None):
+        # None, 'PRIMARY' or 'UNIQUE'.
+        self.type = type
+        # Names of indexed columns (without quotes).
+        self.columns = columns
+        # False for indexes left unusable by interrupted build, they never match any definition.
+        self.is_valid = is_valid
+        # Declared name of the index (None - named by the dialect) and its previous name (RENAMED_FROM).
+        self.name = name
+        self.renamed_from = renamed_from
+        # Prefix length (None - whole value) and descending order of each column, None if no column has them.
+        self.lengths = lengths
+        self.descending = descending
+        # Names of covering (INCLUDE) columns, predicate of partial index and lowercase access method
+        # (None - the default B-tree).
+        self.include = include
+        self.where = where
+        self.method = method
+
+    def _get_identity(self):
+        return (self.type, tuple(self.columns), self.is_valid, _get_column_options(self.lengths),
+                _get_column_options(self.descending), tuple(self.include), self.where, self.method)
+
+    def __eq__(self, other):
+        if not isinstance(other, IndexDef):
+            return NotImplemented
+        return self._get_identity() == other._get_identity()
+
+    def __hash__(self):
+        return hash(self._get_identity())
+
+    def __repr__(self):
+        return 'IndexDef({0})'.format(', '.join('{0}={1!r}'.format(x, getattr(self, x)) for x in self.__slots__))
+
+
+# Per column options are compared as tuples, without options equal to no options.
+def _get_column_options(values):
+    return tuple(values) if values is not None and any(values) else None
+
+
+class PartitioningDef():
+
+    __slots__ = ('method', 'column', 'interval', 'precreate', 'retention', 'count', 'lists')
+
+    def __init__(self, method, column, interval=None, precreate=None, retention=None, count=None, lists=()):
+        # 'RANGE', 'LIST' or 'HASH' and partition key column.
+        self.method = method
+        self.column = column
+        # RANGE only: width of partitions in units of the key (e.g. seconds of unix timestamp), number of future
+        # partitions kept created ahead and age of partitions (by their upper bound) that are dropped (None - never).
+        self.interval = interval
+        self.precreate = precreate
+        self.retention = retention
+        # HASH only: number of partitions.
+        self.count = count
+        # LIST only: tuple of (name, values) of partitions, values are tuples of canonical literals
+        # (see ParseListValues()).
+        self.lists = lists
+
+    def __eq__(self, other):
+        if not isinstance(other, PartitioningDef):
+            return NotImplemented
+        return all(getattr(self, x) == getattr(other, x) for x in self.__slots__)
+
+    def __hash__(self):
+        return hash(tuple(getattr(self, x) for x in self.__slots__))
+
+    def __repr__(self):
+        return 'PartitioningDef({0})'.format(', '.join('{0}={1!r}'.format(x, getattr(self, x))
+                                                       for x in self.__slots__))
+
+
+class TableDef():
+
+    __slots__ = ('columns', 'indexes', 'partitioning')
+
+    def __init__(self, columns, indexes, partitioning=None):
+        # Tuple of ColumnDef in the declared order.
+        self.columns = columns
+        # Tuple of IndexDef.
+        self.indexes = indexes
+        # PartitioningDef or None.
+        self.partitioning = partitioning
+
+
+#-----------------------------------------------------------------------------------------------------------
+
+# Parses table DDL into dialect-neutral TableDef. Results are memoized by DDL text, so they are shared
+# and must not be modified.
+@functools.lru_cache(maxsize=4096)
+def ParseTableSchema(schema):
+
+    fields = [x.strip() if not x.strip().endswith(',') else x.strip()[:-1].strip() for x in schema.splitlines()]
+
+    columns = []
+    indexes = []
+    partitioning = None
+    partitions = []
+    for field in fields:
+        if len(field) == 0:
+            continue
+        matches = FIELD_PATTERN.match(field)
+        if not matches and PARTITION_BY_PATTERN.match(field):
+            if partitioning is not None:
+                raise ValueError('Duplicate partitioning: ' + field)
+            partitioning = _parse_partitioning(field)
+            continue
+        if not matches and PARTITION_PATTERN.match(field):
+            matches = PARTITION_PATTERN.match(field)
+            partitions.append((matches.group(1), ParseListValues(matches.group(2))))
+            continue
+        if not matches:
+            matches = INDEX_PATTERN.match(field)
+            if not matches:
+                raise ValueError('Invalid field specifier: ' + field)
+
+            indexes.append(_parse_index(field, matches))
+            continue
+
+        name = matches.group(1)
+        type = matches.group(2)
+        type_arguments = matches.group(4)
+
+        if type not in COLUMN_TYPES:
+            raise ValueError('Invalid type specifier: ' + field)
+        type = COLUMN_TYPES[type]
+        if type == 'C' and not type_arguments:
+            raise ValueError('Char type requires size: ' + field)
+        if type == 'ENUM' and not type_arguments:
+            raise ValueError('Enum type requires list of possible values: ' + field)
+        if type == 'BIN' and not type_arguments:
+            raise ValueError('Binary type requires size: ' + field)
+        if type not in ['C', 'ENUM', 'BIN'] and type_arguments:
+            raise ValueError('Only char or enum type can have arguments: ' + field)
+
+        if type == 'ENUM':
+            # Strip whitespace between enum values for canonical form.
+            type_arguments = ','.join("'{}'".format(x) for x in ENUM_VALUE_PATTERN.findall(type_arguments))
+
+        columns.append(ColumnDef(
+            name, type, type_arguments,
+            is_unsigned=matches.group(5) is not None,
+            is_autoincrement=matches.group(6) is not None,
+            is_notnull=matches.group(7) is not None,
+            default_value=matches.group(9),
+            renamed_from=matches.group(11)))
+
+    column_names = set(column.name for column in columns)
+    renamed_from = set()
+    for column in columns:
+        if column.renamed_from in column_names or column.renamed_from in renamed_from:
+            raise ValueError('Column {0} can\'t be renamed from {1}'.format(column.name, column.renamed_from))
+        if column.renamed_from is not None:
+            renamed_from.add(column.renamed_from)
+    index_names = [index.name for index in indexes if index.name is not None]
+    if len(index_names) != len(set(index_names)):
+        raise ValueError('Duplicate index names: ' + ', '.join(index_names))
+
+    if partitioning is not None or partitions:
+        partitioning = _check_partitioning(partitioning, partitions, columns, indexes)
+
+    return TableDef(tuple(columns), tuple(indexes), partitioning)
+
+
+def _parse_index(field, matches):
+
+    index_type = matches.group(2)
+    index_name = matches.group(4)
+    method = matches.group(6).lower() if matches.group(6) is not None else None
+    include = tuple(x.strip() for x in matches.group(9).split(',')) if matches.group(9) is not None else ()
+    where = matches.group(11)
+    renamed_from = matches.group(13)
+    if index_type is None and index_name in ('PRIMARY', 'UNIQUE'):
+        index_type, index_name = index_name, None
+
+    columns = []
+    lengths = []
+    descending = []
+    for index_field in matches.group(7).split(','):
+        column_matches = INDEX_COLUMN_PATTERN.match(index_field.strip())
+        if not column_matches:
+            raise ValueError('Invalid index column: ' + field)
+        columns.append(column_matches.group(1))
+        lengths.append(int(column_matches.group(3)) if column_matches.group(3) is not None else None)
+        descending.append(column_matches.group(5) == 'DESC')
+
+    if index_type == 'PRIMARY':
+        if index_name is not None or renamed_from is not None:
+            raise ValueError('Primary key can\'t be named: ' + field)
+        if method is not None or include or where is not None or any(descending):
+            raise ValueError('Primary key can\'t have USING, INCLUDE, WHERE or DESC: ' + field)
+
+    return IndexDef(index_type, tuple(columns), name=index_name, renamed_from=renamed_from,
+                    lengths=tuple(lengths) if any(x is not None for x in lengths) else None,
+                    descending=tuple(descending) if any(descending) else None,
+                    include=include, where=where, method=method)
+
+
+def _parse_partitioning(field):
+
+    matches = PARTITION_BY_PATTERN.match(field)
+    method = matches.group(1)
+    options = dict((name, int(value)) for name, value in PARTITION_OPTION_PATTERN.findall(matches.group(3)))
+    for name in options:
+        if name not in PARTITION_OPTIONS[method]:
+            raise ValueError('Invalid option {0} of {1} partitioning: {2}'.format(name, method, field))
+    if method == 'RANGE' and not options.get('INTERVAL'):
+        raise ValueError('Range partitioning requires INTERVAL: ' + field)
+    if method == 'HASH' and not options.get('PARTITIONS'):
+        raise ValueError('Hash partitioning requires number of PARTITIONS: ' + field)
+
+    precreate = None
+    if method == 'RANGE':
+        precreate = options.get('PRECREATE', DEFAULT_PRECREATE_PARTITIONS)
+
+    return PartitioningDef(method, matches.group(2), interval=options.get('INTERVAL'), precreate=precreate,
+                           retention=options.get('RETENTION'), count=options.get('PARTITIONS'))
+
+
+# Both MySQL and PostgreSQL require partition key in every unique index.
+def _check_partitioning(partitioning, partitions, columns, indexes):
+
+    if partitioning is None:
+        raise ValueError('Partitions require PARTITION BY LIST')
+    if partitioning.method == 'LIST':
+        if not partitions:
+            raise ValueError('List partitioning requires at least one PARTITION name VALUES (...)')
+    elif partitions:
+        raise ValueError('Partitions can be declared only with PARTITION BY LIST')
+
+    names = [name for name, values in partitions]
+    if len(names) != len(set(names)):
+        raise ValueError('Duplicate partition names: ' + ', '.join(names))
+
+    column_types = dict((column.name, column.type) for column in columns)
+    if partitioning.column not in column_types:
+        raise ValueError('Partition key {0} is not a column'.format(partitioning.column))
+    # MySQL can partition by RANGE and HASH only integer expressions.
+    if partitioning.method != 'LIST' and column_types[partitioning.column] not in INTEGER_COLUMN_TYPES:
+        raise ValueError('{0} partition key {1} must be integer column'.format(partitioning.method,
+                                                                               partitioning.column))
+    for index in indexes:
+        if index.type is not None and partitioning.column not in index.columns:
+            raise ValueError('{0} index ({1}) must contain partition key {2}'.format(
+                index.type, ', '.join(index.columns), partitioning.column))
+
+    return PartitioningDef(partitioning.method, partitioning.column, interval=partitioning.interval,
+                           precreate=partitioning.precreate, retention=partitioning.retention,
+                           count=partitioning.count, lists=tuple(partitions))
+
+
+# Parses comma separated SQL literals of LIST partition (quoted strings and integers) into tuple of canonical
+# literals (strings with single quotes, integers without leading zeros), e.g. "'eu', 'uk'" -> ("'eu'", "'uk'").
+def ParseListValues(values):
+    return tuple("'{0}'".format(string) if number == '' else str(int(number))
+                 for string, number in LIST_VALUE_PATTERN.findall(values))
+
+
+# Returns {old name: new name} of declared columns with RENAMED_FROM, whose old name is in existing column_names
+# and the new one is not (i.e. the column wasn't renamed yet).
+def GetRenamedColumns(column_names, table_def):
+    return dict((column.renamed_from, column.name) for column in table_def.columns
+                if column.renamed_from is not None and column.renamed_from in column_names and
+                column.name not in column_names)
+
+
+# Returns [(new name, existing name)] of declared columns that already exist in the table (under the old name,
+# if they are going to be renamed), in the declared order.
+def GetExistingColumns(column_names, table_def, renamed_columns):
+    new_names = dict((new_name, old_name) for old_name, new_name in renamed_columns.items())
+    return [(column.name, new_names.get(column.name, column.name)) for column in table_def.columns
+            if new_names.get(column.name, column.name) in column_names]
+
+
+# Returns (existing name, new name) of primary key column, if the table has single column primary key and the same
+# (possibly renamed) column is declared as primary key. Otherwise None.
+def GetUnchangedPrimaryKey(table_indexes, table_def, renamed_columns):
+    table_keys = [index.columns for index in table_indexes.values() if index.type == 'PRIMARY']
+    declared_keys = [index.columns for index in table_def.indexes if index.type == 'PRIMARY']
+    if len(table_keys) != 1 or len(declared_keys) != 1 or len(table_keys[0]) != 1:
+        return None
+    name = table_keys[0][0]
+    new_name = renamed_columns.get(name, name)
+    if list(declared_keys[0]) != [new_name]:
+        return None
+    return name, new_name
+
+
+# Finds existing index for each declared index. table_indexes maps names of existing indexes to IndexDef,
+# declared_indexes are IndexDef of the DDL and renamed_columns maps old names of renamed columns to the new ones
+# (indexes follow their columns when they are renamed). Returns list with name of the matching existing index
+# (or None) for each declared index. Index matches if it has the same definition and:
+#   - the same name as the declared one, or
+#   - the name from RENAMED_FROM of the declared one, or
+#   - any name, if no existing index matched by the rules above (the index is then renamed, if declared
+#     index is named).
+def MatchIndexes(table_indexes, declared_indexes, renamed_columns=None):
+
+    if renamed_columns:
+        table_indexes = dict((name, IndexDef(index.type, [renamed_columns.get(x, x) for x in index.columns],
+                                             is_valid=index.is_valid, lengths=index.lengths,
+                                             descending=index.descending,
+                                             include=[renamed_columns.get(x, x) for x in index.include],
+                                             where=index.where, method=index.method))
+                             for name, index in table_indexes.items())
+
+    matches = [None] * len(declared_indexes)
+    claimed = set()
+    for attribute in ('name', 'renamed_from'):
+        for i, index in enumerate(declared_indexes):
+            name = getattr(index, attribute)
+            if matches[i] is None and name is not None and name not in claimed and \
+               table_indexes.get(name) == index:
+                matches[i] = name
+                claimed.add(name)
+
+    for i, index in enumerate(declared_indexes):
+        if matches[i] is not None:
+            continue
+        for name, table_index in table_indexes.items():
+            if name not in claimed and table_index == index:
+                matches[i] = name
+                claimed.add(name)
+                break
+
+    return matches
+
+
+#-----------------------------------------------------------------------------------------------------------
+
+# Partitions of the table are dicts from _get_table_partitioning() of the dialects:
+#   {'name', 'from', 'to', 'values', 'is_default'}
+# where 'from'/'to' are bounds of RANGE partition (None - unbounded) and 'values' canonical literals
+# of LIST partition.
+
+# Returns [(lower, upper)] bounds of range partitions that have to be created, so that partitions cover
+# the current interval (the one containing now) and `precreate` intervals after it. Partitions are aligned
+# to multiples of the interval, except the first one: it starts at the end of the last existing partition
+# (or is unbounded below (None) if the table has no partitions yet) and spans to the end of the current interval.
+def GetMissingRangePartitions(partitioning, partitions, now):
+
+    interval = partitioning.interval
+    start = now // interval * interval
+    end = start + (partitioning.precreate + 1) * interval
+    bounds = [partition['to'] for partition in partitions if not partition['is_default']]
+    if None in bounds:
+        # Partition up to MAXVALUE already covers everything.
+        return []
+
+    missing = []
+    lower = max(bounds) if bounds else None
+    upper = start + interval
+    if lower is not None:
+        upper = max(upper, lower // interval * interval + interval)
+    while lower is None or lower < end:
+        missing.append((lower, upper))
+        lower, upper = upper, upper + interval
+    return missing
+
+
+# Returns names of range partitions whose upper bound is older than retention.
+def GetExpiredRangePartitions(partitioning, partitions, now):
+
+    if partitioning.retention is None:
+        return []
+    return [partition['name'] for partition in partitions
+            if not partition['is_default'] and partition['to'] is not None and
+            partition['to'] <= now - partitioning.retention]
+
+
+# Compares declared LIST partitions with partitions of the table, get_name maps declared name to the name
+# of the partition in the database. Returns (added, changed, dropped), where added and changed are
+# [(name, values)] of declared partitions and dropped names of table partitions that are not declared.
+def DiffListPartitions(partitioning, partitions, get_name):
+
+    table_partitions = dict((partition['name'], partition) for partition in partitions if not partition['is_default'])
+    added = []
+    changed = []
+    for name, values in partitioning.lists:
+        partition = table_partitions.get(get_name(name))
+        if partition is None:
+            added.append((name, values))
+        elif sorted(partition['values'] or []) != sorted(values):
+            changed.append((name, values))
+
+    declared_names = set(get_name(name) for name, values in partitioning.lists)
+    dropped = [name for name in table_partitions if name not in declared_names]
+    return added, changed, dropped
@@ -0,0 +1,130 @@
+import contextlib
+import threading
+import time
+
+
+MYSQL_PROGRESS_SQL = """
+    SELECT s.EVENT_NAME, s.WORK_COMPLETED, s.WORK_ESTIMATED, NULL, NULL
+      FROM performance_schema.events_stages_current s
+      JOIN performance_schema.threads t ON t.THREAD_ID = s.THREAD_ID
+     WHERE t.PROCESSLIST_ID = %s
+"""
+
+PGSQL_PROGRESS_SQL = """
+    SELECT phase, blocks_done, blocks_total, tuples_done, tuples_total
+      FROM pg_stat_progress_create_index
+     WHERE pid = %s
+    UNION ALL
+    SELECT phase, heap_blks_scanned, heap_blks_total, heap_tuples_written, NULL
+      FROM pg_stat_progress_cluster
+     WHERE pid = %s
+"""
+
+
+# Polls progress of running DDL statements from a side connection and reports it to a callback:
+#   MySQL      - performance_schema.events_stages_current (stage/innodb/alter% instruments and events_stages_current
+#                consumer have to be enabled)
+#   PostgreSQL - pg_stat_progress_create_index and pg_stat_progress_cluster
+class DDLProgressMonitor():
+
+    # connect - callable returning new autocommit connection used for polling.
+    # callback - called from the polling thread with dict:
+    #   'table', 'sql'   - of the running statement
+    #   'phase'          - name of the current stage/phase reported by the server
+    #   'percent'        - completion of the phase (0-100) or None if unknown
+    #   'rows'           - rows processed in the phase (PostgreSQL) or None
+    #   'elapsed'        - seconds since the statement started
+    #   'eta'            - estimated seconds till the end of the phase or None
+    def __init__(self, connect, db_type, callback, interval=1.0):
+        self._connect = connect
+        self._db_type = db_type
+        self._callback = callback
+        self._interval = interval
+        self._conn = None
+        # Serializes polling of statements running in parallel on the shared side connection.
+        self._lock = threading.Lock()
+        # Last error of polling (e.g. missing privileges), statements are then not polled anymore.
+        self.error = None
+
+    #-----------------------------------------------------------------------------------------------------------
+
+    def _get_session_id(self, conn):
+        if self._db_type == "mysql":
+            return conn.thread_id()
+        return conn.info.backend_pid
+
+    def _query_progress(self, session_id):
+
+        with self._lock:
+            if self._conn is None:
+                self._conn = self._connect()
+            with self._conn.cursor() as cursor:
+                if self._db_type == "mysql":
+                    cursor.execute(MYSQL_PROGRESS_SQL, (session_id,))
+                else:
+                    cursor.execute(PGSQL_PROGRESS_SQL, (session_id, session_id))
+                return cursor.fetchone()
+
+    def _poll(self, session_id, table_name, sql, stop):
+
+        start = time.monotonic()
+        phase_start = None
+        while not stop.wait(self._interval):
+            try:
+                row = self._query_progress(session_id)
+            except Exception as e:
+                self.error = e
+                return
+            if row is None:
+                continue
+
+            phase, done, total, rows, rows_total = row
+            fraction = None
+            if total:
+                fraction = min(float(done or 0) / total, 1.0)
+            elif rows_total:
+                fraction = min(float(rows or 0) / rows_total, 1.0)
+
+            # ETA from the rate since the phase was first seen, phases differ a lot in speed.
+            now = time.monotonic()
+            if phase_start is None or phase_start[0] != phase:
+                phase_start = (phase, now, fraction or 0.0)
+            eta = None
+            if fraction is not None and fraction > phase_start[2]:
+                eta = (now - phase_start[1]) * (1.0 - fraction) / (fraction - phase_start[2])
+
+            self._callback({
+                'table': table_name,
+                'sql': sql,
+                'phase': phase,
+                'percent': fraction * 100.0 if fraction is not None else None,
+                'rows': rows,
+                'elapsed': now - start,
+                'eta': eta,
+            })
+
+    #-----------------------------------------------------------------------------------------------------------
+
+    # Polls progress of the statement executed on conn while the block runs.
+    @contextlib.contextmanager
+    def Watch(self, conn, table_name, sql):
+
+        if self.error is not None:
+            yield
+            return
+
+        stop = threading.Event()
+        thread = threading.Thread(target=self._poll, args=(self._get_session_id(conn), table_name, sql, stop),
+                                  daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def Close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -0,0 +1,66 @@
+import random
+import time
+
+
+# Limits how long DDL waits for table locks and retries statements that timed out waiting, so that ALTER TABLE
+# queued behind a long running query doesn't block all other queries on the table.
+class DDLRetryPolicy():
+
+    # lock_timeout - seconds DDL may wait for a lock (MySQL lock_wait_timeout, PostgreSQL lock_timeout).
+    # statement_timeout - PostgreSQL only, seconds the whole DDL statement may run (None - no limit).
+    # retry_budget - total seconds spent retrying statements of one table that failed on lock timeout (shared by all
+    #                statements of the table executed with this policy, e.g. during one migration).
+    # Delays between attempts grow exponentially from initial_delay up to max_delay, with random jitter.
+    def __init__(self, lock_timeout, statement_timeout=None, retry_budget=60.0, initial_delay=0.5, max_delay=10.0):
+        if lock_timeout <= 0:
+            raise ValueError(f"Invalid lock_timeout: {lock_timeout}!")
+        self.lock_timeout = lock_timeout
+        self.statement_timeout = statement_timeout
+        self._retry_budget = retry_budget
+        self._initial_delay = initial_delay
+        self._max_delay = max_delay
+        # List of {'table', 'sql', 'attempts', 'waited', 'success'} of statements that needed retries.
+        self.report = []
+        # Seconds of the retry budget used by each table (waits of timed out attempts and delays between them).
+        self._spent = {}
+
+    #-----------------------------------------------------------------------------------------------------------
+
+    # Calls execute() until it succeeds, retrying while is_lock_timeout(exception) and the budget of the table lasts.
+    def Execute(self, execute, is_lock_timeout, table_name, sql):
+
+        delay = self._initial_delay
+        attempts = 0
+        waited = 0.0
+        while True:
+            attempts += 1
+            start = time.monotonic()
+            try:
+                execute()
+            except Exception as e:
+                if not is_lock_timeout(e):
+                    raise
+                spent = self._spent.get(table_name, 0.0) + time.monotonic() - start
+                self._spent[table_name] = spent
+                sleep = min(delay, self._max_delay) * random.uniform(0.5, 1.5)
+                if spent + sleep + self.lock_timeout > self._retry_budget:
+                    self._report(table_name, sql, attempts, waited, False)
+                    raise
+                time.sleep(sleep)
+                self._spent[table_name] = spent + sleep
+                waited += sleep
+                delay *= 2
+                continue
+
+            if attempts > 1:
+                self._report(table_name, sql, attempts, waited, True)
+            return attempts
+
+    def _report(self, table_name, sql, attempts, waited, success):
+        self.report.append({
+            'table': table_name,
+            'sql': sql,
+            'attempts': attempts,
+            'waited': waited,
+            'success': success,
+        })
@@ -0,0 +1,203 @@
+from sql_schema_builder.DDLParser import ParseTableSchema
+from sql_schema_builder.SQLSchemaBuilder import SQLSchemaBuilder
+
+import asyncio
+import concurrent.futures
+import time
+import pymysql
+import psycopg
+
+
+# MySQL errors after which migration of the database is repeated: lost connection, lock wait timeout
+# (innodb_lock_wait_timeout and lock_wait_timeout of metadata locks) and deadlock. Other errors (e.g. unknown
+# or duplicate column, access denied) would fail again, after pre_migrate_callback was repeated.
+TRANSIENT_MYSQL_ERRORS = (
+    pymysql.constants.CR.CR_CONN_HOST_ERROR,
+    pymysql.constants.CR.CR_SERVER_GONE_ERROR,
+    pymysql.constants.CR.CR_SERVER_LOST,
+    pymysql.constants.ER.LOCK_WAIT_TIMEOUT,
+    pymysql.constants.ER.LOCK_DEADLOCK,
+)
+
+
+# Keeps schema of many databases (e.g. one database per customer) up to date.
+class FleetSchemaBuilder():
+
+    # targets - list of dicts with connection parameters of SQLSchemaBuilder (host, port, user, passwd, db).
+    # builder_options - other parameters passed to SQLSchemaBuilder of every target (e.g. online_ddl).
+    # retries - how many times migration of a database is repeated after transient error (lost connection,
+    # lock wait timeout, deadlock), with delay starting at retry_delay seconds and doubling after each attempt.
+    def __init__(self, targets, db_type="mysql", max_workers=8, retries=2, retry_delay=1.0, **builder_options):
+        if db_type not in ["mysql", "pgsql"]:
+            raise NotImplementedError(f"Unsupported db_type: {db_type}!")
+        if max_workers < 1:
+            raise ValueError(f"Invalid number of max_workers: {max_workers}!")
+        self.db_type = db_type
+        self._targets = [dict(target) for target in targets]
+        self._max_workers = max_workers
+        self._retries = retries
+        self._retry_delay = retry_delay
+        self._builder_options = builder_options
+
+    #-----------------------------------------------------------------------------------------------------------
+
+    def _get_target_dsn(self, target):
+        port = target.get('port', 3306)
+        db = target.get('db') or target.get('database')
+        return f"{self.db_type}://{target.get('user')}@{target.get('host')}:{port}/{db}"
+
+    # Reads schema_version of all MySQL databases on the same server with one query per server.
+    # Returns {target index: version}, databases whose version could not be read are left out.
+    def _get_bulk_versions(self):
+
+        versions = {}
+        if self.db_type != "mysql":
+            # PostgreSQL can't query other databases on the same connection, they are checked one by one.
+            return versions
+
+        servers = {}
+        for i, target in enumerate(self._targets):
+            server = (target.get('host'), target.get('port', 3306), target.get('user'),
+                      target.get('passwd') or target.get('password'))
+            servers.setdefault(server, []).append(i)
+
+        for (host, port, user, passwd), indexes in servers.items():
+            try:
+                conn = pymysql.connect(host=host, port=port, user=user, passwd=passwd,
+                                       charset='utf8mb4', connect_timeout=5)
+            except pymysql.err.Error:
+                continue
+
+            try:
+                with conn.cursor() as cursor:
+                    db_names = {self._targets[i].get('db') or self._targets[i].get('database'): i for i in indexes}
+                    sql = """
+                        SELECT TABLE_SCHEMA
+                          FROM information_schema.TABLES
+                         WHERE TABLE_NAME = 'cfg_dbase' AND TABLE_SCHEMA IN %s
+                    """
+                    cursor.execute(sql, (tuple(db_names),))
+                    existing_db_names = [row[0] for row in cursor.fetchall()]
+
+                    # Databases without cfg_dbase have never been migrated.
+                    for db_name, i in db_names.items():
+                        if db_name not in existing_db_names:
+                            versions[i] = 0.000
+
+                    if existing_db_names:
+                        sql = " UNION ALL ".join(
+                            "SELECT %s, value FROM `{0}`.cfg_dbase WHERE name = 'schema_version'".format(
+                                db_name.replace('`', '``'))
+                            for db_name in existing_db_names)
+                        cursor.execute(sql, existing_db_names)
+                        for db_name, value in cursor.fetchall():
+                            if db_name in db_names:
+                                versions[db_names[db_name]] = float(value or 0)
+            except pymysql.err.Error:
+                continue
+            finally:
+                conn.close()
+
+        return versions
+
+    def _is_transient_error(self, e):
+        if isinstance(e, pymysql.err.OperationalError):
+            return len(e.args) > 0 and e.args[0] in TRANSIENT_MYSQL_ERRORS
+        if isinstance(e, (psycopg.errors.LockNotAvailable, psycopg.errors.DeadlockDetected,
+                          psycopg.errors.ConnectionException)):
+            return True
+        # Failed or lost connection is reported without SQLSTATE.
+        return isinstance(e, psycopg.OperationalError) and e.sqlstate is None
+
+    def _update_target(self, target, schema_dict, schema_version, post_migrate_callback, pre_migrate_callback):
+
+        result = {
+            'dsn': self._get_target_dsn(target),
+            'success': False,
+            'skipped': False,
+            'attempts': 0,
+            'duration': 0.0,
+            'error': None,
+        }
+
+        start = time.monotonic()
+        delay = self._retry_delay
+        while True:
+            result['attempts'] += 1
+            try:
+                builder = SQLSchemaBuilder(db_type=self.db_type, **dict(self._builder_options, **target))
+                result['success'] = builder.UpdateSchema(schema_dict, schema_version,
+                                                         post_migrate_callback=post_migrate_callback,
+                                                         pre_migrate_callback=pre_migrate_callback)
+                result['error'] = None
+                break
+            except Exception as e:
+                result['error'] = e
+                if not self._is_transient_error(e) or result['attempts'] > self._retries:
+                    break
+            time.sleep(delay)
+            delay *= 2
+
+        result['duration'] = time.monotonic() - start
+        return result
+
+    def _prepare_update(self, schema_dict, schema_version):
+
+        # Parse DDL once up front, so that invalid schema fails before any database is touched
+        # and the parsed tables are shared (memoized) by all targets.
+        for table_schema in schema_dict.values():
+            ParseTableSchema(table_schema)
+
+        results = [None] * len(self._targets)
+        pending = []
+        versions = self._get_bulk_versions()
+        for i, target in enumerate(self._targets):
+            if i in versions and versions[i] >= schema_version:
+                results[i] = {
+                    'dsn': self._get_target_dsn(target),
+                    'success': True,
+                    'skipped': True,
+                    'attempts': 0,
+                    'duration': 0.0,
+                    'error': None,
+                }
+            else:
+                pending.append(i)
+
+        return results, pending
+
+    #-----------------------------------------------------------------------------------------------------------
+
+    # Migrates all out of date databases, up to max_workers at once. Returns list of results in order of targets,
+    # each a dict with keys 'dsn', 'success', 'skipped' (database was already up to date), 'attempts',
+    # 'duration' (seconds) and 'error' (exception of the last attempt, if any).
+    def UpdateSchema(self, schema_dict, schema_version, post_migrate_callback=None, pre_migrate_callback=None):
+
+        results, pending = self._prepare_update(schema_dict, schema_version)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            futures = {i: executor.submit(self._update_target, self._targets[i], schema_dict, schema_version,
+                                          post_migrate_callback, pre_migrate_callback)
+                       for i in pending}
+        for i, future in futures.items():
+            results[i] = future.result()
+
+        return results
+
+    # Same as UpdateSchema(), but can be awaited from asyncio code. Migrations run in the default executor
+    # of the event loop, limited to max_workers at once.
+    async def UpdateSchemaAsync(self, schema_dict, schema_version, post_migrate_callback=None,
+                                pre_migrate_callback=None):
+
+        loop = asyncio.get_running_loop()
+        results, pending = await loop.run_in_executor(None, self._prepare_update, schema_dict, schema_version)
+        semaphore = asyncio.Semaphore(self._max_workers)
+
+        async def update_target(i):
+            async with semaphore:
+                results[i] = await loop.run_in_executor(None, self._update_target, self._targets[i], schema_dict,
+                                                        schema_version, post_migrate_callback, pre_migrate_callback)
+
+        await asyncio.gather(*(update_target(i) for i in pending))
+
+        return results
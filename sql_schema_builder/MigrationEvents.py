@@ -0,0 +1,123 @@
+import contextlib
+import threading
+import time
+
+
+# Events emitted during UpdateSchema(), each with phase 'start' and 'end':
+#   'migration'     - whole UpdateSchema() call
+#   'version_check' - reading schema version from cfg_dbase
+#   'migration_lock' - getting advisory lock of the migration (mode in 'name', result in 'status')
+#   'introspection' - reading columns and indexes from the catalog (table is None for the bulk snapshot)
+#   'ddl'           - single CREATE/ALTER/DROP statement
+#   'callback'      - pre_migrate_callback or post_migrate_callback (name of the callback in 'name')
+#   'backfill'      - one batch of Backfill.Run() (name of the backfill in 'name')
+#   'sql'           - statement executed by a callback through its cursor, only with trace_path (parameters
+#                     in 'params' or 'params_seq')
+MIGRATION_EVENTS = ('migration', 'version_check', 'migration_lock', 'introspection', 'ddl', 'callback', 'backfill',
+                    'sql')
+
+
+class EventDispatcher():
+
+    # listeners - callables that get one dict argument with keys:
+    #   'event', 'phase' ('start'/'end'), 'table', 'sql', 'name', 'timestamp' (time.time())
+    # and on 'end' also 'duration' (seconds), 'rowcount' (if known) and 'error' (exception or None).
+    # Listeners can be called from multiple threads in parallel mode.
+    def __init__(self, listeners=None):
+        self._listeners = list(listeners or [])
+
+    #-----------------------------------------------------------------------------------------------------------
+
+    def AddListener(self, listener):
+        self._listeners.append(listener)
+
+    def RemoveListener(self, listener):
+        self._listeners.remove(listener)
+
+    def Emit(self, event, phase, **data):
+        if not self._listeners:
+            return
+        data.update(event=event, phase=phase, timestamp=time.time())
+        for key in ('table', 'sql', 'name'):
+            data.setdefault(key, None)
+        for listener in self._listeners:
+            listener(data)
+
+    # Emits 'start' and 'end' events around the block. The block can set 'rowcount' (or other data)
+    # in the yielded dict, it's passed with the 'end' event.
+    @contextlib.contextmanager
+    def Timed(self, event, **data):
+
+        self.Emit(event, 'start', **data)
+        result = {'rowcount': None}
+        start = time.perf_counter()
+        try:
+            yield result
+        except BaseException as e:
+            self.Emit(event, 'end', duration=time.perf_counter() - start, error=e, **dict(data, **result))
+            raise
+        self.Emit(event, 'end', duration=time.perf_counter() - start, error=None, **dict(data, **result))
+
+
+# Listener that collects durations of all events of a migration into a timing report.
+class MigrationTimingCollector():
+
+    # histogram_callback - optional callable (event, duration, labels) called for each finished event, e.g. to feed
+    # Prometheus histogram: lambda event, duration, labels: HISTOGRAM.labels(event).observe(duration).
+    # labels is a dict with 'table' and 'name' of the event.
+    def __init__(self, histogram_callback=None):
+        self._histogram_callback = histogram_callback
+        self._lock = threading.Lock()
+        self.events = []
+
+    def __call__(self, data):
+        if data['phase'] != 'end':
+            return
+        record = {key: data.get(key) for key in ('event', 'table', 'sql', 'name', 'duration', 'rowcount', 'error')}
+        with self._lock:
+            self.events.append(record)
+        if self._histogram_callback is not None:
+            self._histogram_callback(data['event'], data['duration'], {'table': data['table'], 'name': data['name']})
+
+    #-----------------------------------------------------------------------------------------------------------
+
+    def Reset(self):
+        with self._lock:
+            self.events = []
+
+    # Returns dict with:
+    #   'total'    - duration of the whole migration (or sum of all events if there was no 'migration' event)
+    #   'by_event' - {event: {'count', 'total', 'max'}}
+    #   'by_table' - {table: total duration of its introspection and DDL}
+    #   'slowest'  - records of the slowest statements (introspection, DDL, callbacks, their SQL and backfill batches),
+    #                slowest first
+    def GetReport(self, slowest=10):
+
+        with self._lock:
+            events = list(self.events)
+
+        by_event = {}
+        by_table = {}
+        for record in events:
+            stats = by_event.setdefault(record['event'], {'count': 0, 'total': 0.0, 'max': 0.0})
+            stats['count'] += 1
+            stats['total'] += record['duration']
+            stats['max'] = max(stats['max'], record['duration'])
+            if record['table'] is not None:
+                by_table[record['table']] = by_table.get(record['table'], 0.0) + record['duration']
+
+        if 'migration' in by_event:
+            total = by_event['migration']['total']
+        else:
+            total = sum(record['duration'] for record in events)
+
+        statements = [record for record in events
+                      if record['event'] in ('introspection', 'ddl', 'callback', 'backfill', 'sql')]
+        statements.sort(key=lambda record: record['duration'], reverse=True)
+
+        return {
+            'total': total,
+            'by_event': by_event,
+            'by_table': by_table,
+            'slowest': statements[:slowest],
+        }
@@ -0,0 +1,221 @@
+import json
+import os
+import tempfile
+import threading
+import time
+
+from sql_schema_builder.MySQLSchema import MySQLSchema
+from sql_schema_builder.PgSQLSchema import PgSQLSchema
+
+
+# Version of saved trace format.
+TRACE_FORMAT = 1
+
+# Events whose statements are executed again by ReplayMigrationTrace().
+REPLAYED_EVENTS = ('introspection', 'ddl', 'sql')
+
+
+# Listener that records all finished events of a migration with their timings, together with sizes of the tables
+# at the time, so that the migration can be replayed on a copy of the database by ReplayMigrationTrace().
+class MigrationTraceRecorder():
+
+    def __init__(self):
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self.db_type = None
+        self.server_info = None
+        self.schema_version = None
+        # Names of all tables of the schema and {table_name: {'rows', 'data_size', 'index_size'}} of existing ones,
+        # None until the migration starts (i.e. nothing is recorded for up to date database).
+        self.table_names = None
+        self.table_stats = None
+        self.events = []
+
+    def __call__(self, data):
+        if data['phase'] != 'end':
+            return
+        record = {key: data.get(key) for key in ('event', 'table', 'sql', 'name', 'duration', 'rowcount')}
+        record['start'] = time.perf_counter() - self._start - data['duration']
+        record['error'] = repr(data['error']) if data.get('error') is not None else None
+        for key in ('params', 'params_seq'):
+            if data.get(key) is not None:
+                record[key] = data[key]
+        with self._lock:
+            self.events.append(record)
+
+    #-----------------------------------------------------------------------------------------------------------
+
+    def SetDatabase(self, db_type, server_info, schema_version, table_names, table_stats):
+        self.db_type = db_type
+        self.server_info = server_info
+        self.schema_version = schema_version
+        self.table_names = list(table_names)
+        self.table_stats = table_stats
+
+    def IsStarted(self):
+        return self.table_stats is not None
+
+    def ToDict(self):
+        with self._lock:
+            events = list(self.events)
+        return {
+            'format': TRACE_FORMAT,
+            'db_type': self.db_type,
+            'server_info': self.server_info,
+            'schema_version': self.schema_version,
+            'recorded_at': time.time(),
+            'table_names': self.table_names,
+            'table_stats': self.table_stats,
+            'events': events,
+        }
+
+    # Saves trace as JSON. Parameters of statements that are not JSON types are saved as strings.
+    def Save(self, path):
+
+        content = json.dumps(self.ToDict(), indent=1, default=str).encode()
+
+        # Write to temporary file and rename it, so that readers never see partially written file.
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.migration-trace-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        except OSError:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+
+# Cursor passed to migration callbacks while tracing, emits 'sql' event with each executed statement.
+class TracedCursor():
+
+    def __init__(self, cursor, events, name):
+        self._cursor = cursor
+        self._events = events
+        self._name = name
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    #-----------------------------------------------------------------------------------------------------------
+
+    def execute(self, sql, params=None):
+        with self._events.Timed('sql', sql=sql, name=self._name, params=params) as event:
+            result = self._cursor.execute(sql, params)
+            event['rowcount'] = self._cursor.rowcount
+        return result
+
+    def executemany(self, sql, params_seq):
+        params_seq = list(params_seq)
+        with self._events.Timed('sql', sql=sql, name=self._name, params_seq=params_seq) as event:
+            result = self._cursor.executemany(sql, params_seq)
+            event['rowcount'] = self._cursor.rowcount
+        return result
+
+
+#-----------------------------------------------------------------------------------------------------------
+
+def LoadMigrationTrace(path):
+
+    with open(path, 'rb') as f:
+        trace = json.loads(f.read())
+    if trace.get('format') != TRACE_FORMAT:
+        raise ValueError('Unsupported migration trace format: {0}'.format(trace.get('format')))
+    return trace
+
+
+#-----------------------------------------------------------------------------------------------------------
+
+# Ratio of recorded and current size (data and indexes) of the table, used to scale replayed durations.
+def _get_size_ratio(recorded_stats, current_stats):
+    recorded_size = (recorded_stats or {}).get('data_size', 0) + (recorded_stats or {}).get('index_size', 0)
+    current_size = (current_stats or {}).get('data_size', 0) + (current_stats or {}).get('index_size', 0)
+    if not recorded_size or not current_size:
+        return 1.0
+    return float(recorded_size) / current_size
+
+
+# Executes statements of the trace (bulk catalog reads, DDL and SQL of callbacks) in the recorded order against
+# conn, e.g. restored staging copy of the database, which is migrated by that. Each statement is committed
+# (PostgreSQL runs in autocommit mode, so that CONCURRENTLY statements work). Statements that failed when
+# recorded are skipped, as well as tables migrated through shadow table (copy of rows isn't recorded as SQL)
+# and callbacks' own work outside of their cursor.
+# Returns dict with:
+#   'statements' - [{'event', 'table', 'sql', 'recorded', 'replayed', 'predicted', 'ratio'}] in order, where
+#                  'predicted' is replayed duration scaled by size of the table when recorded and now
+#   'skipped'    - records of events that were not replayed
+#   'recorded', 'replayed', 'predicted' - total durations of the replayed statements
+def ReplayMigrationTrace(conn, trace, events=None):
+
+    db_type = trace['db_type']
+    if db_type == "mysql":
+        db_schema = MySQLSchema(conn, events=events)
+    elif db_type == "pgsql":
+        db_schema = PgSQLSchema(conn, events=events)
+    else:
+        raise ValueError('Unsupported database type of migration trace: {0}'.format(db_type))
+
+    table_names = trace['table_names'] or []
+    table_stats = db_schema.GetTableStats(table_names)
+    shadow_tables = set(record['name'][len('shadow:'):] for record in trace['events']
+                        if record['event'] == 'backfill' and (record['name'] or '').startswith('shadow:'))
+
+    statements = []
+    skipped = []
+    autocommit = conn.autocommit if db_type == "pgsql" else None
+    if db_type == "pgsql":
+        conn.commit()
+        conn.autocommit = True
+    try:
+        with conn.cursor() as cursor:
+            for record in trace['events']:
+                if record['event'] not in REPLAYED_EVENTS or record['error'] is not None or \
+                   record['table'] in shadow_tables or \
+                   (record['event'] == 'introspection' and record['table'] is not None) or \
+                   (record['event'] != 'introspection' and not record['sql']):
+                    skipped.append(record)
+                    continue
+
+                start = time.perf_counter()
+                if record['event'] == 'introspection':
+                    db_schema.LoadCatalogSnapshot(table_names)
+                elif record.get('params_seq') is not None:
+                    cursor.executemany(record['sql'], record['params_seq'])
+                elif record.get('params') is not None:
+                    cursor.execute(record['sql'], record['params'])
+                else:
+                    cursor.execute(record['sql'])
+                if db_type == "mysql":
+                    conn.commit()
+                duration = time.perf_counter() - start
+
+                ratio = 1.0
+                if record['table'] is not None:
+                    ratio = _get_size_ratio(trace['table_stats'].get(record['table']),
+                                            table_stats.get(record['table']))
+                statements.append({
+                    'event': record['event'],
+                    'table': record['table'],
+                    'sql': record['sql'],
+                    'recorded': record['duration'],
+                    'replayed': duration,
+                    'predicted': duration * ratio,
+                    'ratio': duration / record['duration'] if record['duration'] else None,
+                })
+    finally:
+        if db_type == "pgsql":
+            conn.autocommit = autocommit
+
+    return {
+        'statements': statements,
+        'skipped': skipped,
+        'recorded': sum(x['recorded'] for x in statements),
+        'replayed': sum(x['replayed'] for x in statements),
+        'predicted': sum(x['predicted'] for x in statements),
+    }
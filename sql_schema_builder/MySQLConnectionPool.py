@@ -0,0 +1,63 @@
+import contextlib
+import queue
+import threading
+
+import pymysql
+
+
+# Minimal thread-safe pool of PyMySQL connections with the same interface as psycopg_pool.ConnectionPool:
+# connection() context manager commits on success and rolls back on error.
+class MySQLConnectionPool():
+
+    def __init__(self, max_size, **connect_kwargs):
+        self._connect_kwargs = connect_kwargs
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._connections = []
+
+    #-----------------------------------------------------------------------------------------------------------
+
+    def _discard(self, conn):
+        with self._lock:
+            if conn in self._connections:
+                self._connections.remove(conn)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    @contextlib.contextmanager
+    def connection(self):
+
+        with self._slots:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = pymysql.connect(**self._connect_kwargs)
+                with self._lock:
+                    self._connections.append(conn)
+
+            try:
+                yield conn
+                conn.commit()
+            except Exception as e:
+                try:
+                    conn.rollback()
+                except pymysql.err.Error:
+                    # Connection is broken, don't return it to the pool. The original error is reported,
+                    # not the failed rollback.
+                    self._discard(conn)
+                    raise e
+                self._idle.put(conn)
+                raise
+            self._idle.put(conn)
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except Exception:
+                pass
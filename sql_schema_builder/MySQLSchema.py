@@ -1,18 +1,310 @@
+import bisect
+import contextlib
+import math
 import re
+import time
 import pymysql
 
+from sql_schema_builder.CatalogSnapshot import CatalogSnapshot
+from sql_schema_builder.DDLParser import DiffListPartitions, GetExistingColumns, GetExpiredRangePartitions, \
+                                         GetMissingRangePartitions, GetRenamedColumns, GetUnchangedPrimaryKey, \
+                                         IndexDef, MatchIndexes, ParseListValues, ParseTableSchema
+from sql_schema_builder.MigrationEvents import EventDispatcher
+from sql_schema_builder.TablePlan import TablePlan
+
+
+# MySQL types of canonical DDL column types.
+COLUMN_TYPES = {
+    'I': 'INT(11)',
+    'I1': 'TINYINT(4)',
+    'I2': 'SMALLINT(6)',
+    'I8': 'BIGINT(20)',
+    'F': 'DOUBLE',
+    'N': 'DECIMAL(10,2)',
+
+    'C': 'VARCHAR',
+    'MX': 'MEDIUMTEXT',
+    'X': 'LONGTEXT',
+    'MB': 'MEDIUMBLOB',
+    'B': 'LONGBLOB',
+    'J': 'JSON',
+    'BIN': 'BINARY',
+
+    'D': 'DATE',
+    'T': 'DATETIME',
+
+    'ENUM': 'ENUM',
+
+    'BOOL': 'TINYINT(1)',
+}
+
+# Integer types, whose display width is only a formatting hint. MySQL 8.0.19+ doesn't report it (except TINYINT(1)),
+# so the width is ignored when comparing column definitions.
+INTEGER_TYPES = ('TINYINT', 'SMALLINT', 'MEDIUMINT', 'INT', 'BIGINT')
+
+# Synonyms of types that can be reported by the server, mapped to canonical names used by COLUMN_TYPES.
+TYPE_ALIASES = {
+    'INTEGER': 'INT',
+    'BOOL': 'TINYINT(1)',
+    'BOOLEAN': 'TINYINT(1)',
+    'DEC': 'DECIMAL',
+    'NUMERIC': 'DECIMAL',
+    'FIXED': 'DECIMAL',
+    'REAL': 'DOUBLE',
+}
+
+COLUMN_DEFINITION_PATTERN = re.compile(
+    r'^(\w+)(\((.*?)\))?( UNSIGNED)?( AUTO_INCREMENT)?( NOT NULL)?( DEFAULT .*)?$', re.S)
+
+PARTITIONS_SQL = """
+    SELECT TABLE_NAME, PARTITION_NAME, PARTITION_METHOD, PARTITION_EXPRESSION, PARTITION_DESCRIPTION
+      FROM information_schema.PARTITIONS
+     WHERE TABLE_SCHEMA = DATABASE()
+       AND TABLE_NAME IN %s
+       AND PARTITION_NAME IS NOT NULL
+     ORDER BY TABLE_NAME, PARTITION_ORDINAL_POSITION
+"""
+
+# Partitioning methods reported by the server, mapped to methods of the DDL (others never match the DDL).
+PARTITION_METHODS = {
+    'RANGE': 'RANGE',
+    'RANGE COLUMNS': 'RANGE',
+    'LIST': 'LIST',
+    'LIST COLUMNS': 'LIST',
+    'HASH': 'HASH',
+}
+
+# Name of advisory lock serializing migrations of the database (names of GET_LOCK are limited to 64 characters).
+MIGRATION_LOCK_NAME = "CONCAT('sql_schema_builder:', LEFT(SHA1(DATABASE()), 32))"
+
+# Server refused requested ALGORITHM/LOCK clause of ALTER TABLE (not exported by pymysql.constants.ER).
+ER_ALTER_OPERATION_NOT_SUPPORTED = 1845
+ER_ALTER_OPERATION_NOT_SUPPORTED_REASON = 1846
+
+# Supported policies of online DDL mode:
+#   "fallback" - try the cheapest algorithm, fall back to more expensive ones and finally to server's default.
+#   "nolock"   - like "fallback", but never use algorithm that blocks concurrent writes.
+#   "strict"   - use only the cheapest algorithm, fail if the server refuses it.
+ONLINE_DDL_POLICIES = ("fallback", "nolock", "strict")
+
+# Algorithms (and locks) of online DDL, ordered from the cheapest one.
+ONLINE_DDL_ALGORITHMS = [('INSTANT', None), ('INPLACE', 'NONE'), ('INPLACE', 'SHARED'), ('COPY', 'SHARED')]
+
 
 class MySQLSchema():
 
-    def __init__(self, conn):
+    def __init__(self, conn, catalog=None, online_ddl=None, events=None, ddl_retry=None, ignore_column_order=False,
+                 shadow_tables=None, shadow_copy=None, progress=None):
+        if online_ddl is not None and online_ddl not in ONLINE_DDL_POLICIES:
+            raise ValueError(f"Unsupported online_ddl policy: {online_ddl}!")
+        if ignore_column_order is not True and ignore_column_order is not False and \
+           (not isinstance(ignore_column_order, int) or ignore_column_order < 0):
+            raise ValueError(f"Invalid ignore_column_order: {ignore_column_order}!")
         self._conn = conn
+        self._catalog = catalog
+        self._online_ddl = online_ddl
+        # EventDispatcher notified about introspection queries and executed DDL statements.
+        self._events = events or EventDispatcher()
+        # DDLRetryPolicy limiting lock waits of DDL statements (None - server defaults, no retries).
+        self._ddl_retry = ddl_retry
+        # List of {'table', 'sql', 'algorithm', 'lock'} of ALTER TABLE statements executed in online DDL mode.
+        self.online_ddl_report = []
+        # Canonical forms of column definitions by definition, see _normalize_column_definition().
+        self._normalized_definitions = {}
+        # Physical order of existing columns is not changed: True - in all tables, number - in tables with at least
+        # that many rows (InnoDB estimate). New columns are then added at the end of the table.
+        self._ignore_column_order = ignore_column_order
+        # Estimated row counts of tables, loaded when needed by the ignore_column_order/shadow_tables threshold.
+        self._table_rows = {}
+        # Tables that are migrated by copying rows to a shadow table with the new definition, which then replaces
+        # the table: collection of table names or number - tables with at least that many rows (None - no tables).
+        self._shadow_tables = shadow_tables
+        # Callable (conn, name, table_name, key_column, process_batch) that runs process_batch(cursor, rows) for
+        # batches of keys of the table (Backfill.Run() with throttling options), required with shadow_tables.
+        self._shadow_copy = shadow_copy
+        # DDLProgressMonitor polling progress of executed DDL statements (None - no progress reporting).
+        self._progress = progress
 
     #-----------------------------------------------------------------------------------------------------------
 
+    # Without connection (offline diff against saved CatalogSnapshot) server version is taken from the snapshot.
+    def _get_server_info(self):
+        if self._conn is not None:
+            return self._conn.get_server_info() or ''
+        return (self._catalog.server_info if self._catalog is not None else None) or ''
+
+    def _escape(self, value):
+        if self._conn is not None:
+            return self._conn.escape(value)
+        return pymysql.converters.escape_item(value, 'utf8mb4')
+
+    def _check_offline_table(self, table_name):
+        if self._conn is None:
+            raise ValueError('Table {0} is not in the catalog snapshot'.format(table_name))
+
+    # Returns checksum of columns and indexes of the tables computed by the server with one query,
+    # so that saved CatalogSnapshot can be verified without reading the whole catalog.
+    def GetCatalogChecksum(self, table_names):
+
+        table_names = tuple(table_names)
+        if not table_names:
+            return ''
+
+        with self._conn.cursor() as cursor:
+            sql = """
+                SELECT (SELECT CONCAT(COUNT(*), ':', IFNULL(SUM(CRC32(x)), 0), ':', IFNULL(BIT_XOR(CRC32(x)), 0))
+                          FROM (SELECT CONCAT_WS('|', TABLE_NAME, COLUMN_NAME, ORDINAL_POSITION, COLUMN_TYPE,
+                                                 IS_NULLABLE, COLUMN_KEY, IFNULL(COLUMN_DEFAULT, '<NULL>'), EXTRA) AS x
+                                  FROM information_schema.COLUMNS
+                                 WHERE TABLE_SCHEMA = DATABASE()
+                                   AND TABLE_NAME IN %s) AS c),
+                       (SELECT CONCAT(COUNT(*), ':', IFNULL(SUM(CRC32(x)), 0), ':', IFNULL(BIT_XOR(CRC32(x)), 0))
+                          FROM (SELECT CONCAT_WS('|', TABLE_NAME, NON_UNIQUE, INDEX_NAME, SEQ_IN_INDEX, COLUMN_NAME,
+                                                 COLLATION, SUB_PART, INDEX_TYPE) AS x
+                                  FROM information_schema.STATISTICS
+                                 WHERE TABLE_SCHEMA = DATABASE()
+                                   AND TABLE_NAME IN %s) AS i),
+                       (SELECT CONCAT(COUNT(*), ':', IFNULL(SUM(CRC32(x)), 0), ':', IFNULL(BIT_XOR(CRC32(x)), 0))
+                          FROM (SELECT CONCAT_WS('|', TABLE_NAME, PARTITION_NAME, PARTITION_METHOD,
+                                                 PARTITION_EXPRESSION, PARTITION_DESCRIPTION) AS x
+                                  FROM information_schema.PARTITIONS
+                                 WHERE TABLE_SCHEMA = DATABASE()
+                                   AND TABLE_NAME IN %s
+                                   AND PARTITION_NAME IS NOT NULL) AS p)
+            """
+            cursor.execute(sql, (table_names, table_names, table_names))
+            row = cursor.fetchone()
+
+        return '{0}/{1}/{2}'.format(row[0], row[1], row[2])
+
+    # Returns [(sql, params)] of catalog queries for LoadCatalogSnapshot(), so that they can be also executed
+    # on asynchronous connection.
+    def GetCatalogQueries(self, table_names):
+
+        table_names = tuple(table_names)
+        if not table_names:
+            return []
+
+        columns_sql = """
+            SELECT TABLE_NAME, COLUMN_NAME, COLUMN_TYPE, IS_NULLABLE, COLUMN_KEY, COLUMN_DEFAULT, EXTRA
+              FROM information_schema.COLUMNS
+             WHERE TABLE_SCHEMA = DATABASE()
+               AND TABLE_NAME IN %s
+             ORDER BY TABLE_NAME, ORDINAL_POSITION
+        """
+        indexes_sql = """
+            SELECT TABLE_NAME, NON_UNIQUE, INDEX_NAME, SEQ_IN_INDEX, COLUMN_NAME, COLLATION, SUB_PART, INDEX_TYPE
+              FROM information_schema.STATISTICS
+             WHERE TABLE_SCHEMA = DATABASE()
+               AND TABLE_NAME IN %s
+             ORDER BY TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX
+        """
+        return [(columns_sql, (table_names,)), (indexes_sql, (table_names,)), (PARTITIONS_SQL, (table_names,))]
+
+    # Builds CatalogSnapshot from rows returned by queries of GetCatalogQueries().
+    def BuildCatalogSnapshot(self, table_names, results):
+
+        catalog = CatalogSnapshot(db_type="mysql", server_info=self._get_server_info())
+        # information_schema may return table names in different letter case (lower_case_table_names).
+        requested_tables = {}
+        for table_name in table_names:
+            catalog.AddTable(table_name)
+            requested_tables[table_name.lower()] = table_name
+        if not requested_tables:
+            self._catalog = catalog
+            return catalog
+
+        # MariaDB returns quoted literals (and 'NULL') in information_schema.COLUMNS.COLUMN_DEFAULT.
+        is_mariadb = 'mariadb' in catalog.server_info.lower()
+
+        column_rows, index_rows, partition_rows = results
+        prev_name = None
+        prev_table_name = None
+        for row in column_rows:
+            table_name = requested_tables.get(row[0].lower())
+            if table_name is None:
+                continue
+            if table_name != prev_table_name:
+                prev_name = None
+                prev_table_name = table_name
+            name = row[1]
+            default_value = row[5]
+            if is_mariadb and default_value is not None:
+                if default_value == 'NULL':
+                    default_value = None
+                elif len(default_value) >= 2 and default_value[0] == "'" and default_value[-1] == "'":
+                    default_value = default_value[1:-1].replace("''", "'")
+
+            catalog.GetTableColumns(table_name)[name] = {
+                'column_definition': self._column_definition_from_catalog(
+                    row[2], row[3] == 'NO', default_value, row[6] == 'auto_increment'),
+                'is_in_primary_key': (row[4] == 'PRI'),
+                'prev_name': prev_name
+            }
+            prev_name = name
+
+        for row in index_rows:
+            table_name = requested_tables.get(row[0].lower())
+            if table_name is None:
+                continue
+            self._add_index_column(catalog.GetTableIndexes(table_name), int(row[1]), row[2], int(row[3]), row[4],
+                                   row[5], row[6], row[7])
+
+        table_partition_rows = {}
+        for row in partition_rows:
+            table_name = requested_tables.get(row[0].lower())
+            if table_name is not None:
+                table_partition_rows.setdefault(table_name, []).append(row)
+        for table_name, rows in table_partition_rows.items():
+            catalog.SetTablePartitioning(table_name, self._partitioning_from_catalog(rows))
+
+        self._catalog = catalog
+        return catalog
+
+    # Uses already loaded (e.g. saved) snapshot instead of reading the catalog. With conn=None the snapshot
+    # has to contain all tables, changes can be planned but not executed.
+    def SetCatalogSnapshot(self, catalog):
+        self._catalog = catalog
+
+    # Loads columns and indexes of all given tables with fixed number of queries, instead of 2 queries per table.
+    def LoadCatalogSnapshot(self, table_names):
+
+        table_names = list(table_names)
+        results = []
+        with self._events.Timed('introspection') as event, self._conn.cursor() as cursor:
+            for sql, params in self.GetCatalogQueries(table_names):
+                cursor.execute(sql, params)
+                results.append(cursor.fetchall())
+            event['rowcount'] = sum(len(rows) for rows in results)
+
+        return self.BuildCatalogSnapshot(table_names, results)
+
+    #-----------------------------------------------------------------------------------------------------------
+
+    def _column_definition_from_catalog(self, type, is_notnull, default_value, is_autoincrement):
+
+        if type.upper().startswith('ENUM('):
+            column_definition = type[:5].upper() + type[5:]
+        else:
+            column_definition = type.upper()
+        if is_autoincrement:
+            column_definition += ' AUTO_INCREMENT'
+        if is_notnull:
+            column_definition += ' NOT NULL'
+        if default_value is not None:
+            column_definition += ' DEFAULT '
+            column_definition += self._escape(str(default_value))
+
+        return column_definition
+
     def _get_table_columns(self, table_name):
 
+        if self._catalog is not None and self._catalog.HasTable(table_name):
+            return self._catalog.GetTableColumns(table_name)
+        self._check_offline_table(table_name)
+
         table_columns = None
-        with self._conn.cursor() as cursor:
+        with self._events.Timed('introspection', table=table_name), self._conn.cursor() as cursor:
             sql = "SHOW COLUMNS FROM {0}".format(table_name)
             try:
                 cursor.execute(sql)
@@ -21,26 +313,11 @@ class MySQLSchema():
                 prev_name = None
                 for row in result:
                     name = row[0]
-                    type = row[1]
-                    is_notnull = (row[2] == 'NO')
                     is_in_primary_key = (row[3] == 'PRI')
-                    default_value = row[4]
-                    is_autoincrement = (row[5] == 'auto_increment')
-
-                    if type.upper().startswith('ENUM('):
-                        column_definition = type[:5].upper() + type[5:]
-                    else:
-                        column_definition = type.upper()
-                    if is_autoincrement:
-                        column_definition += ' AUTO_INCREMENT'
-                    if is_notnull:
-                        column_definition += ' NOT NULL'
-                    if default_value is not None:
-                        column_definition += ' DEFAULT '
-                        column_definition += self._conn.escape(str(default_value))
 
                     table_columns[name] = {
-                        'column_definition': column_definition,
+                        'column_definition': self._column_definition_from_catalog(
+                            row[1], row[2] == 'NO', row[4], row[5] == 'auto_increment'),
                         'is_in_primary_key': is_in_primary_key,
                         'prev_name': prev_name
                     }
@@ -56,34 +333,45 @@ class MySQLSchema():
 
     #-----------------------------------------------------------------------------------------------------------
 
+    # Collation is 'D' for descending columns, sub_part is length of prefix index and index_type 'BTREE' for
+    # ordinary indexes of InnoDB.
+    def _add_index_column(self, table_indexes, non_unique, index_name, seq_in_index, column_name,
+                          collation=None, sub_part=None, index_type=None):
+
+        type = None
+        if index_name == 'PRIMARY':
+            type = 'PRIMARY'
+        elif non_unique == 0:
+            type = 'UNIQUE'
+
+        if index_name not in table_indexes:
+            method = index_type.lower() if index_type is not None and index_type != 'BTREE' else None
+            table_indexes[index_name] = IndexDef(type, [], lengths=[], descending=[], method=method)
+
+        index = table_indexes[index_name]
+        while len(index.columns) < seq_in_index:
+            index.columns.append('')
+            index.lengths.append(None)
+            index.descending.append(False)
+        index.columns[seq_in_index - 1] = column_name
+        index.lengths[seq_in_index - 1] = int(sub_part) if sub_part is not None else None
+        index.descending[seq_in_index - 1] = (collation == 'D')
+
     def _get_table_indexes(self, table_name):
 
+        if self._catalog is not None and self._catalog.HasTable(table_name):
+            return self._catalog.GetTableIndexes(table_name)
+        self._check_offline_table(table_name)
+
         table_indexes = None
-        with self._conn.cursor() as cursor:
+        with self._events.Timed('introspection', table=table_name), self._conn.cursor() as cursor:
             sql = "SHOW INDEXES FROM {0}".format(table_name)
             try:
                 cursor.execute(sql)
                 result = cursor.fetchall()
                 table_indexes = {}
                 for row in result:
-                    non_unique = row[1]
-                    index_name = row[2]
-                    seq_in_index = row[3]
-                    column_name = '`{0}`'.format(row[4])
-
-                    type = None
-                    if index_name == 'PRIMARY':
-                        type = 'PRIMARY'
-                    elif non_unique == 0:
-                        type = 'UNIQUE'
-
-                    if index_name not in table_indexes:
-                        table_indexes[index_name] = { 'columns': [] }
-
-                    table_indexes[index_name]['type'] = type
-                    while len(table_indexes[index_name]['columns']) < seq_in_index:
-                        table_indexes[index_name]['columns'].append('')
-                    table_indexes[index_name]['columns'][seq_in_index - 1] = column_name
+                    self._add_index_column(table_indexes, row[1], row[2], row[3], row[4], row[5], row[7], row[10])
 
             except pymysql.err.ProgrammingError as e:
                 if e.args[0] == pymysql.constants.ER.NO_SUCH_TABLE:
@@ -95,8 +383,75 @@ class MySQLSchema():
 
     #-----------------------------------------------------------------------------------------------------------
 
+    # Returns {'method', 'column', 'partitions'} (see DDLParser for shape of partitions) from rows
+    # of PARTITIONS_SQL of one table, or None if the table is not partitioned.
+    def _partitioning_from_catalog(self, rows):
+
+        if not rows:
+            return None
+
+        method = PARTITION_METHODS.get(rows[0][2], rows[0][2])
+        partitions = []
+        lower = None
+        for row in rows:
+            upper = None
+            values = None
+            if method == 'RANGE':
+                # Upper bound of the last partition can be MAXVALUE.
+                description = (row[4] or '').strip("'")
+                upper = int(description) if re.match(r'^-?\d+$', description) else None
+            elif method == 'LIST':
+                values = list(ParseListValues(row[4] or ''))
+            partitions.append({'name': row[1], 'from': lower, 'to': upper, 'values': values, 'is_default': False})
+            lower = upper
+
+        return {'method': method, 'column': (rows[0][3] or '').replace('`', ''), 'partitions': partitions}
+
+    def _get_table_partitioning(self, table_name):
+
+        if self._catalog is not None and self._catalog.HasTable(table_name):
+            return self._catalog.GetTablePartitioning(table_name)
+        self._check_offline_table(table_name)
+
+        with self._events.Timed('introspection', table=table_name), self._conn.cursor() as cursor:
+            cursor.execute(PARTITIONS_SQL, ((table_name,),))
+            return self._partitioning_from_catalog(cursor.fetchall())
+
+    #-----------------------------------------------------------------------------------------------------------
+
+    # Maps declared or introspected column definition to canonical form, so that definitions differing only in
+    # spelling (integer display widths, type synonyms, JSON reported as LONGTEXT by MariaDB) are equal.
+    def _normalize_column_definition(self, column_definition):
+
+        normalized = self._normalized_definitions.get(column_definition)
+        if normalized is not None:
+            return normalized
+
+        matches = COLUMN_DEFINITION_PATTERN.match(column_definition)
+        if not matches:
+            return column_definition
+
+        type = TYPE_ALIASES.get(matches.group(1), matches.group(1))
+        type_arguments = matches.group(3)
+        if '(' in type:
+            type, type_arguments = type[:-1].split('(')
+        if type in INTEGER_TYPES and not (type == 'TINYINT' and type_arguments == '1'):
+            type_arguments = None
+        # MariaDB implements JSON as alias of LONGTEXT.
+        if type == 'JSON' and 'mariadb' in self._get_server_info().lower():
+            type = 'LONGTEXT'
+
+        normalized = type
+        if type_arguments is not None:
+            normalized += '({0})'.format(type_arguments)
+        normalized += ''.join(x for x in matches.group(4, 5, 6, 7) if x is not None)
+
+        self._normalized_definitions[column_definition] = normalized
+        return normalized
+
     def _column_definition_matches(self, sql_field_definition, table_column_definition, is_in_primary_key):
-        current_column_definition = table_column_definition
+        sql_field_definition = self._normalize_column_definition(sql_field_definition)
+        current_column_definition = self._normalize_column_definition(table_column_definition)
         if sql_field_definition == current_column_definition:
             return True
 
@@ -113,225 +468,790 @@ class MySQLSchema():
 
         return False
 
-    def _update_table_columns(self, table_name, sql_fields):
+    def _is_column_order_ignored(self, table_name):
 
-        table_columns = self._get_table_columns(table_name)
+        if self._ignore_column_order is True or self._ignore_column_order is False:
+            return self._ignore_column_order
+        if self._conn is None:
+            return False
 
-        with self._conn.cursor() as cursor:
-            if len(table_columns) == 0:
-                sql = "CREATE TABLE {0} ({1})".format(
-                    table_name,
-                    ','.join('`{0}` {1}'.format(f['name'], f['column_definition']) for f in sql_fields))
-                sql = sql.replace('AUTO_INCREMENT', '')
-                try:
-                    cursor.execute(sql)
-                except pymysql.err.ProgrammingError as e:
-                    raise
+        return self._get_table_rows(table_name) >= self._ignore_column_order
+
+    def _get_table_rows(self, table_name):
+
+        if table_name not in self._table_rows:
+            # Load row counts of all tables of the catalog at once, other tables will probably need them too.
+            table_names = set(self._catalog.GetTableNames() if self._catalog is not None else [])
+            table_names.add(table_name)
+            table_names = [x for x in table_names if x not in self._table_rows]
+            table_stats = self.GetTableStats(table_names)
+            for name in table_names:
+                self._table_rows[name] = table_stats.get(name, {}).get('rows', 0)
+
+        return self._table_rows[table_name]
+
+    # Returns names of existing columns that keep their place when the table is reordered to the declared order.
+    # These are the longest subsequence of declared columns which are already in the same order in the table,
+    # so only the remaining columns have to be moved.
+    # names - existing names of the declared columns in the declared order.
+    def _get_unmoved_columns(self, table_columns, names):
+
+        table_positions = dict((name, position) for position, name in enumerate(table_columns))
+
+        # Longest increasing subsequence of table positions (patience sorting).
+        tails = []
+        tail_indexes = []
+        predecessors = [None] * len(names)
+        for i, name in enumerate(names):
+            position = table_positions[name]
+            j = bisect.bisect_left(tails, position)
+            if j == len(tails):
+                tails.append(position)
+                tail_indexes.append(i)
+            else:
+                tails[j] = position
+                tail_indexes[j] = i
+            predecessors[i] = tail_indexes[j - 1] if j > 0 else None
+
+        unmoved = set()
+        i = tail_indexes[-1] if tail_indexes else None
+        while i is not None:
+            unmoved.add(names[i])
+            i = predecessors[i]
+
+        return unmoved
+
+    def _plan_table_columns(self, plan, table_columns, table_def, renamed_columns):
+
+        if plan.is_new_table:
+            for column in table_def.columns:
+                column_definition = self._render_column_definition(column)
+                plan.AddChange('add_column', column.name,
+                    '`{0}` {1}'.format(column.name, column_definition),
+                    new_definition=column_definition)
+            return
+
+        # Name of each declared column in the table (old name of columns that are going to be renamed).
+        new_names = dict((new_name, old_name) for old_name, new_name in renamed_columns.items())
+        table_names = [new_names.get(column.name, column.name) for column in table_def.columns
+                       if new_names.get(column.name, column.name) in table_columns]
+
+        kept_names = set(table_names)
+        for name, metadata in table_columns.items():
+            if name not in kept_names:
+                plan.AddChange('drop_column', name,
+                    'DROP COLUMN `{0}`'.format(name),
+                    old_definition=metadata['column_definition'])
 
+        unmoved_columns = self._get_unmoved_columns(table_columns, table_names)
+        ignore_column_order = False
+        if len(unmoved_columns) < len(table_names):
+            ignore_column_order = self._is_column_order_ignored(plan.table_name)
+
+        # Columns added behind the last kept column are appended without position, which older servers
+        # can still do instantly.
+        trailing_names = set()
+        for column in reversed(table_def.columns):
+            if new_names.get(column.name, column.name) in table_columns:
+                break
+            trailing_names.add(column.name)
+
+        # Moved and added columns are placed after their declared predecessor. Clauses of ALTER TABLE are applied
+        # in order, so the predecessor is always already at its final place.
+        prev_column_name = None
+        for column in table_def.columns:
+            column_definition = self._render_column_definition(column)
+            position = 'FIRST' if prev_column_name is None else 'AFTER `{0}`'.format(prev_column_name)
+            table_name = new_names.get(column.name, column.name)
+            if table_name not in table_columns:
+                if ignore_column_order or column.name in trailing_names:
+                    plan.AddChange('add_column', column.name,
+                        'ADD COLUMN `{0}` {1}'.format(column.name, column_definition),
+                        new_definition=column_definition, position=None)
+                else:
+                    plan.AddChange('add_column', column.name,
+                        'ADD COLUMN `{0}` {1} {2}'.format(column.name, column_definition, position),
+                        new_definition=column_definition, position=position)
             else:
-                for name, metadata in table_columns.items():
-                    if name not in [field['name'] for field in sql_fields]:
-                        sql = 'ALTER TABLE {0} DROP COLUMN `{1}`'.format(
-                            table_name, name)
-                        try:
-                            cursor.execute(sql)
-                        except pymysql.err.ProgrammingError as e:
-                            raise
-
-                prev_field_name = None
-                for field in sql_fields:
-                    if field['name'] not in table_columns:
-                        sql = 'ALTER TABLE {0} ADD COLUMN `{1}` {2} {3}'.format(
-                            table_name, field['name'], field['column_definition'],
-                            'FIRST' if prev_field_name is None else 'AFTER `{0}`'.format(prev_field_name))
-                        try:
-                            cursor.execute(sql)
-                        except pymysql.err.ProgrammingError as e:
-                            raise
+                table_column = table_columns[table_name]
+                definition_matches = self._column_definition_matches(column_definition,
+                    table_column['column_definition'],
+                    table_column['is_in_primary_key'])
+                is_moved = table_name not in unmoved_columns and not ignore_column_order
+
+                if table_name != column.name and definition_matches and not is_moved:
+                    # Pure rename is metadata-only change.
+                    if self._server_version_at_least([8, 0], [10, 5, 2]):
+                        sql = 'RENAME COLUMN `{0}` TO `{1}`'.format(table_name, column.name)
                     else:
-                        table_column = table_columns[field['name']]
+                        sql = 'CHANGE COLUMN `{0}` `{1}` {2}'.format(table_name, column.name, column_definition)
+                    plan.AddChange('rename_column', column.name, sql, old_name=table_name,
+                        old_definition=table_column['column_definition'], new_definition=column_definition)
+                elif is_moved:
+                    plan.AddChange('change_column', column.name,
+                        'CHANGE COLUMN `{0}` `{1}` {2} {3}'.format(table_name, column.name, column_definition,
+                                                                   position),
+                        old_name=table_name,
+                        old_definition=table_column['column_definition'],
+                        new_definition=column_definition, position=position,
+                        is_reorder_only=definition_matches,
+                        is_moved=True)
+                elif not definition_matches:
+                    plan.AddChange('change_column', column.name,
+                        'CHANGE COLUMN `{0}` `{1}` {2}'.format(table_name, column.name, column_definition),
+                        old_name=table_name,
+                        old_definition=table_column['column_definition'],
+                        new_definition=column_definition, position=None,
+                        is_reorder_only=False,
+                        is_moved=False)
 
-                        if not self._column_definition_matches(field['column_definition'],
-                            table_column['column_definition'],
-                            table_column['is_in_primary_key']) or \
-                            prev_field_name != table_column['prev_name']:
+            prev_column_name = column.name
 
-                            sql = 'ALTER TABLE {0} CHANGE COLUMN `{1}` `{2}` {3} {4}'.format(
-                                table_name, field['name'], field['name'], field['column_definition'],
-                                'FIRST' if prev_field_name is None else 'AFTER `{0}`'.format(prev_field_name))
-                            try:
-                                cursor.execute(sql)
-                            except pymysql.err.ProgrammingError as e:
-                                raise
+    #-----------------------------------------------------------------------------------------------------------
 
-                    prev_field_name = field['name']
+    # Returns declared index in the form it's introspected from this server, for matching with existing indexes.
+    def _get_comparable_index(self, table_name, index):
 
-        return True
+        index_name = index.name or '({0})'.format(','.join(index.columns))
+        if index.include or index.where is not None:
+            raise ValueError('Index {0} of table {1}: INCLUDE and WHERE are not supported by MySQL'.format(
+                index_name, table_name))
+        if index.method not in (None, 'btree'):
+            raise ValueError('Index {0} of table {1}: method {2} is not supported by MySQL'.format(
+                index_name, table_name, index.method))
+
+        # Older servers accept DESC, but create ascending index.
+        descending = index.descending if self._server_version_at_least([8, 0], [10, 8]) else None
+        return IndexDef(index.type, index.columns, name=index.name, renamed_from=index.renamed_from,
+                        lengths=index.lengths, descending=descending)
+
+    def _render_index_columns(self, index):
+
+        columns = []
+        for i, column in enumerate(index.columns):
+            sql = '`{0}`'.format(column)
+            if index.lengths is not None and index.lengths[i] is not None:
+                sql += '({0})'.format(index.lengths[i])
+            if index.descending is not None and index.descending[i]:
+                sql += ' DESC'
+            columns.append(sql)
+        return ','.join(columns)
+
+    def _plan_table_indexes(self, plan, table_indexes, table_def, renamed_columns):
+
+        comparable_indexes = [self._get_comparable_index(plan.table_name, index) for index in table_def.indexes]
+        matches = MatchIndexes(table_indexes, comparable_indexes, renamed_columns)
+        if not self._server_version_at_least([5, 7], [10, 5, 2]):
+            # Server doesn't support RENAME INDEX, renamed indexes are dropped and created again.
+            matches = [index_name if index.name in (None, index_name) else None
+                       for index, index_name in zip(table_def.indexes, matches)]
+
+        for index_name, index in table_indexes.items():
+            if index_name not in matches:
+                if index.type == 'PRIMARY':
+                    plan.AddChange('drop_primary_key', index_name, 'DROP PRIMARY KEY')
+                else:
+                    plan.AddChange('drop_index', index_name, 'DROP INDEX `{0}`'.format(index_name))
+
+        for index, index_name in zip(table_def.indexes, matches):
+            if index_name is not None:
+                if index.name is not None and index.name != index_name:
+                    plan.AddChange('rename_index', index.name,
+                        'RENAME INDEX `{0}` TO `{1}`'.format(index_name, index.name), old_name=index_name)
+                continue
+
+            prefix = '' if plan.is_new_table else 'ADD '
+            columns = self._render_index_columns(index)
+            name = '' if index.name is None else '`{0}` '.format(index.name)
+            if index.type == 'PRIMARY':
+                plan.AddChange('add_primary_key', 'PRIMARY', '{0}PRIMARY KEY ({1})'.format(prefix, columns),
+                    columns=index.columns)
+            elif index.type == 'UNIQUE':
+                plan.AddChange('add_index', index.name, '{0}UNIQUE INDEX {1}({2})'.format(prefix, name, columns),
+                    columns=index.columns, type=index.type)
+            else:
+                plan.AddChange('add_index', index.name, '{0}INDEX {1}({2})'.format(prefix, name, columns),
+                    columns=index.columns, type=index.type)
 
     #-----------------------------------------------------------------------------------------------------------
 
-    def _update_table_indexes(self, table_name, sql_indexes):
+    def _render_range_partition(self, lower, upper):
+        name = 'pmin' if lower is None else 'p{0}'.format(lower)
+        return 'PARTITION `{0}` VALUES LESS THAN ({1})'.format(name, upper)
+
+    def _render_list_partition(self, name, values):
+        return 'PARTITION `{0}` VALUES IN ({1})'.format(name, ','.join(values))
+
+    # New range partitioned table gets partitions from the current interval on, the first one holds also all
+    # lower keys.
+    def _render_partitioning(self, partitioning):
+
+        column = '`{0}`'.format(partitioning.column)
+        if partitioning.method == 'HASH':
+            return 'PARTITION BY HASH ({0}) PARTITIONS {1}'.format(column, partitioning.count)
+        if partitioning.method == 'LIST':
+            return 'PARTITION BY LIST COLUMNS ({0}) ({1})'.format(column, ', '.join(
+                self._render_list_partition(name, values) for name, values in partitioning.lists))
+        return 'PARTITION BY RANGE ({0}) ({1})'.format(column, ', '.join(
+            self._render_range_partition(lower, upper)
+            for lower, upper in GetMissingRangePartitions(partitioning, [], int(time.time()))))
+
+    # Changes of partitioning are separate ALTER TABLE statements (partition options can't be combined with
+    # other changes), issued after the changes of columns and indexes. Partitions of RANGE partitioned tables
+    # are managed by MaintainPartitions().
+    def _plan_table_partitioning(self, plan, table_partitioning, table_def):
+
+        partitioning = table_def.partitioning
+        if partitioning is None:
+            if table_partitioning is not None:
+                plan.AddChange('remove_partitioning', None, 'REMOVE PARTITIONING', partition=True)
+            return
+
+        if table_partitioning is None or table_partitioning['method'] != partitioning.method or \
+           table_partitioning['column'] != partitioning.column:
+            plan.AddChange('partition_by', partitioning.column, self._render_partitioning(partitioning),
+                partition=True)
+            return
 
-        table_indexes = self._get_table_indexes(table_name)
+        if partitioning.method == 'HASH':
+            count = len(table_partitioning['partitions'])
+            if partitioning.count > count:
+                plan.AddChange('resize_partitions', None,
+                    'ADD PARTITION PARTITIONS {0}'.format(partitioning.count - count), partition=True)
+            elif partitioning.count < count:
+                plan.AddChange('resize_partitions', None,
+                    'COALESCE PARTITION {0}'.format(count - partitioning.count), partition=True)
 
+        elif partitioning.method == 'LIST':
+            added, changed, dropped = DiffListPartitions(partitioning, table_partitioning['partitions'],
+                                                         lambda name: name)
+            for name in dropped:
+                plan.AddChange('drop_partition', name, 'DROP PARTITION `{0}`'.format(name), partition=True)
+            for name, values in changed:
+                plan.AddChange('reorganize_partition', name, 'REORGANIZE PARTITION `{0}` INTO ({1})'.format(
+                    name, self._render_list_partition(name, values)), partition=True)
+            for name, values in added:
+                plan.AddChange('add_partition', name,
+                    'ADD PARTITION ({0})'.format(self._render_list_partition(name, values)), partition=True)
+
+    # Returns TablePlan that creates partitions of the table declared with PARTITION BY RANGE for the current
+    # and PRECREATE future intervals and drops partitions older than RETENTION. now is the current value
+    # of the partition key (default: unix timestamp). Both are metadata-only operations.
+    def PlanPartitionMaintenance(self, table_name, schema, now=None):
+
+        table_def = ParseTableSchema(schema)
+        partitioning = table_def.partitioning
+        plan = TablePlan(table_name)
+        if partitioning is None or partitioning.method != 'RANGE':
+            return plan
+        table_partitioning = self._get_table_partitioning(table_name)
+        # Table that doesn't exist or wasn't migrated yet is left to UpdateSchema().
+        if table_partitioning is None or table_partitioning['method'] != 'RANGE' or \
+           table_partitioning['column'] != partitioning.column:
+            return plan
+
+        now = int(time.time()) if now is None else now
+        for lower, upper in GetMissingRangePartitions(partitioning, table_partitioning['partitions'], now):
+            plan.AddChange('add_partition', 'p{0}'.format(lower),
+                'ADD PARTITION ({0})'.format(self._render_range_partition(lower, upper)), partition=True)
+        for name in GetExpiredRangePartitions(partitioning, table_partitioning['partitions'], now):
+            plan.AddChange('drop_partition', name, 'DROP PARTITION `{0}`'.format(name), partition=True)
+
+        return plan
+
+    def MaintainPartitions(self, table_name, schema, now=None):
+
+        plan = self.PlanPartitionMaintenance(table_name, schema, now)
         with self._conn.cursor() as cursor:
+            for sql in self.RenderTablePlan(plan):
+                self._execute_ddl(cursor, table_name, sql)
 
-            drop_primary_key_pending = False
-
-            for index_name, index_schema in table_indexes.items():
-                if index_schema not in sql_indexes:
-                    if index_schema['type'] == 'PRIMARY':
-                        drop_primary_key_pending = True
-                        continue
-
-                    sql = 'ALTER TABLE {0} DROP INDEX {1}'.format(
-                        table_name, index_name)
-                    try:
-                        cursor.execute(sql)
-                    except pymysql.err.ProgrammingError as e:
-                        raise
-
-            for index in sql_indexes:
-                index_exists = False
-                for _, index_schema in table_indexes.items():
-                    if index_schema == index:
-                        index_exists = True
-                        break
-                if not index_exists:
-                    if index['type'] == 'PRIMARY':
-                        sql = 'ALTER TABLE {0} {1} ADD PRIMARY KEY ({2})'.format(
-                            table_name,
-                            ' DROP PRIMARY KEY,' if drop_primary_key_pending else '',
-                            ','.join(index['columns']))
-                        drop_primary_key_pending = False
-                    elif index['type'] == 'UNIQUE':
-                        sql = 'ALTER TABLE {0} ADD UNIQUE INDEX ({1})'.format(
-                            table_name, ','.join(index['columns']))
-                    else:
-                        sql = 'ALTER TABLE {0} ADD INDEX ({1})'.format(
-                            table_name, ','.join(index['columns']))
-
-                    try:
-                        cursor.execute(sql)
-                    except pymysql.err.ProgrammingError as e:
-                        raise
-
-            if drop_primary_key_pending:
-                sql = 'ALTER TABLE {0} DROP PRIMARY KEY'.format(
-                    table_name)
-                try:
-                    cursor.execute(sql)
-                except pymysql.err.ProgrammingError as e:
-                    raise
+        return plan
 
-        return True
+    #-----------------------------------------------------------------------------------------------------------
+
+    # All changes of columns and indexes of the table are issued as one statement, so the table is rebuilt
+    # at most once. AUTO_INCREMENT column and its PRIMARY KEY are created in the same statement.
+    def RenderTablePlan(self, plan):
+        return self._render_table_statements(plan) + self.GetPartitionStatements(plan)
+
+    def _render_table_statements(self, plan):
+
+        if plan.IsEmpty():
+            return []
+        changes = [change for change in plan.changes if not change.get('partition')]
+        clauses = ', '.join(change['sql'] for change in changes)
+        if plan.is_new_table:
+            partitioning = ''.join(' ' + change['sql'] for change in plan.GetChanges('partition_by'))
+            return ['CREATE TABLE {0} ({1}){2}'.format(plan.table_name, clauses, partitioning)]
+        if not changes:
+            return []
+        return ['ALTER TABLE {0} {1}'.format(plan.table_name, clauses)]
+
+    # Returns ALTER TABLE statements changing partitioning of existing table.
+    def GetPartitionStatements(self, plan):
+        if plan.is_new_table:
+            return []
+        return ['ALTER TABLE {0} {1}'.format(plan.table_name, change['sql'])
+                for change in plan.changes if change.get('partition')]
+
+    def _execute_ddl(self, cursor, table_name, sql):
+        # Cached catalog of the table is no longer valid once we start altering it.
+        if self._catalog is not None:
+            self._catalog.InvalidateTable(table_name)
+        with self._events.Timed('ddl', table=table_name, sql=sql) as event, self._watch_progress(table_name, sql):
+            if self._ddl_retry is None:
+                cursor.execute(sql)
+            else:
+                self._execute_ddl_with_lock_timeout(cursor, table_name, sql)
+            event['rowcount'] = cursor.rowcount
+
+    def _watch_progress(self, table_name, sql):
+        if self._progress is None:
+            return contextlib.nullcontext()
+        return self._progress.Watch(self._conn, table_name, sql)
+
+    def _is_lock_timeout(self, e):
+        return isinstance(e, pymysql.err.MySQLError) and e.args[0] == pymysql.constants.ER.LOCK_WAIT_TIMEOUT
+
+    # Waiting for metadata lock is limited by lock_wait_timeout, session value is restored afterwards.
+    def _execute_ddl_with_lock_timeout(self, cursor, table_name, sql):
+        lock_wait_timeout = max(1, int(math.ceil(self._ddl_retry.lock_timeout)))
+        cursor.execute("SET @sql_schema_builder_lock_wait_timeout = @@SESSION.lock_wait_timeout, "
+                       "SESSION lock_wait_timeout = {0}".format(lock_wait_timeout))
+        try:
+            self._ddl_retry.Execute(lambda: cursor.execute(sql), self._is_lock_timeout, table_name, sql)
+        finally:
+            cursor.execute("SET SESSION lock_wait_timeout = @sql_schema_builder_lock_wait_timeout")
 
     #-----------------------------------------------------------------------------------------------------------
 
-    def UpdateTableSchema(self, table_name, schema):
+    # Splits column definition to (type, type_arguments, is_unsigned, is_notnull, default).
+    def _split_column_definition(self, column_definition):
+        matches = COLUMN_DEFINITION_PATTERN.match(column_definition)
+        if not matches:
+            return column_definition, None, False, False, None
+        return matches.group(1), matches.group(3), matches.group(4) is not None, \
+               matches.group(6) is not None, matches.group(7)
 
-        field_pattern = r'^\s*(\w+)\s+(\w+)(\(([^)]+)\))?(\s+UNSIGNED)?(\s+AUTO_INCREMENT)?(\s+NOTNULL)?(\s+DEFAULT\s+\'?([\w\.]*)\'?)?\s*$'
-        index_pattern = r'^\s*INDEX\s+((\w+)\s+)?\(([^\)]+)\)\s*$'
-
-        column_types = {
-            'I': 'INT(11)',
-            'I1': 'TINYINT(4)',
-            'I2': 'SMALLINT(6)',
-            'I8': 'BIGINT(20)',
-            'F': 'DOUBLE',
-            'N': 'DECIMAL(10,2)',
-
-            'C': 'VARCHAR',
-            'MX': 'MEDIUMTEXT',
-            'X': 'LONGTEXT',
-            'MB': 'MEDIUMBLOB',
-            'B': 'LONGBLOB',
-            'J': 'JSON',
-            'BIN': 'BINARY',
-
-            'D': 'DATE',
-            'T': 'DATETIME',
-
-            'ENUM': 'ENUM',
-
-            'INT8': 'TINYINT(4)',
-            'INT16': 'SMALLINT(6)',
-            'INT32': 'INT(11)',
-            'INT64': 'BIGINT(20)',
-            'CHAR': 'VARCHAR',
-            'DOUBLE': 'DOUBLE',
-            'TEXT': 'LONGTEXT',
-            'BLOB': 'LONGBLOB',
-            'JSON': 'JSON',
-            'BOOL': 'TINYINT(1)',
-            'BOOLEAN': 'TINYINT(1)',
-        }
+    def _server_version_at_least(self, mysql_version, mariadb_version):
+        # Old clients report MariaDB version with "5.5.5-" prefix.
+        version = re.sub(r'^5\.5\.5-', '', self._get_server_info())
+        numbers = [int(x) for x in re.findall(r'\d+', version)[:3]]
+        if 'mariadb' in version.lower():
+            return numbers >= mariadb_version
+        return numbers >= mysql_version
+
+    def _server_supports_instant_ddl(self):
+        return self._server_version_at_least([8, 0, 12], [10, 3])
+
+    # Before MySQL 8.0.29 (MariaDB 10.4) columns can be added instantly only as the last column and can't be
+    # dropped instantly.
+    def _server_supports_instant_column_position(self):
+        return self._server_version_at_least([8, 0, 29], [10, 4])
+
+    # Returns the cheapest (algorithm, lock) that can be used for given change of the table.
+    def _classify_change(self, plan, change):
+
+        if change['op'] == 'add_column':
+            # Adding AUTO_INCREMENT column doesn't allow concurrent writes.
+            if 'AUTO_INCREMENT' in change['new_definition']:
+                return 'INPLACE', 'SHARED'
+            if change.get('position') is None and self._server_supports_instant_ddl() or \
+                self._server_supports_instant_column_position():
+                return 'INSTANT', None
+            return 'INPLACE', 'NONE'
+
+        if change['op'] == 'drop_column':
+            if self._server_supports_instant_column_position():
+                return 'INSTANT', None
+            return 'INPLACE', 'NONE'
+
+        if change['op'] in ('add_index', 'drop_index', 'add_primary_key'):
+            return 'INPLACE', 'NONE'
+
+        if change['op'] == 'rename_index':
+            return 'INSTANT', None
 
-        fields = [x.strip() if not x.strip().endswith(',') else x.strip()[:-1].strip() for x in schema.splitlines()]
+        if change['op'] == 'rename_column':
+            # Renaming column is instant since MySQL 8.0.28, before that in-place without rebuild.
+            if self._server_version_at_least([8, 0, 28], [10, 3]):
+                return 'INSTANT', None
+            return 'INPLACE', 'NONE'
 
-        sql_fields = []
-        sql_indexes = []
-        for field in fields:
-            if len(field) == 0:
+        if change['op'] == 'drop_primary_key':
+            # Dropping primary key without adding a new one requires table copy.
+            if plan.GetChanges('add_primary_key'):
+                return 'INPLACE', 'NONE'
+            return 'COPY', 'SHARED'
+
+        if change['is_reorder_only']:
+            return 'INPLACE', 'NONE'
+
+        old_type, old_arguments, old_unsigned, old_notnull, old_default = \
+            self._split_column_definition(change['old_definition'])
+        new_type, new_arguments, new_unsigned, new_notnull, new_default = \
+            self._split_column_definition(change['new_definition'])
+
+        if old_type != new_type or old_unsigned != new_unsigned:
+            return 'COPY', 'SHARED'
+
+        algorithm = 'INSTANT'
+        if old_arguments != new_arguments:
+            if new_type == 'ENUM':
+                # Appending values at the end of ENUM is metadata-only change, unless storage size grows.
+                old_values = re.findall(r"'((?:[^']|'')*)'", old_arguments or '')
+                new_values = re.findall(r"'((?:[^']|'')*)'", new_arguments or '')
+                if new_values[:len(old_values)] != old_values or (len(old_values) <= 255 < len(new_values)):
+                    return 'COPY', 'SHARED'
+            elif new_type == 'VARCHAR' and old_arguments.isdigit() and new_arguments.isdigit():
+                # Widening VARCHAR is in-place as long as the length prefix stays 1 byte (up to 255 bytes)
+                # or 2 bytes, assuming utf8mb4 with up to 4 bytes per character.
+                old_size, new_size = int(old_arguments) * 4, int(new_arguments) * 4
+                if new_size < old_size or (old_size <= 255 < new_size):
+                    return 'COPY', 'SHARED'
+                algorithm = 'INPLACE'
+            else:
+                return 'COPY', 'SHARED'
+
+        # Making column NULL/NOT NULL or moving it rebuilds the table in-place.
+        if old_notnull != new_notnull or change['is_moved']:
+            algorithm = 'INPLACE'
+
+        return (algorithm, None if algorithm == 'INSTANT' else 'NONE')
+
+    # Returns list of (algorithm, lock) to try for the plan, according to online DDL policy.
+    def _get_online_ddl_candidates(self, plan):
+
+        cheapest = 0
+        for change in plan.changes:
+            if change.get('partition'):
                 continue
-            matches = re.match(field_pattern, field)
-            if not matches:
-                matches = re.match(index_pattern, field)
-                if not matches:
-                    raise ValueError('Invalid field specifier: ' + field)
-
-                index_type = matches.group(2)
-                index_fields = matches.group(3)
-                if index_type not in (None, 'PRIMARY', 'UNIQUE'):
-                    raise ValueError('Invalid index type: ' + field)
-
-                sql_indexes.append({'type': index_type, 'columns': ['`{}`'.format(x.strip()) for x in index_fields.split(',')] })
+            cheapest = max(cheapest, ONLINE_DDL_ALGORITHMS.index(self._classify_change(plan, change)))
+        if cheapest == 0 and not self._server_supports_instant_ddl():
+            cheapest = 1
+
+        if self._online_ddl == "strict":
+            return [ONLINE_DDL_ALGORITHMS[cheapest]]
+        elif self._online_ddl == "nolock":
+            return [x for x in ONLINE_DDL_ALGORITHMS[cheapest:] if x[1] in (None, 'NONE')]
+        return ONLINE_DDL_ALGORITHMS[cheapest:] + [(None, None)]
+
+    # Returns list of (sql, algorithm, lock) - variants of the statement to try in order in online DDL mode.
+    # Partitioning statements are executed as they are (with server's default algorithm), repartitioning that
+    # copies rows is refused by "nolock" and "strict" policies.
+    def GetOnlineDDLAttempts(self, plan, sql):
+
+        for change in plan.changes:
+            if change.get('partition') and sql == 'ALTER TABLE {0} {1}'.format(plan.table_name, change['sql']):
+                if self._online_ddl != "fallback" and self._get_change_impact(plan, change) == 'rewrite':
+                    return []
+                return [(sql, None, None)]
+
+        attempts = []
+        for algorithm, lock in self._get_online_ddl_candidates(plan):
+            online_sql = sql
+            if algorithm is not None:
+                online_sql += ', ALGORITHM={0}'.format(algorithm)
+            if lock is not None:
+                online_sql += ', LOCK={0}'.format(lock)
+            attempts.append((online_sql, algorithm, lock))
+        return attempts
+
+    # Whether the error means that the server refused requested ALGORITHM/LOCK and next attempt should be tried.
+    def IsOnlineDDLRefused(self, e):
+        return isinstance(e, pymysql.err.MySQLError) and \
+               e.args[0] in (ER_ALTER_OPERATION_NOT_SUPPORTED, ER_ALTER_OPERATION_NOT_SUPPORTED_REASON)
+
+    def ReportOnlineDDL(self, plan, sql, algorithm, lock):
+        self.online_ddl_report.append({
+            'table': plan.table_name,
+            'sql': sql,
+            'algorithm': algorithm or 'DEFAULT',
+            'lock': lock or 'DEFAULT',
+        })
+
+    # Returns exception to raise when all attempts failed (error - the last refusal, None if nothing was tried).
+    def GetOnlineDDLError(self, plan, error):
+        if error is None:
+            return ValueError('Changes of table {0} require ALTER TABLE that blocks writes, '
+                              'which is not allowed by online_ddl policy "{1}"'.format(plan.table_name, self._online_ddl))
+        return error
+
+    def _execute_online_ddl(self, cursor, plan, sql):
+
+        error = None
+        for online_sql, algorithm, lock in self.GetOnlineDDLAttempts(plan, sql):
+            try:
+                self._execute_ddl(cursor, plan.table_name, online_sql)
+            except pymysql.err.MySQLError as e:
+                if not self.IsOnlineDDLRefused(e):
+                    raise
+                error = e
                 continue
 
-            name = matches.group(1)
-            type = matches.group(2)
-            type_arguments = matches.group(4)
-            is_unsigned = matches.group(5) is not None
-            is_autoincrement = matches.group(6) is not None
-            is_notnull = matches.group(7) is not None
-            default_value = matches.group(9)
-
-            if type not in column_types:
-                raise ValueError('Invalid type specifier: ' + field)
-            if type in ['C', 'CHAR'] and not type_arguments:
-                raise ValueError('Char type requires size: ' + field)
-            if type == 'ENUM' and not type_arguments:
-                raise ValueError('Enum type requires list of possible values: ' + field)
-            if type == 'BIN' and not type_arguments:
-                raise ValueError('Binary type requires size: ' + field)
-            if type not in ['C', 'CHAR', 'ENUM', 'BIN'] and type_arguments:
-                raise ValueError('Only char or enum type can have arguments: ' + field)
-
-            column_definition = column_types[type]
-            if type in ['C', 'CHAR', 'ENUM', 'BIN']:
-                if type == 'ENUM':
-                    # Strip whitespace between enum values for canonical form.
-                    type_arguments = ','.join("'{}'".format(x) for x in re.findall(r"'([^']*?)'", type_arguments))
-                column_definition += '({0})'.format(type_arguments)
-            if is_unsigned:
-                column_definition += ' UNSIGNED'
-            if is_autoincrement:
-                column_definition += ' AUTO_INCREMENT'
-            if is_notnull:
-                column_definition += ' NOT NULL'
-            if default_value is not None:
-                column_definition += ' DEFAULT '
-                column_definition += self._conn.escape(str(default_value))
-
-            sql_fields.append({'name': name, 'column_definition': column_definition})
-
-        if not self._update_table_columns(table_name, sql_fields):
-            return False
-        if not self._update_table_indexes(table_name, sql_indexes):
+            self.ReportOnlineDDL(plan, online_sql, algorithm, lock)
+            return
+
+        raise self.GetOnlineDDLError(plan, error)
+
+    #-----------------------------------------------------------------------------------------------------------
+
+    def _is_shadow_table(self, table_name):
+
+        if self._shadow_tables is None:
             return False
-        # AUTO_INCREMENT can be set only after primary index is created.
-        if any('AUTO_INCREMENT' in f['column_definition'] for f in sql_fields):
-            if not self._update_table_columns(table_name, sql_fields):
-                return False
+        if isinstance(self._shadow_tables, int):
+            return self._conn is not None and self._get_table_rows(table_name) >= self._shadow_tables
+        return table_name in self._shadow_tables
+
+    # Existing table from shadow_tables, which ALTER TABLE would rebuild, is migrated through shadow table instead
+    # (like gh-ost or pt-online-schema-change): new table is created from the DDL, rows are copied in batches
+    # by primary key while triggers apply concurrent writes, then the tables are swapped by atomic RENAME TABLE.
+    def _plan_shadow_table(self, plan, table_columns, table_indexes, table_def, renamed_columns):
+
+        if plan.is_new_table or not self._is_shadow_table(plan.table_name):
+            return
+        if all(self._get_change_impact(plan, change) == 'metadata' for change in plan.changes):
+            return
+
+        key_column = GetUnchangedPrimaryKey(table_indexes, table_def, renamed_columns)
+        if key_column is None:
+            raise ValueError('Table {0} needs unchanged single column primary key to be migrated through '
+                             'shadow table'.format(plan.table_name))
+
+        shadow_plan = TablePlan('_{0}_new'.format(plan.table_name), is_new_table=True)
+        self._plan_table_columns(shadow_plan, {}, table_def, {})
+        self._plan_table_indexes(shadow_plan, {}, table_def, {})
+        self._plan_table_partitioning(shadow_plan, None, table_def)
+        plan.shadow = {
+            'table_name': shadow_plan.table_name,
+            'old_table_name': '_{0}_old'.format(plan.table_name),
+            'key_column': key_column,
+            'columns': GetExistingColumns(table_columns, table_def, renamed_columns),
+            'plan': shadow_plan,
+        }
+
+    # Returns {'prepare', 'copy', 'swap'} statements of migration through shadow table. Copy statement copies
+    # batch of rows between two keys (its parameters), statements of the other steps are executed in order.
+    def GetShadowStatements(self, plan):
+
+        table_name = plan.table_name
+        shadow_table_name = plan.shadow['table_name']
+        old_table_name = plan.shadow['old_table_name']
+        key_name, new_key_name = plan.shadow['key_column']
+        triggers = ['_{0}_{1}'.format(table_name, x) for x in ('ins', 'upd', 'del')]
+
+        new_columns = ', '.join('`{0}`'.format(new_name) for new_name, name in plan.shadow['columns'])
+        columns = ', '.join('`{0}`'.format(name) for new_name, name in plan.shadow['columns'])
+        values = ', '.join('NEW.`{0}`'.format(name) for new_name, name in plan.shadow['columns'])
+        replace_sql = 'REPLACE INTO `{0}` ({1}) VALUES ({2})'.format(shadow_table_name, new_columns, values)
+        delete_sql = 'DELETE FROM `{0}` WHERE `{1}` = OLD.`{2}`'.format(shadow_table_name, new_key_name, key_name)
+
+        # Leftovers of interrupted migration are dropped, the copy starts again.
+        prepare = ['DROP TRIGGER IF EXISTS `{0}`'.format(trigger) for trigger in triggers]
+        prepare.append('DROP TABLE IF EXISTS `{0}`, `{1}`'.format(shadow_table_name, old_table_name))
+        prepare += self.RenderTablePlan(plan.shadow['plan'])
+        prepare += [
+            'CREATE TRIGGER `{0}` AFTER INSERT ON `{1}` FOR EACH ROW {2}'.format(triggers[0], table_name, replace_sql),
+            'CREATE TRIGGER `{0}` AFTER UPDATE ON `{1}` FOR EACH ROW BEGIN {2}; {3}; END'.format(
+                triggers[1], table_name, delete_sql, replace_sql),
+            'CREATE TRIGGER `{0}` AFTER DELETE ON `{1}` FOR EACH ROW {2}'.format(triggers[2], table_name, delete_sql),
+        ]
+
+        # Rows already written by triggers are newer than the copied ones. Copied rows are locked until commit,
+        # so that their concurrent update waits for the copy and its trigger then overwrites them.
+        copy = 'INSERT IGNORE INTO `{0}` ({1}) SELECT {2} FROM `{3}` WHERE `{4}` BETWEEN %s AND %s ' \
+               'LOCK IN SHARE MODE'.format(shadow_table_name, new_columns, columns, table_name, key_name)
+
+        # Triggers are renamed with the table and dropped with it.
+        swap = [
+            'RENAME TABLE `{0}` TO `{1}`, `{2}` TO `{0}`'.format(table_name, old_table_name, shadow_table_name),
+            'DROP TABLE `{0}`'.format(old_table_name),
+        ]
+
+        return {'prepare': prepare, 'copy': copy, 'swap': swap}
+
+    # Triggers of the table would be dropped with the replaced table.
+    def _check_table_triggers(self, cursor, plan):
+
+        sql = """
+            SELECT TRIGGER_NAME
+              FROM information_schema.TRIGGERS
+             WHERE EVENT_OBJECT_SCHEMA = DATABASE()
+               AND EVENT_OBJECT_TABLE = %s
+        """
+        cursor.execute(sql, (plan.table_name,))
+        shadow_triggers = ['_{0}_{1}'.format(plan.table_name, x) for x in ('ins', 'upd', 'del')]
+        triggers = [row[0] for row in cursor.fetchall() if row[0] not in shadow_triggers]
+        if triggers:
+            raise ValueError('Table {0} has triggers ({1}), it can\'t be migrated through shadow table'.format(
+                plan.table_name, ', '.join(triggers)))
+
+    def _update_table_with_shadow(self, cursor, plan):
+
+        self._check_table_triggers(cursor, plan)
+        statements = self.GetShadowStatements(plan)
+        for sql in statements['prepare']:
+            self._execute_ddl(cursor, plan.table_name, sql)
+
+        self._shadow_copy(self._conn, 'shadow:' + plan.table_name, '`{0}`'.format(plan.table_name),
+                          '`{0}`'.format(plan.shadow['key_column'][0]),
+                          lambda cursor, rows: cursor.execute(statements['copy'], (rows[0][0], rows[-1][0])))
+
+        for sql in statements['swap']:
+            self._execute_ddl(cursor, plan.table_name, sql)
+
+    #-----------------------------------------------------------------------------------------------------------
+
+    # Waits up to timeout seconds (0 - just try) for advisory lock of the database migration, returns True if acquired.
+    # The lock belongs to the connection, it's not released by commit/rollback.
+    def AcquireMigrationLock(self, timeout):
+        with self._conn.cursor() as cursor:
+            cursor.execute("SELECT GET_LOCK({0}, %s)".format(MIGRATION_LOCK_NAME), (int(math.ceil(timeout)),))
+            return cursor.fetchone()[0] == 1
+
+    def ReleaseMigrationLock(self):
+        with self._conn.cursor() as cursor:
+            cursor.execute("SELECT RELEASE_LOCK({0})".format(MIGRATION_LOCK_NAME))
+
+    #-----------------------------------------------------------------------------------------------------------
+
+    # Returns {table_name: {'rows', 'data_size', 'index_size'}} of existing tables with one query.
+    # Row counts are InnoDB estimates.
+    def GetTableStats(self, table_names):
+
+        table_stats = {}
+        requested_tables = dict((table_name.lower(), table_name) for table_name in table_names)
+        if not requested_tables:
+            return table_stats
+
+        with self._conn.cursor() as cursor:
+            sql = """
+                SELECT TABLE_NAME, TABLE_ROWS, DATA_LENGTH, INDEX_LENGTH
+                  FROM information_schema.TABLES
+                 WHERE TABLE_SCHEMA = DATABASE()
+                   AND TABLE_NAME IN %s
+            """
+            cursor.execute(sql, (tuple(requested_tables.values()),))
+            for row in cursor.fetchall():
+                table_name = requested_tables.get(row[0].lower())
+                if table_name is not None:
+                    table_stats[table_name] = {
+                        'rows': int(row[1] or 0),
+                        'data_size': int(row[2] or 0),
+                        'index_size': int(row[3] or 0),
+                    }
+
+        return table_stats
+
+    # Returns 'metadata', 'index' or 'rewrite' impact of the change on the existing table.
+    def _get_change_impact(self, plan, change):
+
+        if plan.is_new_table or change['op'] in ('drop_index', 'rename_index', 'rename_column'):
+            return 'metadata'
+        if change['op'] == 'add_index':
+            return 'index'
+        # Adding/dropping RANGE or LIST partition doesn't touch rows of other partitions, other changes
+        # of partitioning copy the rows.
+        if change['op'] in ('add_partition', 'drop_partition'):
+            return 'metadata'
+        if change.get('partition'):
+            return 'rewrite'
+
+        # Classification depends on server version, e.g. column added in the middle of the table or dropped
+        # column rebuilds the table before MySQL 8.0.29.
+        algorithm, lock = self._classify_change(plan, change)
+        if algorithm == 'INSTANT':
+            return 'metadata'
+        if change['op'] == 'change_column' and algorithm == 'INPLACE' and not change['is_moved']:
+            # Widening of VARCHAR is done in-place without rebuild, changing NULL/NOT NULL rebuilds the table.
+            if self._split_column_definition(change['old_definition'])[3] == \
+                self._split_column_definition(change['new_definition'])[3]:
+                return 'metadata'
+        return 'rewrite'
+
+    # Returns statements that UpdateTableSchema() would execute for the plan.
+    def GetPlanStatements(self, plan):
+
+        if plan.shadow is not None:
+            statements = self.GetShadowStatements(plan)
+            return statements['prepare'] + [statements['copy']] + statements['swap']
+
+        statements = self._render_table_statements(plan)
+        candidates = []
+        if self._online_ddl is not None and not plan.is_new_table and statements:
+            candidates = self._get_online_ddl_candidates(plan)
+        if candidates:
+            algorithm, lock = candidates[0]
+            if algorithm is not None:
+                statements[-1] += ', ALGORITHM={0}'.format(algorithm)
+            if lock is not None:
+                statements[-1] += ', LOCK={0}'.format(lock)
+        return statements + self.GetPartitionStatements(plan)
+
+    # Fills table stats, impact of changes, statements and estimated duration of the plans.
+    def AnnotateTablePlans(self, plans, throughput=None):
+
+        table_stats = self.GetTableStats([plan.table_name for plan in plans if not plan.is_new_table])
+        for plan in plans:
+            plan.stats = table_stats.get(plan.table_name, {'rows': 0, 'data_size': 0, 'index_size': 0})
+            for change in plan.changes:
+                change['impact'] = self._get_change_impact(plan, change)
+            plan.statements = self.GetPlanStatements(plan)
+            plan.EstimateDuration(throughput)
+
+        return plans
+
+    #-----------------------------------------------------------------------------------------------------------
+
+    def _render_column_definition(self, column):
+
+        column_definition = COLUMN_TYPES[column.type]
+        if column.type in ['C', 'ENUM', 'BIN']:
+            column_definition += '({0})'.format(column.type_arguments)
+        if column.is_unsigned:
+            column_definition += ' UNSIGNED'
+        if column.is_autoincrement:
+            column_definition += ' AUTO_INCREMENT'
+        if column.is_notnull:
+            column_definition += ' NOT NULL'
+        if column.default_value is not None:
+            column_definition += ' DEFAULT '
+            column_definition += self._escape(str(column.default_value))
+
+        return column_definition
+
+    # Returns TablePlan with all changes needed to bring the table up to date, without executing them.
+    def PlanTableSchema(self, table_name, schema):
+
+        table_def = ParseTableSchema(schema)
+
+        table_columns = self._get_table_columns(table_name)
+        plan = TablePlan(table_name, is_new_table=(len(table_columns) == 0))
+        renamed_columns = GetRenamedColumns(table_columns, table_def)
+        table_indexes = {} if plan.is_new_table else self._get_table_indexes(table_name)
+        table_partitioning = None if plan.is_new_table else self._get_table_partitioning(table_name)
+        self._plan_table_columns(plan, table_columns, table_def, renamed_columns)
+        self._plan_table_indexes(plan, table_indexes, table_def, renamed_columns)
+        self._plan_table_partitioning(plan, table_partitioning, table_def)
+        self._plan_shadow_table(plan, table_columns, table_indexes, table_def, renamed_columns)
+
+        return plan
+
+    def UpdateTableSchema(self, table_name, schema):
+
+        plan = self.PlanTableSchema(table_name, schema)
+
+        with self._conn.cursor() as cursor:
+            if plan.shadow is not None:
+                self._update_table_with_shadow(cursor, plan)
+                return True
+
+            for sql in self.RenderTablePlan(plan):
+                if self._online_ddl is not None and not plan.is_new_table:
+                    self._execute_online_ddl(cursor, plan, sql)
+                else:
+                    self._execute_ddl(cursor, table_name, sql)
 
         return True
@@ -1,23 +1,322 @@
+import contextlib
 import re
+import time
 import psycopg
 
+from sql_schema_builder.CatalogSnapshot import CatalogSnapshot
+from sql_schema_builder.DDLParser import DiffListPartitions, GetExistingColumns, GetExpiredRangePartitions, \
+                                         GetMissingRangePartitions, GetRenamedColumns, GetUnchangedPrimaryKey, \
+                                         IndexDef, MatchIndexes, ParseListValues, ParseTableSchema, TableDef
+from sql_schema_builder.MigrationEvents import EventDispatcher
+from sql_schema_builder.TablePlan import TablePlan
+
+
+# PostgreSQL types of canonical DDL column types.
+COLUMN_TYPES = {
+    'I': 'INTEGER',
+    'I1': 'SMALLINT',
+    'I2': 'SMALLINT',
+    'I8': 'BIGINT',
+    'F': 'DOUBLE PRECISION',
+    'N': 'DECIMAL(10,2)',
+
+    'C': 'CHARACTER VARYING',
+    'MX': 'TEXT',
+    'X': 'TEXT',
+    'MB': 'BYTEA',
+    'B': 'BYTEA',
+    'J': 'JSON',
+    'BIN': 'BYTEA',
+
+    'D': 'DATE',
+    'T': 'TIME',
+
+    'ENUM': 'ENUM',
+
+    'BOOL': 'BOOLEAN',
+}
+
+# Synonyms of types (as reported by information_schema or written in DDL), mapped to canonical names.
+TYPE_ALIASES = {
+    'INT': 'INTEGER',
+    'INT4': 'INTEGER',
+    'INT2': 'SMALLINT',
+    'INT8': 'BIGINT',
+    'FLOAT8': 'DOUBLE PRECISION',
+    'DECIMAL': 'NUMERIC',
+    'VARCHAR': 'CHARACTER VARYING',
+    'BOOL': 'BOOLEAN',
+    'TIME WITHOUT TIME ZONE': 'TIME',
+    'TIMESTAMP WITHOUT TIME ZONE': 'TIMESTAMP',
+}
+
+# Keys of session-level advisory lock serializing migrations of the database.
+MIGRATION_LOCK_KEYS = "hashtext('sql_schema_builder'), hashtext(current_database())"
+
+# Seconds between attempts to get the migration lock (pg_advisory_lock() itself can't time out).
+MIGRATION_LOCK_POLL_INTERVAL = 0.5
+
+COLUMN_TYPE_PATTERN = re.compile(r'^(.*?)(\((.*)\))?$', re.S)
+
+# Partitioned tables with their partitions (one row with NULL partition for tables without partitions yet).
+PARTITIONS_SQL = """
+    SELECT t.relname, pt.partstrat, a.attname, p.relname, pg_get_expr(p.relpartbound, p.oid)
+      FROM pg_partitioned_table pt
+      JOIN pg_class t ON t.oid = pt.partrelid
+      LEFT JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = pt.partattrs[0]
+      LEFT JOIN pg_inherits i ON i.inhparent = t.oid
+      LEFT JOIN pg_class p ON p.oid = i.inhrelid
+     WHERE t.relname = ANY(%s)
+     ORDER BY t.relname, p.relname
+"""
+
+# Partitioning strategies of pg_partitioned_table.
+PARTITION_METHODS = {
+    'r': 'RANGE',
+    'l': 'LIST',
+    'h': 'HASH',
+}
+
+RANGE_BOUND_PATTERN = re.compile(r'^FOR VALUES FROM \((.*)\) TO \((.*)\)$', re.S)
+LIST_BOUND_PATTERN = re.compile(r'^FOR VALUES IN \((.*)\)$', re.S)
+
+# Columns of indexes: key columns and covering (INCLUDE) columns in order of pg_index.indkey, sort options of key
+# columns, access method and predicate of partial index. Indexes on expressions can't be declared, so they are not
+# read at all (and never dropped).
+INDEXES_SQL = """
+    SELECT
+        t.relname as table_name,
+        i.relname as index_name,
+        ix.indisprimary as is_pk,
+        ix.indisunique as is_unique,
+        (SELECT array_to_string(array_agg(a.attname ORDER BY k.n), ', ')
+           FROM unnest(ix.indkey::int2[]) WITH ORDINALITY AS k(attnum, n)
+           JOIN pg_attribute a ON a.attrelid = ix.indrelid AND a.attnum = k.attnum
+          WHERE k.n <= ix.indnkeyatts) as column_names,
+        ix.indisvalid as is_valid,
+        (SELECT array_to_string(array_agg(a.attname ORDER BY k.n), ', ')
+           FROM unnest(ix.indkey::int2[]) WITH ORDINALITY AS k(attnum, n)
+           JOIN pg_attribute a ON a.attrelid = ix.indrelid AND a.attnum = k.attnum
+          WHERE k.n > ix.indnkeyatts) as include_names,
+        ix.indoption::text as options,
+        am.amname as method,
+        pg_get_expr(ix.indpred, ix.indrelid) as predicate
+     FROM
+        pg_class t,
+        pg_class i,
+        pg_index ix,
+        pg_am am
+    WHERE
+        t.oid = ix.indrelid
+        and i.oid = ix.indexrelid
+        and am.oid = i.relam
+        and 0 <> ALL (ix.indkey::int2[])
+        and t.relkind IN ('r', 'p')
+        and t.relname = ANY(%s)
+    ORDER BY
+        table_name, index_name
+"""
+
+# Type casts added by the server to expressions of index predicates.
+PREDICATE_CAST_PATTERN = re.compile(r'::\s*(character varying|double precision|timestamp with(out)? time zone|'
+                                    r'time with(out)? time zone|"?\w+"?)(\(\d+(,\s*\d+)?\))?(\[\])?')
+PREDICATE_LITERAL_PATTERN = re.compile(r"('(?:[^']|'')*')")
+
 
 class PgSQLSchema():
 
-    def __init__(self, conn):
+    def __init__(self, conn, catalog=None, concurrent_indexes=False, events=None, ddl_retry=None,
+                 shadow_tables=None, shadow_copy=None, progress=None):
         self._conn = conn
+        self._catalog = catalog
+        # Secondary indexes of existing tables are left for UpdateIndexesConcurrently().
+        self._concurrent_indexes = concurrent_indexes
+        # EventDispatcher notified about introspection queries and executed DDL statements.
+        self._events = events or EventDispatcher()
+        # DDLRetryPolicy limiting lock waits of DDL statements (None - server defaults, no retries).
+        self._ddl_retry = ddl_retry
+        # Session values of lock_timeout and statement_timeout restored after each DDL statement.
+        self._session_timeouts = None
+        # Canonical forms of column definitions by definition, see _normalize_column_definition().
+        self._normalized_definitions = {}
+        # Tables that are migrated by copying rows to a shadow table with the new definition, which then replaces
+        # the table: collection of table names or number - tables with at least that many rows (None - no tables).
+        self._shadow_tables = shadow_tables
+        # Callable (conn, name, table_name, key_column, process_batch) that runs process_batch(cursor, rows) for
+        # batches of keys of the table (Backfill.Run() with throttling options), required with shadow_tables.
+        self._shadow_copy = shadow_copy
+        # DDLProgressMonitor polling progress of executed DDL statements (None - no progress reporting).
+        self._progress = progress
+        # Estimated row counts of tables, loaded when needed by the shadow_tables threshold.
+        self._table_rows = {}
 
     #-----------------------------------------------------------------------------------------------------------
 
+    def _check_offline_table(self, table_name):
+        if self._conn is None:
+            raise ValueError('Table {0} is not in the catalog snapshot'.format(table_name))
+
+    # Returns checksum of columns and indexes of the tables computed by the server with one query,
+    # so that saved CatalogSnapshot can be verified without reading the whole catalog.
+    def GetCatalogChecksum(self, table_names):
+
+        table_names = list(dict.fromkeys(table_names))
+        if not table_names:
+            return ''
+
+        with self._conn.cursor() as cursor:
+            sql = """
+                SELECT
+                    (SELECT md5(coalesce(string_agg(concat_ws('|', table_name, column_name, ordinal_position, data_type,
+                                                             character_maximum_length, numeric_precision, numeric_scale,
+                                                             column_default, is_nullable, identity_generation), ','
+                                                   ORDER BY table_name, ordinal_position), ''))
+                       FROM INFORMATION_SCHEMA.COLUMNS
+                      WHERE table_name = ANY(%s)),
+                    (SELECT md5(coalesce(string_agg(concat_ws('|', t.relname, i.relname, ix.indisprimary, ix.indisunique,
+                                                             ix.indkey::text, ix.indisvalid, ix.indnkeyatts,
+                                                             ix.indoption::text, i.relam,
+                                                             pg_get_expr(ix.indpred, ix.indrelid)), ','
+                                                   ORDER BY t.relname, i.relname), ''))
+                       FROM pg_class t, pg_class i, pg_index ix
+                      WHERE t.oid = ix.indrelid
+                        and i.oid = ix.indexrelid
+                        and t.relkind IN ('r', 'p')
+                        and t.relname = ANY(%s)),
+                    (SELECT md5(coalesce(string_agg(concat_ws('|', t.relname, pt.partstrat, pt.partattrs::text,
+                                                             p.relname, pg_get_expr(p.relpartbound, p.oid)), ','
+                                                   ORDER BY t.relname, p.relname), ''))
+                       FROM pg_partitioned_table pt
+                       JOIN pg_class t ON t.oid = pt.partrelid
+                       LEFT JOIN pg_inherits i ON i.inhparent = t.oid
+                       LEFT JOIN pg_class p ON p.oid = i.inhrelid
+                      WHERE t.relname = ANY(%s))
+            """
+            cursor.execute(sql, (table_names, table_names, table_names))
+            row = cursor.fetchone()
+
+        return '{0}/{1}/{2}'.format(row[0], row[1], row[2])
+
+    # Returns [(sql, params)] of catalog queries for LoadCatalogSnapshot(), so that they can be also executed
+    # on asynchronous connection.
+    def GetCatalogQueries(self, table_names):
+
+        table_names = list(dict.fromkeys(table_names))
+        if not table_names:
+            return []
+
+        columns_sql = """
+            SELECT table_name, column_name,
+                   data_type, character_maximum_length,
+                   column_default,
+                   is_nullable, identity_generation,
+                   numeric_precision, numeric_scale
+              FROM INFORMATION_SCHEMA.COLUMNS
+             WHERE table_name = ANY(%s)
+             ORDER BY table_name, ordinal_position
+        """
+        return [(columns_sql, (table_names,)), (INDEXES_SQL, (table_names,)), (PARTITIONS_SQL, (table_names,))]
+
+    # Builds CatalogSnapshot from rows returned by queries of GetCatalogQueries().
+    def BuildCatalogSnapshot(self, table_names, results):
+
+        catalog = CatalogSnapshot(db_type="pgsql")
+        for table_name in table_names:
+            catalog.AddTable(table_name)
+        if not catalog.GetTableNames():
+            self._catalog = catalog
+            return catalog
+
+        column_rows, index_rows, partition_rows = results
+        for row in column_rows:
+            catalog.GetTableColumns(row[0])[row[1]] = {
+                'column_definition': self._column_definition_from_catalog(*row[2:]),
+                'is_in_primary_key': False,
+            }
+
+        for row in index_rows:
+            table_name = row[0]
+            table_columns = catalog.GetTableColumns(table_name)
+            catalog.GetTableIndexes(table_name)[row[1]] = self._index_from_catalog(*row[2:])
+            if row[2]:
+                for column_name in row[4].split(", "):
+                    if column_name in table_columns:
+                        table_columns[column_name]['is_in_primary_key'] = True
+
+        table_partition_rows = {}
+        for row in partition_rows:
+            table_partition_rows.setdefault(row[0], []).append(row)
+        for table_name, rows in table_partition_rows.items():
+            if catalog.HasTable(table_name):
+                catalog.SetTablePartitioning(table_name, self._partitioning_from_catalog(rows))
+
+        self._catalog = catalog
+        return catalog
+
+    # Uses already loaded (e.g. saved) snapshot instead of reading the catalog. With conn=None the snapshot
+    # has to contain all tables, changes can be planned but not executed.
+    def SetCatalogSnapshot(self, catalog):
+        self._catalog = catalog
+
+    # Loads columns and indexes of all given tables with fixed number of queries, instead of 3 queries per table.
+    def LoadCatalogSnapshot(self, table_names):
+
+        table_names = list(table_names)
+        results = []
+        with self._events.Timed('introspection') as event, self._conn.cursor() as cursor:
+            for sql, params in self.GetCatalogQueries(table_names):
+                cursor.execute(sql, params)
+                results.append(cursor.fetchall())
+            event['rowcount'] = sum(len(rows) for rows in results)
+
+        return self.BuildCatalogSnapshot(table_names, results)
+
+    #-----------------------------------------------------------------------------------------------------------
+
+    def _column_definition_from_catalog(self, data_type, character_maximum_length, column_default,
+                                        is_nullable, identity_generation, numeric_precision=None, numeric_scale=None):
+
+        type = data_type
+        if character_maximum_length:
+            type = f"{type}({character_maximum_length})"
+        elif data_type == 'numeric' and numeric_precision is not None:
+            type = f"{type}({numeric_precision},{numeric_scale or 0})"
+        default_value = column_default.split("::", 1)[0].strip("'") if column_default else None
+        is_notnull = (is_nullable == 'NO')
+        # Identity columns and serial columns (sequence in default) are all auto increment columns.
+        is_autoincrement = identity_generation in ("ALWAYS", "BY DEFAULT")
+        if default_value is not None and default_value.startswith('nextval('):
+            is_autoincrement = True
+            default_value = None
+
+        if type.upper().startswith('ENUM('):
+            column_definition = type[:5].upper() + type[5:]
+        else:
+            column_definition = type.upper()
+        if is_autoincrement:
+            column_definition += ' AUTO_INCREMENT'
+        if is_notnull:
+            column_definition += ' NOT NULL'
+        if default_value is not None:
+            column_definition += ' DEFAULT '
+            column_definition += f"'{default_value}'"
+
+        return column_definition
+
     def _get_table_columns(self, table_name):
 
+        if self._catalog is not None and self._catalog.HasTable(table_name):
+            return self._catalog.GetTableColumns(table_name)
+        self._check_offline_table(table_name)
+
         table_columns = None
-        with self._conn.cursor() as cursor:
+        with self._events.Timed('introspection', table=table_name), self._conn.cursor() as cursor:
             sql = f"""
                 SELECT column_name,
                        data_type, character_maximum_length,
                        column_default,
-                       is_nullable, identity_generation
+                       is_nullable, identity_generation,
+                       numeric_precision, numeric_scale
                   FROM INFORMATION_SCHEMA.COLUMNS
                  WHERE table_name = '{table_name}'
             """
@@ -26,29 +325,8 @@ class PgSQLSchema():
                 result = cursor.fetchall()
                 table_columns = {}
                 for row in result:
-                    name = row[0]
-                    type = row[1]
-                    character_maximum_length = row[2]
-                    if character_maximum_length:
-                        type = f"{type}({character_maximum_length})"
-                    default_value = row[3].split("::", 1)[0].strip("'") if row[3] else None
-                    is_notnull = (row[4] == 'NO')
-                    is_autoincrement = (row[5] == "ALWAYS")
-
-                    if type.upper().startswith('ENUM('):
-                        column_definition = type[:5].upper() + type[5:]
-                    else:
-                        column_definition = type.upper()
-                    if is_autoincrement:
-                        column_definition += ' AUTO_INCREMENT'
-                    if is_notnull:
-                        column_definition += ' NOT NULL'
-                    if default_value is not None:
-                        column_definition += ' DEFAULT '
-                        column_definition += f"'{default_value}'"
-
-                    table_columns[name] = {
-                        'column_definition': column_definition,
+                    table_columns[row[0]] = {
+                        'column_definition': self._column_definition_from_catalog(*row[1:]),
                         'is_in_primary_key': False,
                     }
 
@@ -68,7 +346,7 @@ class PgSQLSchema():
                     and i.oid = ix.indexrelid
                     and a.attrelid = t.oid
                     and a.attnum = ANY(ix.indkey)
-                    and t.relkind = 'r'
+                    and t.relkind IN ('r', 'p')
                     and t.relname = '{table_name}'
                     and ix.indisprimary = true
             """
@@ -89,54 +367,64 @@ class PgSQLSchema():
 
     #-----------------------------------------------------------------------------------------------------------
 
+    def _index_from_catalog(self, is_primary, is_unique, column_names, is_valid, include_names=None, options=None,
+                            method=None, predicate=None):
+
+        type = None
+        if is_primary:
+            type = 'PRIMARY'
+        elif is_unique:
+            type = 'UNIQUE'
+
+        columns = column_names.split(", ")
+        # Bit 0 of pg_index.indoption is DESC.
+        descending = [int(x) & 1 == 1 for x in (options or '').split()][:len(columns)]
+
+        # Index left INVALID by interrupted CREATE INDEX CONCURRENTLY never matches DDL, so it gets rebuilt.
+        return IndexDef(type, columns, is_valid=bool(is_valid),
+                        descending=descending if any(descending) else None,
+                        include=include_names.split(", ") if include_names else [],
+                        where=self._normalize_index_predicate(predicate),
+                        method=method if method not in (None, 'btree') else None)
+
+    # Maps predicate of partial index to canonical form: the server returns it with added parentheses and type
+    # casts, in lower case and with IN lists as = ANY (ARRAY[...]). String literals are kept as they are.
+    def _normalize_index_predicate(self, predicate):
+
+        if predicate is None:
+            return None
+
+        parts = PREDICATE_LITERAL_PATTERN.split(predicate)
+        for i in range(0, len(parts), 2):
+            part = PREDICATE_CAST_PATTERN.sub('', parts[i].lower())
+            parts[i] = re.sub(r'[\s()"]+', '', part)
+        predicate = ''.join(parts)
+        predicate = re.sub(r'=anyarray\[(.*?)\]', r'in\1', predicate)
+        return re.sub(r'<>allarray\[(.*?)\]', r'notin\1', predicate)
+
+    # Returns declared index in the form it's introspected, for matching with existing indexes.
+    # Prefix lengths are ignored, whole values are indexed.
+    def _get_comparable_index(self, index):
+        return IndexDef(index.type, index.columns, name=index.name, renamed_from=index.renamed_from,
+                        descending=index.descending, include=index.include,
+                        where=self._normalize_index_predicate(index.where),
+                        method=index.method if index.method != 'btree' else None)
+
     def _get_table_indexes(self, table_name):
 
-        table_indexes = None
-        with self._conn.cursor() as cursor:
-            sql = f"""
-                SELECT
-                    i.relname as index_name,
-                    ix.indisprimary as is_pk,
-                    ix.indisunique as is_unique,
-                    array_to_string(array_agg(a.attname), ', ') as column_names
-                 FROM
-                    pg_class t,
-                    pg_class i,
-                    pg_index ix,
-                    pg_attribute a
-                WHERE
-                    t.oid = ix.indrelid
-                    and i.oid = ix.indexrelid
-                    and a.attrelid = t.oid
-                    and a.attnum = ANY(ix.indkey)
-                    and t.relkind = 'r'
-                    and t.relname = '{table_name}'
-                GROUP BY
-                    index_name, is_pk, is_unique
-                ORDER BY
-                    index_name
-            """
+        if self._catalog is not None and self._catalog.HasTable(table_name):
+            return self._catalog.GetTableIndexes(table_name)
+        self._check_offline_table(table_name)
 
+        table_indexes = None
+        with self._events.Timed('introspection', table=table_name), self._conn.cursor() as cursor:
             try:
-                cursor.execute(sql)
+                cursor.execute(INDEXES_SQL, ([table_name],))
                 result = cursor.fetchall()
 
                 table_indexes = {}
                 for row in result:
-                    index_name = row[0]
-                    is_primary = row[1]
-                    is_unique = row[2]
-
-                    type = None
-                    if is_primary:
-                        type = 'PRIMARY'
-                    elif is_unique:
-                        type = 'UNIQUE'
-
-                    table_indexes[index_name] = {
-                        'type': type,
-                        'columns': row[3].split(", ")
-                    }
+                    table_indexes[row[1]] = self._index_from_catalog(*row[2:])
 
             except:
                 table_indexes = {}
@@ -147,8 +435,77 @@ class PgSQLSchema():
 
     #-----------------------------------------------------------------------------------------------------------
 
+    def _parse_range_bound(self, value):
+        value = value.strip().strip("'")
+        return int(value) if re.match(r'^-?\d+$', value) else None
+
+    # Returns {'method', 'column', 'partitions'} (see DDLParser for shape of partitions) from rows
+    # of PARTITIONS_SQL of one table, or None if the table is not partitioned.
+    def _partitioning_from_catalog(self, rows):
+
+        if not rows:
+            return None
+
+        method = PARTITION_METHODS.get(rows[0][1], rows[0][1])
+        partitions = []
+        for row in rows:
+            if row[3] is None:
+                continue
+            partition = {'name': row[3], 'from': None, 'to': None, 'values': None, 'is_default': row[4] == 'DEFAULT'}
+            matches = RANGE_BOUND_PATTERN.match(row[4] or '')
+            if matches:
+                # MINVALUE/MAXVALUE bounds are None.
+                partition['from'] = self._parse_range_bound(matches.group(1))
+                partition['to'] = self._parse_range_bound(matches.group(2))
+            matches = LIST_BOUND_PATTERN.match(row[4] or '')
+            if matches:
+                partition['values'] = list(ParseListValues(matches.group(1)))
+            partitions.append(partition)
+
+        if method == 'RANGE':
+            partitions.sort(key=lambda partition: (partition['to'] is None, partition['to'] or 0))
+        return {'method': method, 'column': rows[0][2], 'partitions': partitions}
+
+    def _get_table_partitioning(self, table_name):
+
+        if self._catalog is not None and self._catalog.HasTable(table_name):
+            return self._catalog.GetTablePartitioning(table_name)
+        self._check_offline_table(table_name)
+
+        with self._events.Timed('introspection', table=table_name), self._conn.cursor() as cursor:
+            cursor.execute(PARTITIONS_SQL, ([table_name],))
+            return self._partitioning_from_catalog(cursor.fetchall())
+
+    #-----------------------------------------------------------------------------------------------------------
+
+    # Maps declared or introspected column definition to canonical form, so that definitions differing only in
+    # spelling (DECIMAL/NUMERIC, TIME/TIME WITHOUT TIME ZONE, ...) are equal.
+    def _normalize_column_definition(self, column_definition):
+
+        normalized = self._normalized_definitions.get(column_definition)
+        if normalized is not None:
+            return normalized
+
+        column_type, is_autoincrement, is_notnull, default_value = self._split_column_definition(column_definition)
+        # PostgreSQL has no unsigned types.
+        column_type = column_type.replace(' UNSIGNED', '')
+        matches = COLUMN_TYPE_PATTERN.match(column_type)
+        normalized = TYPE_ALIASES.get(matches.group(1), matches.group(1))
+        if matches.group(2) is not None:
+            normalized += '({0})'.format(matches.group(3).replace(' ', ''))
+        if is_autoincrement:
+            normalized += ' AUTO_INCREMENT'
+        if is_notnull:
+            normalized += ' NOT NULL'
+        if default_value is not None:
+            normalized += ' DEFAULT ' + default_value
+
+        self._normalized_definitions[column_definition] = normalized
+        return normalized
+
     def _column_definition_matches(self, sql_field_definition, table_column_definition, is_in_primary_key):
-        current_column_definition = table_column_definition
+        sql_field_definition = self._normalize_column_definition(sql_field_definition)
+        current_column_definition = self._normalize_column_definition(table_column_definition)
         if sql_field_definition == current_column_definition:
             return True
 
@@ -165,244 +522,776 @@ class PgSQLSchema():
 
         return False
 
-    def _update_table_columns(self, table_name, sql_fields):
+    # Splits column definition to (type, is_autoincrement, is_notnull, default_value).
+    def _split_column_definition(self, column_definition):
+        default_value = None
+        if ' DEFAULT ' in column_definition:
+            column_definition, default_value = column_definition.split(' DEFAULT ', 1)
+        is_autoincrement = ' AUTO_INCREMENT' in column_definition
+        is_notnull = ' NOT NULL' in column_definition
+        column_type = column_definition.replace(' AUTO_INCREMENT', '').replace(' NOT NULL', '').strip()
+        return column_type, is_autoincrement, is_notnull, default_value
+
+    def _plan_table_columns(self, plan, table_columns, table_def, renamed_columns):
+
+        if plan.is_new_table:
+            for column in table_def.columns:
+                column_definition = self._render_column_definition(column)
+                plan.AddChange('add_column', column.name,
+                    '{0} {1}'.format(column.name, column_definition).replace(
+                        'AUTO_INCREMENT', "GENERATED ALWAYS AS IDENTITY"),
+                    new_definition=column_definition)
+            return
+
+        # Name of each declared column in the table (old name of columns that are going to be renamed).
+        new_names = dict((new_name, old_name) for old_name, new_name in renamed_columns.items())
+        column_names = set(new_names.get(column.name, column.name) for column in table_def.columns)
+        for name, metadata in table_columns.items():
+            if name not in column_names:
+                plan.AddChange('drop_column', name,
+                    'DROP COLUMN {0}'.format(name),
+                    old_definition=metadata['column_definition'])
+
+        for column in table_def.columns:
+            column_definition = self._render_column_definition(column)
+            table_name = new_names.get(column.name, column.name)
+            if table_name != column.name and table_name in table_columns:
+                # RENAME can't be combined with other subcommands, so it's executed before ALTER TABLE.
+                plan.AddChange('rename_column', column.name,
+                    'ALTER TABLE "{0}" RENAME COLUMN {1} TO {2}'.format(plan.table_name, table_name, column.name),
+                    old_name=table_name, standalone=True)
+            if table_name not in table_columns:
+                plan.AddChange('add_column', column.name,
+                    'ADD COLUMN {0} {1}'.format(column.name, column_definition).replace(
+                        'AUTO_INCREMENT', "GENERATED ALWAYS AS IDENTITY"),
+                    new_definition=column_definition)
+                continue
 
-        table_columns = self._get_table_columns(table_name)
+            table_column = table_columns[table_name]
+            if self._column_definition_matches(column_definition,
+                table_column['column_definition'],
+                table_column['is_in_primary_key']):
+                continue
 
-        with self._conn.cursor() as cursor:
-            if len(table_columns) == 0:
-                sql = "CREATE TABLE \"{0}\" ({1})".format(
-                    table_name,
-                    ','.join('{0} {1}'.format(f['name'], f['column_definition']) for f in sql_fields))
-                sql = sql.replace('AUTO_INCREMENT', "GENERATED ALWAYS AS IDENTITY")
+            column_type, is_autoincrement, is_notnull, default_value = \
+                self._split_column_definition(column_definition)
+            _, was_autoincrement, was_notnull, old_default_value = \
+                self._split_column_definition(table_column['column_definition'])
+            old_type = self._split_column_definition(
+                self._normalize_column_definition(table_column['column_definition']))[0]
+            new_type = self._split_column_definition(self._normalize_column_definition(column_definition))[0]
+            impact = self._get_column_change_impact(table_column['column_definition'], column_definition)
+            # Outside of the transaction NOT NULL is validated without blocking writes, unless the table is
+            # rewritten anyway.
+            # NOT VALID constraints can't be added to partitioned tables.
+            is_online_not_null = is_notnull and not was_notnull and self._concurrent_indexes and \
+                                 impact != 'rewrite' and table_def.partitioning is None
+
+            clauses = []
+            # ALTER COLUMN TYPE takes exclusive lock (and may rewrite the table) even if the type is the same.
+            if new_type != old_type:
+                clauses.append('ALTER COLUMN {0} TYPE {1}'.format(column.name, column_type))
+            if is_notnull and not was_notnull and not is_online_not_null:
+                clauses.append('ALTER COLUMN {0} SET NOT NULL'.format(column.name))
+            elif was_notnull and not is_notnull and not table_column['is_in_primary_key']:
+                clauses.append('ALTER COLUMN {0} DROP NOT NULL'.format(column.name))
+            if default_value is not None and default_value != old_default_value:
+                clauses.append('ALTER COLUMN {0} SET DEFAULT {1}'.format(column.name, default_value))
+            elif default_value is None and old_default_value is not None:
+                clauses.append('ALTER COLUMN {0} DROP DEFAULT'.format(column.name))
+            if is_autoincrement and not was_autoincrement:
+                clauses.append('ALTER COLUMN {0} ADD GENERATED ALWAYS AS IDENTITY'.format(column.name))
+            elif was_autoincrement and not is_autoincrement:
+                clauses.append('ALTER COLUMN {0} DROP IDENTITY IF EXISTS'.format(column.name))
+
+            if clauses:
+                plan.AddChange('change_column', column.name, ', '.join(clauses),
+                    old_definition=table_column['column_definition'],
+                    new_definition=column_definition if not is_online_not_null else
+                                   column_definition.replace(' NOT NULL', ''))
+            if is_online_not_null:
+                self._plan_online_not_null(plan, column.name)
+
+    # Adds NOT NULL to existing column without holding exclusive lock during the scan: NOT VALID check constraint
+    # is validated with lock that allows writes, then SET NOT NULL uses it instead of scanning (PostgreSQL 12+).
+    # Each statement is committed separately (in UpdateIndexesConcurrently(), retried on lock timeout like other DDL),
+    # constraint left by interrupted run is replaced.
+    def _plan_online_not_null(self, plan, column_name):
+
+        constraint_name = '{0}_{1}_not_null'.format(plan.table_name, column_name)
+        plan.AddChange('set_not_null', column_name,
+            'ALTER TABLE "{0}" ALTER COLUMN {1} SET NOT NULL'.format(plan.table_name, column_name),
+            standalone=True, concurrent=True,
+            concurrent_sql=[
+                'ALTER TABLE "{0}" DROP CONSTRAINT IF EXISTS "{1}", '
+                'ADD CONSTRAINT "{1}" CHECK ({2} IS NOT NULL) NOT VALID'.format(
+                    plan.table_name, constraint_name, column_name),
+                'ALTER TABLE "{0}" VALIDATE CONSTRAINT "{1}"'.format(plan.table_name, constraint_name),
+                'ALTER TABLE "{0}" ALTER COLUMN {1} SET NOT NULL'.format(plan.table_name, column_name),
+                'ALTER TABLE "{0}" DROP CONSTRAINT "{1}"'.format(plan.table_name, constraint_name),
+            ])
+
+    #-----------------------------------------------------------------------------------------------------------
+
+    # Name of created index (indexes of all tables share one namespace in PostgreSQL).
+    def _get_index_name(self, table_name, index):
+
+        if index.name is not None:
+            return index.name
+        elif index.type == 'UNIQUE':
+            return '{0}_{1}_key'.format(table_name, '_'.join(index.columns))
+        return '{0}_{1}'.format(table_name, '_'.join(index.columns))
+
+    # Returns ON ... part of CREATE INDEX statement.
+    def _render_index_definition(self, table_name, index):
+
+        columns = ','.join('{0} DESC'.format(column) if index.descending is not None and index.descending[i]
+                           else column for i, column in enumerate(index.columns))
+        sql = 'ON "{0}"'.format(table_name)
+        if index.method is not None:
+            sql += ' USING {0}'.format(index.method)
+        sql += ' ({0})'.format(columns)
+        if index.include:
+            sql += ' INCLUDE ({0})'.format(','.join(index.include))
+        if index.where is not None:
+            sql += ' WHERE {0}'.format(index.where)
+        return sql
+
+    def _plan_table_indexes(self, plan, table_indexes, table_def, renamed_columns):
+
+        matches = MatchIndexes(table_indexes, [self._get_comparable_index(index) for index in table_def.indexes],
+                               renamed_columns)
+        renamed_indexes = [(index, index_name) for index, index_name in zip(table_def.indexes, matches)
+                           if index_name is not None and index.name is not None and index.name != index_name]
+        # Indexes of partitioned tables can't be created or dropped CONCURRENTLY.
+        is_concurrent = self._concurrent_indexes and table_def.partitioning is None
+
+        for index_name, index in table_indexes.items():
+            if index_name not in matches:
+                if index.type == 'PRIMARY':
+                    # Primary key index has the same name as its constraint.
+                    plan.AddChange('drop_primary_key', index_name, 'DROP CONSTRAINT "{0}"'.format(index_name))
+                else:
+                    # Index whose name is taken over by renamed index has to be dropped before the rename.
+                    is_replaced = any(renamed.name == index_name for renamed, _ in renamed_indexes)
+                    plan.AddChange('drop_index', index_name, 'DROP INDEX IF EXISTS "{0}"'.format(index_name),
+                        standalone=True, concurrent=is_concurrent and not is_replaced,
+                        concurrent_sql='DROP INDEX CONCURRENTLY IF EXISTS "{0}"'.format(index_name))
+
+        for index, index_name in renamed_indexes:
+            plan.AddChange('rename_index', index.name,
+                'ALTER INDEX "{0}" RENAME TO "{1}"'.format(index_name, index.name),
+                old_name=index_name, standalone=True)
+
+        for index, index_name in zip(table_def.indexes, matches):
+            if index_name is not None:
+                continue
 
-                try:
-                    cursor.execute(sql)
-                except psycopg.errors.ProgrammingError as e:
-                    raise
+            if index.type == 'PRIMARY':
+                plan.AddChange('add_primary_key', 'PRIMARY',
+                    '{0}PRIMARY KEY ({1})'.format('' if plan.is_new_table else 'ADD ', ','.join(index.columns)),
+                    columns=index.columns)
+                continue
+
+            index_name = self._get_index_name(plan.table_name, index)
+            definition = self._render_index_definition(plan.table_name, index)
+            plan.AddChange('add_index', index_name,
+                'CREATE {0}INDEX {1} {2}'.format(
+                    'UNIQUE ' if index.type == 'UNIQUE' else '', index_name, definition),
+                columns=index.columns, type=index.type, standalone=True,
+                # Indexes of new (empty) tables are cheap to build inside the transaction.
+                concurrent=is_concurrent and not plan.is_new_table,
+                concurrent_sql='CREATE {0}INDEX CONCURRENTLY IF NOT EXISTS {1} {2}'.format(
+                    'UNIQUE ' if index.type == 'UNIQUE' else '', index_name, definition))
+
+    #-----------------------------------------------------------------------------------------------------------
 
+    def _get_partition_name(self, table_name, name):
+        return '{0}_{1}'.format(table_name, name)
+
+    def _render_range_partition(self, table_name, lower, upper):
+        name = self._get_partition_name(table_name, 'pmin' if lower is None else 'p{0}'.format(lower))
+        return 'CREATE TABLE "{0}" PARTITION OF "{1}" FOR VALUES FROM ({2}) TO ({3})'.format(
+            name, table_name, 'MINVALUE' if lower is None else lower, upper)
+
+    def _render_list_partition(self, table_name, name, values):
+        return 'CREATE TABLE "{0}" PARTITION OF "{1}" FOR VALUES IN ({2})'.format(
+            self._get_partition_name(table_name, name), table_name, ','.join(values))
+
+    # Partitioning is declared in CREATE TABLE, partitions are separate tables created after it. New range
+    # partitioned table gets partitions from the current interval on, the first one holds also all lower keys.
+    # Existing table can't be partitioned, unpartitioned or repartitioned in place on PostgreSQL, so only LIST
+    # partitions can be added or dropped. Partitions of RANGE partitioned tables are managed
+    # by MaintainPartitions().
+    def _plan_table_partitioning(self, plan, table_partitioning, table_def):
+
+        partitioning = table_def.partitioning
+        table_name = plan.table_name
+        if plan.is_new_table:
+            if partitioning is None:
+                return
+            plan.AddChange('partition_by', partitioning.column,
+                'PARTITION BY {0} ({1})'.format(partitioning.method, partitioning.column), partition=True)
+            if partitioning.method == 'RANGE':
+                for lower, upper in GetMissingRangePartitions(partitioning, [], int(time.time())):
+                    plan.AddChange('add_partition', 'pmin' if lower is None else 'p{0}'.format(lower),
+                        self._render_range_partition(table_name, lower, upper), standalone=True, partition=True)
+            elif partitioning.method == 'LIST':
+                for name, values in partitioning.lists:
+                    plan.AddChange('add_partition', name, self._render_list_partition(table_name, name, values),
+                        standalone=True, partition=True)
             else:
-                for name, metadata in table_columns.items():
-                    if name not in [field['name'] for field in sql_fields]:
-                        sql = 'ALTER TABLE "{0}" DROP COLUMN {1}'.format(
-                            table_name, name)
-                        try:
-                            cursor.execute(sql)
-                        except psycopg.errors.ProgrammingError as e:
-                            raise
-
-                for field in sql_fields:
-                    if field['name'] not in table_columns:
-                        sql = 'ALTER TABLE "{0}" ADD COLUMN {1} {2}'.format(
-                            table_name, field['name'], field['column_definition'])
-                        sql = sql.replace('AUTO_INCREMENT', "GENERATED ALWAYS AS IDENTITY")
-                        try:
-                            cursor.execute(sql)
-                        except psycopg.errors.ProgrammingError as e:
-                            raise
-                    else:
-                        table_column = table_columns[field['name']]
-
-                        if not self._column_definition_matches(field['column_definition'],
-                            table_column['column_definition'],
-                            table_column['is_in_primary_key']):
-
-                            column_type = field['column_definition']
-                            default_value = None
-                            if "DEFAULT" in field['column_definition']:
-                                (column_type, default_value) = field['column_definition'].split(" DEFAULT ")
-
-                            sql = 'ALTER TABLE "{0}" ALTER COLUMN {1} TYPE {2}'.format(
-                                table_name, field['name'], column_type)
-
-                            is_not_null = "NOT NULL" in field['column_definition']
-                            if is_not_null:
-                                sql = sql.replace("NOT NULL", "")
-
-                            sql = sql.replace('AUTO_INCREMENT', "")
-
-                            try:
-                                cursor.execute(sql)
-                                if is_not_null:
-                                    sql = 'ALTER TABLE "{0}" ALTER COLUMN {1} SET NOT NULL'.format(
-                                        table_name, field['name'])
-                                    cursor.execute(sql)
-                                if default_value is not None:
-                                    sql = 'ALTER TABLE "{0}" ALTER COLUMN {1} SET DEFAULT {2}'.format(
-                                        table_name, field['name'], default_value)
-                                    cursor.execute(sql)
-
-                            except psycopg.errors.ProgrammingError as e:
-                                raise
+                for i in range(partitioning.count):
+                    plan.AddChange('add_partition', 'p{0}'.format(i),
+                        'CREATE TABLE "{0}" PARTITION OF "{1}" FOR VALUES WITH (MODULUS {2}, REMAINDER {3})'.format(
+                            self._get_partition_name(table_name, 'p{0}'.format(i)), table_name,
+                            partitioning.count, i), standalone=True, partition=True)
+            return
+
+        if partitioning is None and table_partitioning is None:
+            return
+        if partitioning is None or table_partitioning is None or \
+           table_partitioning['method'] != partitioning.method or table_partitioning['column'] != partitioning.column:
+            raise ValueError('Partitioning of existing table {0} can\'t be changed on PostgreSQL'.format(table_name))
+
+        if partitioning.method == 'HASH' and partitioning.count != len(table_partitioning['partitions']):
+            raise ValueError('Number of HASH partitions of existing table {0} can\'t be changed '
+                             'on PostgreSQL'.format(table_name))
+
+        if partitioning.method == 'LIST':
+            added, changed, dropped = DiffListPartitions(partitioning, table_partitioning['partitions'],
+                                                         lambda name: self._get_partition_name(table_name, name))
+            if changed:
+                raise ValueError('Values of LIST partitions {0} of table {1} can\'t be changed on PostgreSQL, '
+                                 'add new partitions instead'.format(', '.join(x[0] for x in changed), table_name))
+            for name in dropped:
+                plan.AddChange('drop_partition', name, 'DROP TABLE "{0}"'.format(name), standalone=True,
+                    partition=True)
+            for name, values in added:
+                plan.AddChange('add_partition', name, self._render_list_partition(table_name, name, values),
+                    standalone=True, partition=True)
+
+    # Returns TablePlan that creates partitions of the table declared with PARTITION BY RANGE for the current
+    # and PRECREATE future intervals and drops partitions older than RETENTION. now is the current value
+    # of the partition key (default: unix timestamp). Both are metadata-only operations.
+    def PlanPartitionMaintenance(self, table_name, schema, now=None):
+
+        table_def = ParseTableSchema(schema)
+        partitioning = table_def.partitioning
+        plan = TablePlan(table_name)
+        if partitioning is None or partitioning.method != 'RANGE':
+            return plan
+        table_partitioning = self._get_table_partitioning(table_name)
+        # Table that doesn't exist or wasn't migrated yet is left to UpdateSchema().
+        if table_partitioning is None or table_partitioning['method'] != 'RANGE' or \
+           table_partitioning['column'] != partitioning.column:
+            return plan
+
+        now = int(time.time()) if now is None else now
+        for lower, upper in GetMissingRangePartitions(partitioning, table_partitioning['partitions'], now):
+            plan.AddChange('add_partition', 'p{0}'.format(lower),
+                self._render_range_partition(table_name, lower, upper), standalone=True, partition=True)
+        for name in GetExpiredRangePartitions(partitioning, table_partitioning['partitions'], now):
+            plan.AddChange('drop_partition', name, 'DROP TABLE "{0}"'.format(name), standalone=True,
+                partition=True)
+
+        return plan
+
+    def MaintainPartitions(self, table_name, schema, now=None):
+
+        plan = self.PlanPartitionMaintenance(table_name, schema, now)
+        with self._conn.cursor() as cursor:
+            for sql in self.RenderTablePlan(plan):
+                self._execute_ddl(cursor, table_name, sql)
 
-        return True
+        return plan
 
     #-----------------------------------------------------------------------------------------------------------
 
-    def _update_table_indexes(self, table_name, sql_indexes):
+    # All column and primary key changes of the table are issued as one statement, so the table is locked and
+    # rewritten at most once. Secondary indexes can't be part of CREATE/ALTER TABLE in PostgreSQL, so they are
+    # dropped before and created after it, as well as partitions of partitioned table.
+    def RenderTablePlan(self, plan):
 
-        table_indexes = self._get_table_indexes(table_name)
+        changes = [change for change in plan.changes if not change.get('concurrent')]
 
-        with self._conn.cursor() as cursor:
+        statements = [change['sql'] for change in changes
+            if change.get('standalone') and change['op'] == 'drop_index']
+        statements += [change['sql'] for change in changes
+            if change['op'] in ('rename_column', 'rename_index')]
 
-            drop_primary_key_pending = False
-
-            for index_name, index_schema in table_indexes.items():
-                if index_schema not in sql_indexes:
-                    if index_schema['type'] == 'PRIMARY':
-                        drop_primary_key_pending = True
-                        continue
-
-                    sql = f"DROP INDEX {index_name}"
-                    try:
-                        cursor.execute(sql)
-                    except psycopg.errors.ProgrammingError as e:
-                        raise
-
-            for index in sql_indexes:
-                index_exists = False
-                for _, index_schema in table_indexes.items():
-                    if index_schema == index:
-                        index_exists = True
-                        break
-
-                if not index_exists:
-                    if index['type'] == 'PRIMARY':
-                        sql = 'ALTER TABLE "{0}" {1} ADD PRIMARY KEY ({2})'.format(
-                            table_name,
-                            ' DROP PRIMARY KEY,' if drop_primary_key_pending else '',
-                            ','.join(index['columns']))
-                        drop_primary_key_pending = False
-                    elif index['type'] == 'UNIQUE':
-                        sql = 'ALTER TABLE "{0}" ADD UNIQUE INDEX ({1})'.format(
-                            table_name, ','.join(index['columns']))
-                    else:
-                        sql = 'CREATE INDEX {0}_{2} ON "{0}" ({1})'.format(
-                            table_name, ','.join(index['columns']), '_'.join(index['columns']))
-
-                    try:
-                        cursor.execute(sql)
-                    except psycopg.errors.ProgrammingError as e:
-                        raise
-
-            if drop_primary_key_pending:
-                sql = 'ALTER TABLE "{0}" DROP PRIMARY KEY'.format(
-                    table_name)
-                try:
-                    cursor.execute(sql)
-                except psycopg.errors.ProgrammingError as e:
-                    raise
+        clauses = ', '.join(change['sql'] for change in changes
+                            if not change.get('standalone') and change['op'] != 'partition_by')
+        if clauses:
+            if plan.is_new_table:
+                partitioning = ''.join(' ' + change['sql'] for change in plan.GetChanges('partition_by'))
+                statements.append('CREATE TABLE "{0}" ({1}){2}'.format(plan.table_name, clauses, partitioning))
+            else:
+                statements.append('ALTER TABLE "{0}" {1}'.format(plan.table_name, clauses))
 
-        return True
+        statements += [change['sql'] for change in changes
+            if change.get('standalone') and change['op'] not in ('drop_index', 'rename_column', 'rename_index')]
+
+        return statements
+
+    def _execute_ddl(self, cursor, table_name, sql):
+        # Cached catalog of the table is no longer valid once we start altering it.
+        if self._catalog is not None:
+            self._catalog.InvalidateTable(table_name)
+        with self._events.Timed('ddl', table=table_name, sql=sql) as event, self._watch_progress(table_name, sql):
+            if self._ddl_retry is None:
+                cursor.execute(sql)
+            elif self._conn.autocommit:
+                # Statements of UpdateIndexesConcurrently() run outside of transaction, without savepoints.
+                self._execute_autocommit_ddl_with_lock_timeout(cursor, table_name, sql)
+            else:
+                self._execute_ddl_with_lock_timeout(cursor, table_name, sql)
+            event['rowcount'] = cursor.rowcount
+
+    def _watch_progress(self, table_name, sql):
+        if self._progress is None:
+            return contextlib.nullcontext()
+        return self._progress.Watch(self._conn, table_name, sql)
+
+    def _is_lock_timeout(self, e):
+        return isinstance(e, psycopg.errors.LockNotAvailable)
+
+    def _get_timeout_settings(self, lock_timeout, statement_timeout, local=True):
+        return "SET {0}lock_timeout = '{1}'; SET {0}statement_timeout = '{2}'".format(
+            'LOCAL ' if local else '', str(lock_timeout).replace("'", "''"), str(statement_timeout).replace("'", "''"))
+
+    # Returns (lock_timeout, statement_timeout) of DDL statements in the format of PostgreSQL settings.
+    def _get_ddl_timeouts(self, cursor, is_index_build=False):
+
+        if self._session_timeouts is None:
+            cursor.execute("SELECT current_setting('lock_timeout'), current_setting('statement_timeout')")
+            self._session_timeouts = tuple(cursor.fetchone())
+
+        # Index builds take as long as the table is big, only their lock waits are limited.
+        statement_timeout = self._session_timeouts[1]
+        if self._ddl_retry.statement_timeout is not None and not is_index_build:
+            statement_timeout = '{0}ms'.format(int(self._ddl_retry.statement_timeout * 1000))
+        return '{0}ms'.format(int(self._ddl_retry.lock_timeout * 1000)), statement_timeout
+
+    # Each attempt runs in a savepoint, so that lock timeout doesn't abort the whole migration transaction.
+    # Timeouts are set with SET LOCAL and restored to session values after the statement.
+    def _execute_ddl_with_lock_timeout(self, cursor, table_name, sql):
+
+        settings = self._get_timeout_settings(*self._get_ddl_timeouts(cursor))
+
+        def execute():
+            cursor.execute("SAVEPOINT sql_schema_builder_ddl; " + settings)
+            try:
+                cursor.execute(sql)
+            except psycopg.Error:
+                cursor.execute("ROLLBACK TO SAVEPOINT sql_schema_builder_ddl")
+                raise
+            cursor.execute(self._get_timeout_settings(*self._session_timeouts) +
+                           "; RELEASE SAVEPOINT sql_schema_builder_ddl")
+
+        self._ddl_retry.Execute(execute, self._is_lock_timeout, table_name, sql)
+
+    # Outside of transaction each statement is committed on its own, so failed attempt needs no savepoint.
+    # Timeouts are set for the session and restored after the statement, CREATE/DROP INDEX CONCURRENTLY keeps
+    # the session statement_timeout.
+    def _execute_autocommit_ddl_with_lock_timeout(self, cursor, table_name, sql):
+
+        match = re.match(r'(CREATE (UNIQUE )?|DROP )INDEX CONCURRENTLY IF (NOT )?EXISTS "?(\w+)"?', sql)
+        settings = self._get_timeout_settings(*self._get_ddl_timeouts(cursor, is_index_build=match is not None),
+                                              local=False)
+        is_retry = [False]
+
+        def execute():
+            cursor.execute(settings)
+            try:
+                # Build that timed out waiting for older transactions leaves INVALID index behind, which
+                # IF NOT EXISTS of the next attempt would keep.
+                if is_retry[0] and match is not None and match.group(1).startswith('CREATE'):
+                    cursor.execute("SELECT 1 FROM pg_index WHERE indexrelid = to_regclass(%s) AND NOT indisvalid",
+                                   ('"{0}"'.format(match.group(4)),))
+                    if cursor.fetchone() is not None:
+                        cursor.execute('DROP INDEX CONCURRENTLY IF EXISTS "{0}"'.format(match.group(4)))
+                is_retry[0] = True
+                cursor.execute(sql)
+            finally:
+                cursor.execute(self._get_timeout_settings(*self._session_timeouts, local=False))
+
+        self._ddl_retry.Execute(execute, self._is_lock_timeout, table_name, sql)
 
     #-----------------------------------------------------------------------------------------------------------
 
-    def UpdateTableSchema(self, table_name, schema):
+    # Waits up to timeout seconds (0 - just try) for advisory lock of the database migration, returns True if acquired.
+    # The lock belongs to the session, it's not released by commit/rollback.
+    def AcquireMigrationLock(self, timeout):
+        deadline = time.monotonic() + timeout
+        with self._conn.cursor() as cursor:
+            while True:
+                cursor.execute("SELECT pg_try_advisory_lock({0})".format(MIGRATION_LOCK_KEYS))
+                if cursor.fetchone()[0]:
+                    return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                time.sleep(min(MIGRATION_LOCK_POLL_INTERVAL, remaining))
+
+    def ReleaseMigrationLock(self):
+        with self._conn.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_unlock({0})".format(MIGRATION_LOCK_KEYS))
 
-        field_pattern = r'^\s*(\w+)\s+(\w+)(\(([^)]+)\))?(\s+UNSIGNED)?(\s+AUTO_INCREMENT)?(\s+NOTNULL)?(\s+DEFAULT\s+\'?([\w\.]*)\'?)?\s*$'
-        index_pattern = r'^\s*INDEX\s+((\w+)\s+)?\(([^\)]+)\)\s*$'
-
-        column_types = {
-            'I': 'INTEGER',
-            'I1': 'SMALLINT',
-            'I2': 'SMALLINT',
-            'I8': 'BIGINT',
-            'F': 'DOUBLE PRECISION',
-            'N': 'DECIMAL(10,2)',
-
-            'C': 'CHARACTER VARYING',
-            'MX': 'TEXT',
-            'X': 'TEXT',
-            'MB': 'BYTEA',
-            'B': 'BYTEA',
-            'J': 'JSON',
-            'BIN': 'BYTEA',
-
-            'D': 'DATE',
-            'T': 'TIME',
-
-            'ENUM': 'ENUM',
-
-            'INT8': 'SMALLINT',
-            'INT16': 'SMALLINT',
-            'INT32': 'INTEGER',
-            'INT64': 'BIGINT',
-            'CHAR': 'CHARACTER VARYING',
-            'DOUBLE': 'DOUBLE PRECISION',
-            'TEXT': 'TEXT',
-            'BLOB': 'BYTEA',
-            'JSON': 'JSON',
-            'BOOL': 'BOOLEAN',
-            'BOOLEAN': 'BOOLEAN',
+    #-----------------------------------------------------------------------------------------------------------
+
+    def _get_table_rows(self, table_name):
+
+        if table_name not in self._table_rows:
+            # Load row counts of all tables of the catalog at once, other tables will probably need them too.
+            table_names = set(self._catalog.GetTableNames() if self._catalog is not None else [])
+            table_names.add(table_name)
+            table_names = [x for x in table_names if x not in self._table_rows]
+            table_stats = self.GetTableStats(table_names)
+            for name in table_names:
+                self._table_rows[name] = table_stats.get(name, {}).get('rows', 0)
+
+        return self._table_rows[table_name]
+
+    def _is_shadow_table(self, table_name):
+
+        if self._shadow_tables is None:
+            return False
+        if isinstance(self._shadow_tables, int):
+            return self._conn is not None and self._get_table_rows(table_name) >= self._shadow_tables
+        return table_name in self._shadow_tables
+
+    # Existing table from shadow_tables, which ALTER TABLE would rewrite or scan (or block writes to it while
+    # building index), is migrated through shadow table instead: new table is created from the DDL, rows are copied
+    # in batches by primary key while trigger applies concurrent writes, then the tables are swapped by renames
+    # in one short transaction.
+    def _plan_shadow_table(self, plan, table_columns, table_indexes, table_def, renamed_columns):
+
+        if plan.is_new_table or not self._is_shadow_table(plan.table_name):
+            return
+        if all(change.get('concurrent') or self._get_change_impact(plan, change) == 'metadata'
+               for change in plan.changes):
+            return
+
+        if table_def.partitioning is not None:
+            raise ValueError('Partitioned table {0} can\'t be migrated through shadow table'.format(plan.table_name))
+        key_column = GetUnchangedPrimaryKey(table_indexes, table_def, renamed_columns)
+        if key_column is None:
+            raise ValueError('Table {0} needs unchanged single column primary key to be migrated through '
+                             'shadow table'.format(plan.table_name))
+
+        # Indexes of the shadow table are named after it and renamed once the original table is dropped.
+        shadow_def = TableDef(table_def.columns, tuple(IndexDef(index.type, index.columns, lengths=index.lengths,
+                                                                descending=index.descending, include=index.include,
+                                                                where=index.where, method=index.method)
+                                                       for index in table_def.indexes))
+        shadow_plan = TablePlan('_{0}_new'.format(plan.table_name), is_new_table=True)
+        self._plan_table_columns(shadow_plan, {}, shadow_def, {})
+        self._plan_table_indexes(shadow_plan, {}, shadow_def, {})
+        plan.shadow = {
+            'table_name': shadow_plan.table_name,
+            'old_table_name': '_{0}_old'.format(plan.table_name),
+            'key_column': key_column,
+            'columns': GetExistingColumns(table_columns, table_def, renamed_columns),
+            'plan': shadow_plan,
+            'indexes': [(self._get_index_name(shadow_plan.table_name, shadow_index),
+                         self._get_index_name(plan.table_name, index))
+                        for shadow_index, index in zip(shadow_def.indexes, table_def.indexes)
+                        if index.type != 'PRIMARY'],
+            'sequences': [column.name for column in table_def.columns if column.is_autoincrement],
         }
 
-        fields = [x.strip() if not x.strip().endswith(',') else x.strip()[:-1].strip() for x in schema.splitlines()]
+    # Returns {'prepare', 'copy', 'swap'} statements of migration through shadow table. Copy statement copies
+    # batch of rows between two keys (its parameters), statements of the other steps are executed in order.
+    def GetShadowStatements(self, plan):
+
+        table_name = plan.table_name
+        shadow_table_name = plan.shadow['table_name']
+        old_table_name = plan.shadow['old_table_name']
+        key_name, new_key_name = plan.shadow['key_column']
+        trigger = '_{0}_sync'.format(table_name)
+
+        new_columns = ', '.join(new_name for new_name, name in plan.shadow['columns'])
+        columns = ', '.join(name for new_name, name in plan.shadow['columns'])
+        values = ', '.join('NEW.{0}'.format(name) for new_name, name in plan.shadow['columns'])
+
+        # Leftovers of interrupted migration are dropped, the copy starts again.
+        prepare = [
+            'DROP TRIGGER IF EXISTS "{0}" ON "{1}"'.format(trigger, table_name),
+            'DROP TABLE IF EXISTS "{0}", "{1}"'.format(shadow_table_name, old_table_name),
+        ]
+        prepare += self.RenderTablePlan(plan.shadow['plan'])
+        prepare += [
+            'CREATE OR REPLACE FUNCTION "{0}"() RETURNS trigger LANGUAGE plpgsql AS $$ BEGIN '
+            'IF TG_OP <> \'INSERT\' THEN DELETE FROM "{1}" WHERE {2} = OLD.{3}; END IF; '
+            'IF TG_OP <> \'DELETE\' THEN INSERT INTO "{1}" ({4}) OVERRIDING SYSTEM VALUE VALUES ({5}); END IF; '
+            'RETURN NULL; END $$'.format(trigger, shadow_table_name, new_key_name, key_name, new_columns, values),
+            'CREATE TRIGGER "{0}" AFTER INSERT OR UPDATE OR DELETE ON "{1}" '
+            'FOR EACH ROW EXECUTE FUNCTION "{0}"()'.format(trigger, table_name),
+        ]
+
+        # Rows already written by the trigger are newer than the copied ones. Copied rows are locked until commit,
+        # so that their concurrent update waits for the copy and its trigger then replaces them.
+        copy = 'INSERT INTO "{0}" ({1}) OVERRIDING SYSTEM VALUE SELECT {2} FROM "{3}" WHERE {4} BETWEEN %s AND %s ' \
+               'FOR SHARE ON CONFLICT DO NOTHING'.format(shadow_table_name, new_columns, columns, table_name, key_name)
+
+        swap = [
+            'LOCK TABLE "{0}" IN ACCESS EXCLUSIVE MODE'.format(table_name),
+            'ALTER TABLE "{0}" RENAME TO "{1}"'.format(table_name, old_table_name),
+            'ALTER TABLE "{0}" RENAME TO "{1}"'.format(shadow_table_name, table_name),
+            'DROP TABLE "{0}"'.format(old_table_name),
+            'DROP FUNCTION "{0}"()'.format(trigger),
+            'ALTER TABLE "{0}" RENAME CONSTRAINT "{1}_pkey" TO "{0}_pkey"'.format(table_name, shadow_table_name),
+        ]
+        swap += ['ALTER INDEX "{0}" RENAME TO "{1}"'.format(shadow_index_name, index_name)
+                 for shadow_index_name, index_name in plan.shadow['indexes']]
+        # Sequences of identity columns of the shadow table continue after the copied values.
+        swap += ["SELECT setval(pg_get_serial_sequence('\"{0}\"', '{1}'), coalesce(max({1}), 0) + 1, false) "
+                 "FROM \"{0}\"".format(table_name, column_name)
+                 for column_name in plan.shadow['sequences']]
+
+        return {'prepare': prepare, 'copy': copy, 'swap': swap}
+
+    # Triggers of the table would be dropped with the replaced table.
+    def _check_table_triggers(self, cursor, plan):
+
+        sql = """
+            SELECT tg.tgname
+              FROM pg_trigger tg, pg_class t
+             WHERE tg.tgrelid = t.oid
+               AND t.relname = %s
+               AND NOT tg.tgisinternal
+        """
+        cursor.execute(sql, (plan.table_name,))
+        triggers = [row[0] for row in cursor.fetchall() if row[0] != '_{0}_sync'.format(plan.table_name)]
+        if triggers:
+            raise ValueError('Table {0} has triggers ({1}), it can\'t be migrated through shadow table'.format(
+                plan.table_name, ', '.join(triggers)))
+
+    def _update_table_with_shadow(self, cursor, plan):
+
+        self._check_table_triggers(cursor, plan)
+        statements = self.GetShadowStatements(plan)
+        for sql in statements['prepare']:
+            self._execute_ddl(cursor, plan.table_name, sql)
+        # Trigger has to be committed before the copy, and the copy is committed after every batch,
+        # so it can't be part of the migration transaction.
+        self._conn.commit()
+
+        self._shadow_copy(self._conn, 'shadow:' + plan.table_name, '"{0}"'.format(plan.table_name),
+                          plan.shadow['key_column'][0],
+                          lambda cursor, rows: cursor.execute(statements['copy'], (rows[0][0], rows[-1][0])))
+
+        for sql in statements['swap']:
+            self._execute_ddl(cursor, plan.table_name, sql)
+        self._conn.commit()
 
-        sql_fields = []
-        sql_indexes = []
-        for field in fields:
-            if len(field) == 0:
-                continue
-            matches = re.match(field_pattern, field)
-            if not matches:
-                matches = re.match(index_pattern, field)
-                if not matches:
-                    raise ValueError('Invalid field specifier: ' + field)
-
-                index_type = matches.group(2)
-                index_fields = matches.group(3)
-                if index_type not in (None, 'PRIMARY', 'UNIQUE'):
-                    raise ValueError('Invalid index type: ' + field)
-
-                sql_indexes.append({'type': index_type, 'columns': ['{}'.format(x.strip()) for x in index_fields.split(',')] })
-                continue
+    #-----------------------------------------------------------------------------------------------------------
 
-            name = matches.group(1)
-            type = matches.group(2)
-            type_arguments = matches.group(4)
-            is_unsigned = matches.group(5) is not None
-            is_autoincrement = matches.group(6) is not None
-            is_notnull = matches.group(7) is not None
-            default_value = matches.group(9)
-
-            if type not in column_types:
-                raise ValueError('Invalid type specifier: ' + field)
-            if type in ['C', 'CHAR'] and not type_arguments:
-                raise ValueError('Char type requires size: ' + field)
-            if type == 'ENUM' and not type_arguments:
-                raise ValueError('Enum type requires list of possible values: ' + field)
-            if type == 'BIN' and not type_arguments:
-                raise ValueError('Binary type requires size: ' + field)
-            if type not in ['C', 'CHAR', 'ENUM', 'BIN'] and type_arguments:
-                raise ValueError('Only char or enum type can have arguments: ' + field)
-
-            column_definition = column_types[type]
-            if type in ['C', 'CHAR', 'ENUM']:
-                if type == 'ENUM':
-                    # Strip whitespace between enum values for canonical form.
-                    type_arguments = ','.join("'{}'".format(x) for x in re.findall(r"'([^']*?)'", type_arguments))
-                    # We don't support ENUM type for PostgreSQL yet. We convert it to CHAR.
-                    column_definition = column_types["CHAR"]
-                    type_arguments = max([len(x) for x in type_arguments.split(",")] or [1])
-                column_definition += '({0})'.format(type_arguments)
-            elif type == 'BIN':
-                # We ignore size specifier for BIN column on PostgreSQL.
-                pass
-            if is_unsigned:
-                column_definition += ' UNSIGNED'
-            if is_autoincrement:
-                column_definition += ' AUTO_INCREMENT'
-            if is_notnull:
-                column_definition += ' NOT NULL'
-            if default_value is not None:
-                column_definition += ' DEFAULT '
-                column_definition += f"'{default_value}'"
-
-            sql_fields.append({'name': name, 'column_definition': column_definition})
-
-        if not self._update_table_columns(table_name, sql_fields):
+    # Returns {table_name: {'rows', 'data_size', 'index_size'}} of existing tables with one query.
+    # Row counts are planner estimates from the last ANALYZE.
+    def GetTableStats(self, table_names):
+
+        table_stats = {}
+        table_names = list(table_names)
+        if not table_names:
+            return table_stats
+
+        with self._conn.cursor() as cursor:
+            # Partitioned table has no storage of its own, its sizes are sums of its partitions.
+            sql = """
+                SELECT c.relname,
+                       greatest(c.reltuples, 0) + coalesce(sum(greatest(p.reltuples, 0)), 0),
+                       pg_table_size(c.oid) + coalesce(sum(pg_table_size(p.oid)), 0),
+                       pg_indexes_size(c.oid) + coalesce(sum(pg_indexes_size(p.oid)), 0)
+                  FROM pg_class c
+                  LEFT JOIN pg_inherits i ON i.inhparent = c.oid AND c.relkind = 'p'
+                  LEFT JOIN pg_class p ON p.oid = i.inhrelid
+                 WHERE c.relkind IN ('r', 'p')
+                   AND c.relname = ANY(%s)
+                 GROUP BY c.relname, c.reltuples, c.oid
+            """
+            cursor.execute(sql, (table_names,))
+            for row in cursor.fetchall():
+                table_stats[row[0]] = {
+                    # reltuples is -1 for tables that were never analyzed.
+                    'rows': max(int(row[1] or 0), 0),
+                    'data_size': int(row[2] or 0),
+                    'index_size': int(row[3] or 0),
+                }
+
+        return table_stats
+
+    # Changing VARCHAR to wider VARCHAR or TEXT and increasing precision of NUMERIC with the same scale doesn't
+    # rewrite the table. Types are in canonical form (see _normalize_column_definition()).
+    def _is_binary_coercible(self, old_type, new_type):
+
+        old_matches = re.match(r'^NUMERIC\((\d+),(\d+)\)$', old_type)
+        if old_matches:
+            new_matches = re.match(r'^NUMERIC(\((\d+),(\d+)\))?$', new_type)
+            if not new_matches:
+                return False
+            if new_matches.group(1) is None:
+                return True
+            return new_matches.group(3) == old_matches.group(2) and \
+                   int(new_matches.group(2)) >= int(old_matches.group(1))
+
+        old_matches = re.match(r'^CHARACTER VARYING(\((\d+)\))?$', old_type)
+        if not old_matches:
             return False
-        if not self._update_table_indexes(table_name, sql_indexes):
+        if new_type == 'TEXT':
+            return True
+        new_matches = re.match(r'^CHARACTER VARYING(\((\d+)\))?$', new_type)
+        if not new_matches:
             return False
+        if new_matches.group(2) is None:
+            return True
+        return old_matches.group(2) is not None and int(new_matches.group(2)) >= int(old_matches.group(2))
+
+    # Returns 'metadata', 'scan' or 'rewrite' impact of changing column definition with ALTER TABLE.
+    def _get_column_change_impact(self, old_definition, new_definition):
+
+        old_type, was_autoincrement, was_notnull, _ = \
+            self._split_column_definition(self._normalize_column_definition(old_definition))
+        new_type, is_autoincrement, is_notnull, _ = \
+            self._split_column_definition(self._normalize_column_definition(new_definition))
+        if is_autoincrement and not was_autoincrement:
+            return 'rewrite'
+        if old_type != new_type and not self._is_binary_coercible(old_type, new_type):
+            return 'rewrite'
+        if is_notnull and not was_notnull:
+            return 'scan'
+        return 'metadata'
+
+    # Returns 'metadata', 'scan', 'index' or 'rewrite' impact of the change on the existing table.
+    def _get_change_impact(self, plan, change):
+
+        if plan.is_new_table or change['op'] in ('drop_column', 'drop_index', 'drop_primary_key', 'rename_column',
+                                                 'rename_index', 'add_partition', 'drop_partition'):
+            return 'metadata'
+        if change['op'] in ('add_index', 'add_primary_key'):
+            return 'index'
+        if change['op'] == 'set_not_null':
+            # Validation scans the table, but doesn't block writes.
+            return 'scan'
+        if change['op'] == 'add_column':
+            # Identity column has to be filled for all existing rows.
+            return 'rewrite' if 'AUTO_INCREMENT' in change['new_definition'] else 'metadata'
+
+        return self._get_column_change_impact(change['old_definition'], change['new_definition'])
+
+    # Returns statements that UpdateTableSchema() (and UpdateIndexesConcurrently()) would execute for the plan.
+    def GetPlanStatements(self, plan):
+
+        if plan.shadow is not None:
+            statements = self.GetShadowStatements(plan)
+            return statements['prepare'] + [statements['copy']] + statements['swap']
+
+        return self.RenderTablePlan(plan) + self.GetConcurrentIndexStatements(plan)
+
+    # Fills table stats, impact of changes, statements and estimated duration of the plans.
+    def AnnotateTablePlans(self, plans, throughput=None):
+
+        table_stats = self.GetTableStats([plan.table_name for plan in plans if not plan.is_new_table])
+        for plan in plans:
+            plan.stats = table_stats.get(plan.table_name, {'rows': 0, 'data_size': 0, 'index_size': 0})
+            for change in plan.changes:
+                change['impact'] = self._get_change_impact(plan, change)
+            plan.statements = self.GetPlanStatements(plan)
+            plan.EstimateDuration(throughput)
+
+        return plans
+
+    #-----------------------------------------------------------------------------------------------------------
+
+    def _render_column_definition(self, column):
+
+        column_definition = COLUMN_TYPES[column.type]
+        if column.type == 'C':
+            column_definition += '({0})'.format(column.type_arguments)
+        elif column.type == 'ENUM':
+            # We don't support ENUM type for PostgreSQL yet. We convert it to CHAR.
+            column_definition = COLUMN_TYPES['C']
+            column_definition += '({0})'.format(max([len(x) for x in column.type_arguments.split(",")] or [1]))
+        elif column.type == 'BIN':
+            # We ignore size specifier for BIN column on PostgreSQL.
+            pass
+        # UNSIGNED is ignored, PostgreSQL has no unsigned types.
+        if column.is_autoincrement:
+            column_definition += ' AUTO_INCREMENT'
+        if column.is_notnull:
+            column_definition += ' NOT NULL'
+        if column.default_value is not None:
+            column_definition += ' DEFAULT '
+            column_definition += f"'{column.default_value}'"
+
+        return column_definition
+
+    # Returns TablePlan with all changes needed to bring the table up to date, without executing them.
+    def PlanTableSchema(self, table_name, schema):
+
+        table_def = ParseTableSchema(schema)
+
+        table_columns = self._get_table_columns(table_name)
+        plan = TablePlan(table_name, is_new_table=(len(table_columns) == 0))
+        renamed_columns = GetRenamedColumns(table_columns, table_def)
+        table_indexes = {} if plan.is_new_table else self._get_table_indexes(table_name)
+        table_partitioning = None if plan.is_new_table else self._get_table_partitioning(table_name)
+        self._plan_table_columns(plan, table_columns, table_def, renamed_columns)
+        self._plan_table_indexes(plan, table_indexes, table_def, renamed_columns)
+        self._plan_table_partitioning(plan, table_partitioning, table_def)
+        self._plan_shadow_table(plan, table_columns, table_indexes, table_def, renamed_columns)
+
+        return plan
+
+    def UpdateTableSchema(self, table_name, schema):
+
+        plan = self.PlanTableSchema(table_name, schema)
+
+        with self._conn.cursor() as cursor:
+            if plan.shadow is not None:
+                self._update_table_with_shadow(cursor, plan)
+                return True
+
+            for sql in self.RenderTablePlan(plan):
+                self._execute_ddl(cursor, table_name, sql)
+
+        return True
+
+    #-----------------------------------------------------------------------------------------------------------
+
+    # Returns DROP/CREATE INDEX CONCURRENTLY and online NOT NULL statements of the plan, which
+    # UpdateIndexesConcurrently() executes.
+    def GetConcurrentIndexStatements(self, plan):
+
+        statements = []
+        for change in plan.GetChanges('drop_index') + plan.GetChanges('set_not_null') + plan.GetChanges('add_index'):
+            if not change.get('concurrent'):
+                continue
+            if change['op'] == 'set_not_null':
+                statements += change['concurrent_sql']
+            else:
+                statements.append(change['concurrent_sql'])
+
+        return statements
+
+    # Creates/drops secondary indexes with CONCURRENTLY and adds NOT NULL to existing columns with validated
+    # check constraint, so that writes to the tables are not blocked.
+    # Has to be called outside of transaction, after column changes from UpdateTableSchema() were committed.
+    # INVALID indexes left by interrupted builds are dropped and built again, so it can be safely restarted.
+    def UpdateIndexesConcurrently(self, schema_dict):
+
+        self._conn.commit()
+        autocommit = self._conn.autocommit
+        self._conn.autocommit = True
+        try:
+            self.LoadCatalogSnapshot(schema_dict.keys())
+            with self._conn.cursor() as cursor:
+                for table_name, table_schema in schema_dict.items():
+                    plan = self.PlanTableSchema(table_name, table_schema)
+                    for sql in self.GetConcurrentIndexStatements(plan):
+                        self._execute_ddl(cursor, table_name, sql)
+        finally:
+            self._conn.autocommit = autocommit
 
         return True
@@ -1,8 +1,89 @@
-from sql_schema_builder.MySQLSchema import MySQLSchema
+from sql_schema_builder.Backfill import Backfill, CHECKPOINT_PREFIX
+from sql_schema_builder.CatalogSnapshot import CatalogSnapshot
+from sql_schema_builder.DDLProgressMonitor import DDLProgressMonitor
+from sql_schema_builder.DDLRetryPolicy import DDLRetryPolicy
+from sql_schema_builder.MigrationEvents import EventDispatcher
+from sql_schema_builder.MigrationTrace import MigrationTraceRecorder, TracedCursor
+from sql_schema_builder.MySQLConnectionPool import MySQLConnectionPool
+from sql_schema_builder.MySQLSchema import MySQLSchema, ONLINE_DDL_POLICIES
 from sql_schema_builder.PgSQLSchema import PgSQLSchema
+from sql_schema_builder.SchemaVersionCache import GetProcessCache
 
+import concurrent.futures
+import hashlib
+import inspect
+import os
 import pymysql
 import psycopg
+import psycopg_pool
+
+
+CFG_DBASE_SCHEMA = """
+    name C(64),
+    value C(64),
+    INDEX PRIMARY (name)
+"""
+
+
+MIGRATION_LOCK_MODES = (None, "wait", "skip")
+
+
+# Stable hash of the schema, independent of indentation of the DDL and order of tables in the dict.
+def GetSchemaFingerprint(schema_dict, schema_version):
+    fingerprint = hashlib.sha256(repr(float(schema_version)).encode())
+    for table_name in sorted(schema_dict):
+        ddl = ' '.join(line.strip() for line in schema_dict[table_name].splitlines() if line.strip())
+        fingerprint.update(f"\n{table_name}: {ddl}".encode())
+    return fingerprint.hexdigest()
+
+
+# Plans changes of the schema against saved CatalogSnapshot without any database connection.
+# Returns list of TablePlan with SQL statements (without table stats and estimates).
+def PlanSchemaFromSnapshot(catalog, schema_dict, online_ddl=None, ignore_column_order=False):
+
+    if 'cfg_dbase' in schema_dict:
+        raise ValueError('Table name cfg_dbase is reserved')
+
+    schema_dict = dict(schema_dict)
+    schema_dict['cfg_dbase'] = CFG_DBASE_SCHEMA
+
+    if catalog.db_type == "mysql":
+        db_schema = MySQLSchema(None, catalog=catalog, online_ddl=online_ddl, ignore_column_order=ignore_column_order)
+    elif catalog.db_type == "pgsql":
+        db_schema = PgSQLSchema(None, catalog=catalog)
+    else:
+        raise NotImplementedError(f"Unsupported db_type: {catalog.db_type}!")
+
+    plans = []
+    for table_name, table_schema in schema_dict.items():
+        plan = db_schema.PlanTableSchema(table_name, table_schema)
+        if not plan.IsEmpty():
+            plan.statements = db_schema.GetPlanStatements(plan)
+            plans.append(plan)
+
+    return plans
+
+
+# Raised by UpdateSchema() in parallel mode when migration of some tables failed.
+# All other tables were migrated, but schema version was not increased.
+class SchemaMigrationError(Exception):
+
+    def __init__(self, errors):
+        # Maps table name to exception raised by its migration.
+        self.errors = errors
+        super().__init__("Migration of tables failed: " + ", ".join(
+            f"{table_name} ({error})" for table_name, error in errors.items()))
+
+
+# Raised by UpdateSchema() with verify_idempotence=True when planning the schema again right after the migration
+# still finds changes, i.e. the same schema would be altered again on the next version bump.
+class SchemaNotIdempotentError(Exception):
+
+    def __init__(self, plans):
+        # TablePlan of each table with remaining changes.
+        self.plans = plans
+        super().__init__("Schema is not idempotent, remaining changes: " + "; ".join(
+            f"{plan.table_name} ({', '.join(change['sql'] for change in plan.changes)})" for plan in plans))
 
 
 class SQLSchemaBuilder:
@@ -12,7 +93,12 @@ class SQLSchemaBuilder:
                        passwd=None, password=None,
                        db=None, database=None,
                        pymysql_conn=None, create_db=False,
-                       db_type="mysql"):
+                       db_type="mysql", online_ddl=None, concurrent_indexes=False,
+                       version_cache=None, parallel_tables=None, listeners=None, catalog_snapshot=None,
+                       lock_timeout=None, statement_timeout=None, lock_retry_budget=60,
+                       verify_idempotence=False, ignore_column_order=False,
+                       migration_lock=None, migration_lock_timeout=60, shadow_tables=None, shadow_copy_options=None,
+                       progress_callback=None, progress_interval=1.0, trace_path=None):
         self._conn = None
         self._conn_params = {}
         passwd = passwd or password
@@ -20,6 +106,65 @@ class SQLSchemaBuilder:
         if db_type not in ["mysql", "pgsql"]:
             raise NotImplementedError(f"Unsupported db_type: {db_type}!")
         self.db_type = db_type
+        # Online DDL mode (MySQL only): None, "fallback", "nolock" or "strict".
+        if online_ddl is not None and online_ddl not in ONLINE_DDL_POLICIES:
+            raise ValueError(f"Unsupported online_ddl policy: {online_ddl}!")
+        self._online_ddl = online_ddl
+        # ALGORITHM/LOCK actually used by ALTER TABLE statements of the last UpdateSchema() in online DDL mode.
+        self.online_ddl_report = []
+        # PostgreSQL only: build/drop secondary indexes with CONCURRENTLY after the migration transaction.
+        self._concurrent_indexes = concurrent_indexes
+        # SchemaVersionCache remembering databases that are up to date (True - cache shared by the whole process).
+        self._version_cache = GetProcessCache() if version_cache is True else (version_cache or None)
+        # Number of connections used to migrate tables in parallel (None - all tables on the single connection).
+        if parallel_tables is not None and parallel_tables < 1:
+            raise ValueError(f"Invalid number of parallel_tables: {parallel_tables}!")
+        self._parallel_tables = parallel_tables
+        # Listeners of migration events (see MigrationEvents.py).
+        self.events = EventDispatcher(listeners)
+        # Path of saved CatalogSnapshot used instead of reading the catalog while its checksum matches the database.
+        self._catalog_snapshot = catalog_snapshot
+        # Limits of lock waits (and PostgreSQL statement duration) of DDL statements, in seconds.
+        if lock_timeout is None and statement_timeout is not None:
+            raise ValueError("statement_timeout requires lock_timeout!")
+        self._lock_timeout = lock_timeout
+        self._statement_timeout = statement_timeout
+        self._lock_retry_budget = lock_retry_budget
+        self._ddl_retry = None
+        # Statements of the last UpdateSchema() that were retried after lock timeout (see DDLRetryPolicy.report).
+        self.lock_retry_report = []
+        # MySQL only: keep physical order of existing columns (True - in all tables, number - in tables with at least
+        # that many rows), new columns are added at the end.
+        if ignore_column_order is not True and ignore_column_order is not False and \
+           (not isinstance(ignore_column_order, int) or ignore_column_order < 0):
+            raise ValueError(f"Invalid ignore_column_order: {ignore_column_order}!")
+        self._ignore_column_order = ignore_column_order
+        # Advisory lock that lets only one instance migrate the database at a time (None - no lock):
+        #   "wait" - wait for the lock (up to migration_lock_timeout seconds), then check the version again
+        #   "skip" - like "wait", but return immediately if another instance migrates to the same or newer version
+        if migration_lock not in MIGRATION_LOCK_MODES:
+            raise ValueError(f"Unsupported migration_lock mode: {migration_lock}!")
+        self._migration_lock = migration_lock
+        self._migration_lock_timeout = migration_lock_timeout
+        # Tables migrated through shadow table with copy of rows and atomic swap: collection of table names or number -
+        # tables with at least that many rows. Rows are copied with Backfill.Run() with shadow_copy_options.
+        if isinstance(shadow_tables, (bool, str)) or (isinstance(shadow_tables, int) and shadow_tables < 0):
+            raise ValueError(f"Invalid shadow_tables: {shadow_tables}!")
+        if shadow_tables is not None and not isinstance(shadow_tables, int):
+            shadow_tables = frozenset(shadow_tables)
+        self._shadow_tables = shadow_tables
+        self._shadow_copy_options = dict(shadow_copy_options or {})
+        # Plan the schema again after migration and raise SchemaNotIdempotentError if anything is left to change.
+        self._verify_idempotence = verify_idempotence
+        # Progress of DDL statements polled every progress_interval seconds from a side connection.
+        self._progress = None
+        if progress_callback is not None:
+            self._progress = DDLProgressMonitor(self._open_side_connection, self.db_type, progress_callback,
+                                                interval=progress_interval)
+        # Path of trace file with all statements of the last migration, their timings and sizes of the tables,
+        # replayed on staging copy of the database by ReplayMigrationTrace() (see MigrationTrace.py).
+        self._trace_path = trace_path
+        self._trace = None
 
         if self.db_type == "mysql" and pymysql_conn is not None:
             self._conn = pymysql_conn
@@ -114,7 +259,236 @@ class SQLSchemaBuilder:
             self._conn.close()
             self._conn = None
 
+    def _get_dsn(self):
+        if self._conn_params:
+            params = self._conn_params
+            return f"{self.db_type}://{params['user']}@{params['host']}:{params['port']}/{params['db']}"
+
+        db = getattr(self._conn, 'db', None)
+        if isinstance(db, bytes):
+            db = db.decode()
+        return f"{self.db_type}://{getattr(self._conn, 'user', None)}@{self._conn.host}:{self._conn.port}/{db}"
+
+    def _get_db_schema(self, conn=None, catalog=None):
+        if self.db_type == "mysql":
+            return MySQLSchema(conn or self._conn, catalog=catalog, online_ddl=self._online_ddl, events=self.events,
+                               ddl_retry=self._ddl_retry, ignore_column_order=self._ignore_column_order,
+                               shadow_tables=self._shadow_tables, shadow_copy=self._copy_shadow_table,
+                               progress=self._progress)
+        elif self.db_type == "pgsql":
+            return PgSQLSchema(conn or self._conn, catalog=catalog, concurrent_indexes=self._concurrent_indexes,
+                               events=self.events, ddl_retry=self._ddl_retry,
+                               shadow_tables=self._shadow_tables, shadow_copy=self._copy_shadow_table,
+                               progress=self._progress)
+
+    # Copies rows of the table to its shadow table from the beginning, with checkpoints and throttling of Backfill.
+    def _copy_shadow_table(self, conn, name, table_name, key_column, process_batch):
+        backfill = Backfill(conn, self._get_cfg_value, self._set_cfg_value, self.events)
+        backfill.Reset(name)
+        return backfill.Run(name, table_name, key_column, process_batch, **self._shadow_copy_options)
+
+    def _get_connection_params(self):
+        if self._conn_params:
+            return self._conn_params
+        # Connection passed by the caller - open other connections with the same credentials.
+        return {
+            'host': self._conn.host,
+            'port': self._conn.port,
+            'user': self._conn.user,
+            'passwd': self._conn.password,
+            'db': self._conn.db,
+        }
+
+    # Autocommit connection for monitoring queries, so that they see current state of the server.
+    def _open_side_connection(self):
+        params = self._get_connection_params()
+        if self.db_type == "mysql":
+            return pymysql.connect(
+                host=params['host'],
+                port=params['port'],
+                user=params['user'],
+                passwd=params['passwd'],
+                db=params['db'],
+                charset='utf8mb4',
+                connect_timeout=5,
+                autocommit=True)
+        elif self.db_type == "pgsql":
+            return psycopg.connect(
+                host=params['host'],
+                port=params['port'],
+                user=params['user'],
+                password=params['passwd'],
+                dbname=params['db'] or "postgres",
+                connect_timeout=5,
+                autocommit=True)
+
+    def _create_connection_pool(self):
+        params = self._get_connection_params()
+
+        if self.db_type == "mysql":
+            return MySQLConnectionPool(
+                self._parallel_tables,
+                host=params['host'],
+                port=params['port'],
+                user=params['user'],
+                passwd=params['passwd'],
+                db=params['db'],
+                charset='utf8mb4',
+                connect_timeout=5,
+                autocommit=False)
+        elif self.db_type == "pgsql":
+            return psycopg_pool.ConnectionPool(
+                kwargs={
+                    'host': params['host'],
+                    'port': params['port'],
+                    'user': params['user'],
+                    'password': params['passwd'],
+                    'dbname': params['db'] or "postgres",
+                    'connect_timeout': 5,
+                    'autocommit': False,
+                },
+                min_size=1,
+                max_size=self._parallel_tables,
+                open=True)
+
+    # Migrates each table on its own pooled connection (and in its own transaction).
+    # All tables are processed even if some of them fail, errors are raised together as SchemaMigrationError.
+    def _update_tables_parallel(self, schema_dict, catalog):
+
+        def update_table(table_name, table_schema):
+            with pool.connection() as conn:
+                db_schema = self._get_db_schema(conn, catalog)
+                success = db_schema.UpdateTableSchema(table_name, table_schema)
+                return success, getattr(db_schema, 'online_ddl_report', [])
+
+        pool = self._create_connection_pool()
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self._parallel_tables) as executor:
+                futures = {table_name: executor.submit(update_table, table_name, table_schema)
+                           for table_name, table_schema in schema_dict.items()}
+
+            success = True
+            errors = {}
+            for table_name, future in futures.items():
+                try:
+                    table_success, online_ddl_report = future.result()
+                except Exception as e:
+                    errors[table_name] = e
+                    continue
+                success = success and table_success
+                self.online_ddl_report.extend(online_ddl_report)
+        finally:
+            pool.close()
+
+        if errors:
+            raise SchemaMigrationError(errors)
+
+        return success
+
+    # Uses saved snapshot if it still matches the database (verified by one checksum query),
+    # otherwise reads the catalog.
+    def _load_catalog_snapshot(self, db_schema, table_names):
+
+        table_names = list(table_names)
+        if self._catalog_snapshot is not None and os.path.exists(self._catalog_snapshot):
+            try:
+                catalog = CatalogSnapshot.Load(self._catalog_snapshot)
+            except ValueError:
+                catalog = None
+            if catalog is not None and catalog.db_type == self.db_type and \
+               all(catalog.HasTable(table_name) for table_name in table_names) and \
+               catalog.checksum == db_schema.GetCatalogChecksum(table_names):
+                db_schema.SetCatalogSnapshot(catalog)
+                return catalog
+
+        return db_schema.LoadCatalogSnapshot(table_names)
+
+    # Plans the schema against freshly read catalog, right after the migration there must be nothing left to change.
+    def _check_idempotence(self, schema_dict):
+
+        db_schema = self._get_db_schema()
+        db_schema.LoadCatalogSnapshot(schema_dict.keys())
+        plans = []
+        for table_name, table_schema in schema_dict.items():
+            plan = db_schema.PlanTableSchema(table_name, table_schema)
+            # Indexes built CONCURRENTLY after the migration transaction are expected to be missing yet.
+            if any(not change.get('concurrent') for change in plan.changes):
+                plans.append(plan)
+
+        if plans:
+            # Schema version is not increased, so the migration runs (and is verified) again next time.
+            self._conn.rollback()
+            raise SchemaNotIdempotentError(plans)
+
+    def _get_cfg_version(self, cursor, name):
+        try:
+            sql = "SELECT value FROM cfg_dbase WHERE name = %s"
+            with self.events.Timed('version_check', name=name, sql=sql):
+                cursor.execute(sql, (name,))
+                return float(cursor.fetchone()[0] or 0)
+        except (TypeError, pymysql.err.ProgrammingError, psycopg.errors.UndefinedTable):
+            if self.db_type == "pgsql":
+                self._conn.commit()
+            return 0.000
+
+    def _get_cfg_value(self, cursor, name):
+        sql = "SELECT value FROM cfg_dbase WHERE name = %s"
+        cursor.execute(sql, (name,))
+        row = cursor.fetchone()
+        return row[0] if row is not None else None
+
+    # Callbacks declared with 3 parameters get also Backfill helper.
+    def _call_post_migrate_callback(self, callback, db_schema_version, cursor):
+        try:
+            parameters = inspect.signature(callback).parameters.values()
+        except (TypeError, ValueError):
+            parameters = []
+        is_variadic = any(parameter.kind == parameter.VAR_POSITIONAL for parameter in parameters)
+        positional = [parameter for parameter in parameters
+                      if parameter.kind in (parameter.POSITIONAL_ONLY, parameter.POSITIONAL_OR_KEYWORD)]
+        if len(positional) >= 3 or is_variadic:
+            backfill = Backfill(self._conn, self._get_cfg_value, self._set_cfg_value, self.events)
+            return callback(db_schema_version, cursor, backfill)
+        return callback(db_schema_version, cursor)
+
+    def _set_cfg_value(self, cursor, name, value):
+        if self.db_type == "mysql":
+            sql = "REPLACE cfg_dbase (name, value) VALUES (%s, %s)"
+            cursor.execute(sql, (name, value))
+        elif self.db_type == "pgsql":
+            sql = """
+                INSERT INTO cfg_dbase (name, value)
+                     VALUES (%s, %s)
+                ON CONFLICT (name) DO UPDATE
+                        SET value = %s
+            """
+            cursor.execute(sql, (name, value, value))
+
     def UpdateSchema(self, schema_dict, schema_version, post_migrate_callback=None, pre_migrate_callback=None):
+        if self._trace_path is not None:
+            self._trace = MigrationTraceRecorder()
+            self.events.AddListener(self._trace)
+        try:
+            with self.events.Timed('migration'):
+                return self._update_schema(schema_dict, schema_version, post_migrate_callback, pre_migrate_callback)
+        finally:
+            if self._progress is not None:
+                self._progress.Close()
+            if self._trace is not None:
+                self.events.RemoveListener(self._trace)
+                # Trace is saved only if the database was migrated (also partially).
+                if self._trace.IsStarted():
+                    self._trace.Save(self._trace_path)
+                self._trace = None
+
+    def _update_schema(self, schema_dict, schema_version, post_migrate_callback, pre_migrate_callback):
+
+        fingerprint = None
+        if schema_dict is not None and schema_version is not None:
+            fingerprint = GetSchemaFingerprint(schema_dict, schema_version)
+            # Database already known to be up to date - don't touch it at all.
+            if self._version_cache is not None and self._version_cache.IsCurrent(self._get_dsn(), fingerprint):
+                return True
 
         self._connect_to_database()
         if self._conn is None:
@@ -126,59 +500,289 @@ class SQLSchemaBuilder:
         if 'cfg_dbase' in schema_dict:
             return False
 
-        schema_dict['cfg_dbase'] = """
-            name C(64),
-            value C(64),
-            INDEX PRIMARY (name)
-        """
+        # Don't modify caller's dict, so that it can be passed to UpdateSchema() again.
+        schema_dict = dict(schema_dict)
+        schema_dict['cfg_dbase'] = CFG_DBASE_SCHEMA
 
         #-----------------------------------------------------------------------------------------------------------
 
         with self._conn.cursor() as cursor:
 
+            db_schema_version = self._get_cfg_version(cursor, 'schema_version')
+
+            is_locked = False
+            if self._migration_lock is not None and self._is_migration_needed(cursor, db_schema_version,
+                                                                              schema_version):
+                status = self._acquire_migration_lock(cursor, schema_version)
+                if status != 'acquired':
+                    # 'skip' - compatible migration is in progress in another instance, 'timeout' - waited too long.
+                    return status == 'skip'
+                is_locked = True
+                # Another instance could have migrated the database while we were waiting for the lock.
+                db_schema_version = self._get_cfg_version(cursor, 'schema_version')
+                if db_schema_version < schema_version:
+                    self._set_migration_target(cursor, schema_version)
+
             try:
-                sql = "SELECT value FROM cfg_dbase WHERE name = %s"
-                cursor.execute(sql, ('schema_version',))
-                db_schema_version = float(cursor.fetchone()[0] or 0)
-            except (TypeError, pymysql.err.ProgrammingError, psycopg.errors.UndefinedTable):
-                db_schema_version = 0.000
-                if self.db_type == "pgsql":
-                    self._conn.commit()
-
-            if db_schema_version < schema_version:
-                if self.db_type == "mysql":
-                    db_schema = MySQLSchema(self._conn)
-                elif self.db_type == "pgsql":
-                    db_schema = PgSQLSchema(self._conn)
+                if not self._migrate_schema(cursor, schema_dict, schema_version, db_schema_version, fingerprint,
+                                            post_migrate_callback, pre_migrate_callback):
+                    return False
+            finally:
+                if is_locked:
+                    self._release_migration_lock(cursor)
 
-                if pre_migrate_callback is not None:
-                    migration_success = pre_migrate_callback(db_schema_version, cursor)
-                    if migration_success == False:
-                        self._conn.rollback()
-                        return False
+        if self._version_cache is not None:
+            self._version_cache.MarkCurrent(self._get_dsn(), fingerprint)
+
+        return True
+
+    def _is_migration_needed(self, cursor, db_schema_version, schema_version):
+        if db_schema_version < schema_version:
+            return True
+        return self.db_type == "pgsql" and self._concurrent_indexes and \
+               self._get_cfg_version(cursor, 'concurrent_indexes_version') < schema_version
+
+    # Returns 'acquired', 'skip' (lock is held by instance migrating to at least schema_version) or 'timeout'.
+    def _acquire_migration_lock(self, cursor, schema_version):
+
+        db_schema = self._get_db_schema()
+        # End the transaction of the version check, so that reads after getting the lock see current data
+        # (MySQL REPEATABLE READ would keep the old snapshot).
+        self._conn.commit()
+        with self.events.Timed('migration_lock', name=self._migration_lock) as event:
+            if db_schema.AcquireMigrationLock(0):
+                status = 'acquired'
+            elif self._migration_lock == "skip" and \
+                 self._get_cfg_version(cursor, 'migration_target') >= schema_version:
+                status = 'skip'
+            elif db_schema.AcquireMigrationLock(self._migration_lock_timeout):
+                status = 'acquired'
+            else:
+                status = 'timeout'
+            self._conn.commit()
+            event['status'] = status
+
+        return status
+
+    # Target version of running migration, so that followers in "skip" mode know whether they can go on.
+    def _set_migration_target(self, cursor, schema_version):
+        try:
+            self._set_cfg_value(cursor, 'migration_target', schema_version)
+            self._conn.commit()
+        except (pymysql.err.ProgrammingError, psycopg.errors.UndefinedTable):
+            # cfg_dbase doesn't exist before the first migration, followers just wait for the lock.
+            self._conn.rollback()
+
+    def _release_migration_lock(self, cursor):
+        try:
+            # Successful migration already removed its target, failed one left it in rolled back transaction
+            # or committed (MySQL DDL), so remove it here.
+            self._conn.rollback()
+            try:
+                cursor.execute("DELETE FROM cfg_dbase WHERE name = %s", ('migration_target',))
+                self._conn.commit()
+            except (pymysql.err.ProgrammingError, psycopg.errors.UndefinedTable):
+                self._conn.rollback()
+            self._get_db_schema().ReleaseMigrationLock()
+            self._conn.commit()
+        except (pymysql.err.OperationalError, psycopg.errors.OperationalError):
+            # Connection was lost, the server released the lock with the session.
+            pass
 
+    def _migrate_schema(self, cursor, schema_dict, schema_version, db_schema_version, fingerprint,
+                        post_migrate_callback, pre_migrate_callback):
+
+        if self._trace is not None and self._is_migration_needed(cursor, db_schema_version, schema_version):
+            self._start_trace(schema_dict, schema_version)
+
+        if db_schema_version < schema_version:
+            self._start_ddl_retry()
+            db_schema = self._get_db_schema()
+            self.online_ddl_report = []
+            if self.db_type == "mysql" and not self._parallel_tables:
+                self.online_ddl_report = db_schema.online_ddl_report
+
+            if pre_migrate_callback is not None:
+                with self.events.Timed('callback', name='pre_migrate_callback'):
+                    migration_success = pre_migrate_callback(db_schema_version,
+                                                             self._trace_cursor(cursor, 'pre_migrate_callback'))
+                if migration_success == False:
+                    self._conn.rollback()
+                    return False
+
+            # Read catalog of all tables at once, after pre_migrate_callback had a chance to alter them.
+            catalog = self._load_catalog_snapshot(db_schema, schema_dict.keys())
+
+            if self._parallel_tables:
+                # Release locks held by the coordinating connection, otherwise the workers would wait for them.
+                self._conn.commit()
+                if not self._update_tables_parallel(schema_dict, catalog):
+                    return False
+            else:
                 for table_name, table_schema in schema_dict.items():
                     if not db_schema.UpdateTableSchema(table_name, table_schema):
                         return False
 
-                if post_migrate_callback is not None:
-                    migration_success = post_migrate_callback(db_schema_version, cursor)
-                    if migration_success == False:
-                        self._conn.rollback()
-                        return False
+            if post_migrate_callback is not None:
+                with self.events.Timed('callback', name='post_migrate_callback'):
+                    migration_success = self._call_post_migrate_callback(
+                        post_migrate_callback, db_schema_version, self._trace_cursor(cursor, 'post_migrate_callback'))
+                if migration_success == False:
+                    self._conn.rollback()
+                    return False
 
-                if self.db_type == "mysql":
-                    sql = "REPLACE cfg_dbase (name, value) VALUES (%s, %s)"
-                    cursor.execute(sql, ('schema_version', schema_version))
-                elif self.db_type == "pgsql":
-                    sql = """
-                        INSERT INTO cfg_dbase (name, value)
-                             VALUES (%s, %s)
-                        ON CONFLICT (name) DO UPDATE
-                                SET value = %s
-                    """
-                    cursor.execute(sql, ('schema_version', schema_version, schema_version))
+            if self._verify_idempotence:
+                self._check_idempotence(schema_dict)
+
+            self._set_cfg_value(cursor, 'schema_version', schema_version)
+            self._set_cfg_value(cursor, 'schema_fingerprint', fingerprint)
+            # Checkpoints of finished backfills must not affect backfills of the next migration.
+            cursor.execute("DELETE FROM cfg_dbase WHERE name LIKE %s OR name = %s",
+                           (CHECKPOINT_PREFIX + '%', 'migration_target'))
+            self._conn.commit()
 
+        # Concurrent index builds run in their own phase with separately stored version, so that the rest
+        # of the migration (including callbacks) is not repeated if the builds are interrupted.
+        if self.db_type == "pgsql" and self._concurrent_indexes:
+            if self._get_cfg_version(cursor, 'concurrent_indexes_version') < schema_version:
+                # Only this phase is left from an interrupted migration, the retry policy wasn't started yet.
+                if db_schema_version >= schema_version:
+                    self._start_ddl_retry()
+                db_schema = PgSQLSchema(self._conn, concurrent_indexes=True, events=self.events,
+                                        ddl_retry=self._ddl_retry, progress=self._progress)
+                if not db_schema.UpdateIndexesConcurrently(schema_dict):
+                    return False
+                self._set_cfg_value(cursor, 'concurrent_indexes_version', schema_version)
                 self._conn.commit()
 
+        # Keep saved snapshot in sync with the migrated database.
+        if self._catalog_snapshot is not None and db_schema_version < schema_version:
+            self._save_catalog_snapshot(schema_dict.keys(), self._catalog_snapshot)
+
         return True
+
+    def _start_ddl_retry(self):
+        if self._lock_timeout is not None:
+            self._ddl_retry = DDLRetryPolicy(self._lock_timeout, statement_timeout=self._statement_timeout,
+                                             retry_budget=self._lock_retry_budget)
+            self.lock_retry_report = self._ddl_retry.report
+
+    # Sizes of the tables are read before the migration changes them, to scale durations of replayed trace.
+    def _start_trace(self, schema_dict, schema_version):
+        if self.db_type == "mysql":
+            server_info = self._conn.get_server_info()
+        else:
+            server_info = str(self._conn.info.server_version)
+        table_stats = self._get_db_schema().GetTableStats(schema_dict.keys())
+        self._trace.SetDatabase(self.db_type, server_info, schema_version, schema_dict.keys(), table_stats)
+
+    def _trace_cursor(self, cursor, name):
+        if self._trace is None:
+            return cursor
+        return TracedCursor(cursor, self.events, name)
+
+    def _save_catalog_snapshot(self, table_names, path):
+        table_names = list(table_names)
+        db_schema = self._get_db_schema()
+        try:
+            catalog = db_schema.LoadCatalogSnapshot(table_names)
+            catalog.checksum = db_schema.GetCatalogChecksum(table_names)
+        finally:
+            # Only catalog was read, end the transaction started by the queries.
+            self._conn.rollback()
+        if path is not None:
+            catalog.Save(path)
+        return catalog
+
+    # Reads columns and indexes of the tables (and cfg_dbase) into CatalogSnapshot and optionally saves it
+    # to a file (JSON, or msgpack if the path ends with .msgpack) for offline diff or for catalog_snapshot option.
+    # Returns None if connection to the database failed.
+    def DumpCatalogSnapshot(self, table_names, path=None):
+
+        self._connect_to_database()
+        if self._conn is None:
+            return None
+
+        return self._save_catalog_snapshot(list(table_names) + ['cfg_dbase'], path)
+
+    # Returns list of TablePlan with changes that UpdateSchema() would make, without executing anything.
+    # Each plan has table stats, impact of its changes, SQL statements and estimated duration in seconds
+    # (throughput of operations can be adjusted, see TablePlan.ESTIMATED_THROUGHPUT).
+    # Returns None if connection to the database failed.
+    def PlanSchema(self, schema_dict, schema_version, throughput=None):
+
+        self._connect_to_database()
+        if self._conn is None:
+            return None
+
+        if schema_dict is None or schema_version is None:
+            return []
+
+        if 'cfg_dbase' in schema_dict:
+            raise ValueError('Table name cfg_dbase is reserved')
+
+        schema_dict = dict(schema_dict)
+        schema_dict['cfg_dbase'] = CFG_DBASE_SCHEMA
+
+        plans = []
+        try:
+            with self._conn.cursor() as cursor:
+                if self._get_cfg_version(cursor, 'schema_version') >= schema_version:
+                    return plans
+
+            db_schema = self._get_db_schema()
+            db_schema.LoadCatalogSnapshot(schema_dict.keys())
+            for table_name, table_schema in schema_dict.items():
+                plan = db_schema.PlanTableSchema(table_name, table_schema)
+                if not plan.IsEmpty():
+                    plans.append(plan)
+            db_schema.AnnotateTablePlans(plans, throughput)
+        finally:
+            # Nothing was changed, just end the transaction started by the queries.
+            self._conn.rollback()
+
+        return plans
+
+    # Creates upcoming partitions and drops expired ones of tables declared with PARTITION BY RANGE, meant to be
+    # called periodically (e.g. daily, more often than the smallest INTERVAL). Tables have to be migrated
+    # by UpdateSchema() first, now is the current value of partition keys (default: unix timestamp).
+    # Returns list of non-empty TablePlan that were executed, or None if connection to the database failed.
+    def MaintainPartitions(self, schema_dict, now=None):
+
+        self._connect_to_database()
+        if self._conn is None:
+            return None
+
+        self._start_ddl_retry()
+        db_schema = self._get_db_schema()
+        plans = []
+        try:
+            db_schema.LoadCatalogSnapshot(schema_dict.keys())
+            for table_name, table_schema in schema_dict.items():
+                plan = db_schema.MaintainPartitions(table_name, table_schema, now)
+                if not plan.IsEmpty():
+                    plans.append(plan)
+            self._conn.commit()
+        except Exception:
+            self._conn.rollback()
+            raise
+
+        return plans
+
+    # Renders plans returned by PlanSchema() as SQL script with annotations in comments.
+    def RenderPlanSQL(self, plans):
+
+        lines = []
+        for plan in plans:
+            stats = plan.stats or {}
+            lines.append('-- Table {0}{1}: {2} rows, {3:.1f} MB data, {4:.1f} MB indexes, estimated {5:.1f} s'.format(
+                plan.table_name, ' (new)' if plan.is_new_table else '',
+                stats.get('rows', 0), stats.get('data_size', 0) / 1048576.0, stats.get('index_size', 0) / 1048576.0,
+                plan.estimated_duration or 0.0))
+            for change in plan.changes:
+                lines.append('--   {0} {1}: {2}'.format(change['op'], change['name'] or '', change.get('impact')))
+            for sql in plan.statements:
+                lines.append(sql + ';')
+            lines.append('')
+
+        return '\n'.join(lines)
@@ -0,0 +1,97 @@
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+class SchemaVersionCache():
+
+    # ttl - seconds after which database has to be checked again (None - never).
+    # path - optional JSON file to share the cache between processes (e.g. workers of one service).
+    def __init__(self, ttl=None, path=None):
+        self._ttl = ttl
+        self._path = path
+        # Maps "dsn fingerprint" to time when the database was known to be up to date.
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    #-----------------------------------------------------------------------------------------------------------
+
+    def _is_fresh(self, timestamp):
+        return self._ttl is None or time.time() - timestamp < self._ttl
+
+    def _read_file(self):
+        try:
+            with open(self._path) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return entries if isinstance(entries, dict) else {}
+
+    def _write_file(self, removed_dsn=None):
+        entries = self._read_file()
+        entries.update(self._entries)
+        entries = {key: timestamp for key, timestamp in entries.items()
+                   if self._is_fresh(timestamp) and (removed_dsn is None or not key.startswith(f"{removed_dsn} "))}
+
+        # Write to temporary file and rename it, so that readers never see partially written file.
+        directory = os.path.dirname(os.path.abspath(self._path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.schema-version-cache-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self._path)
+        except OSError:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+
+    #-----------------------------------------------------------------------------------------------------------
+
+    def IsCurrent(self, dsn, fingerprint):
+        key = f"{dsn} {fingerprint}"
+        with self._lock:
+            timestamp = self._entries.get(key)
+            if timestamp is None and self._path is not None:
+                timestamp = self._read_file().get(key)
+                if timestamp is not None:
+                    self._entries[key] = timestamp
+            if timestamp is None:
+                return False
+            if not self._is_fresh(timestamp):
+                del self._entries[key]
+                return False
+            return True
+
+    def MarkCurrent(self, dsn, fingerprint):
+        key = f"{dsn} {fingerprint}"
+        with self._lock:
+            self._entries[key] = time.time()
+            if self._path is not None:
+                self._write_file()
+
+    # Forgets all databases (or only the given one), e.g. after restoring a database from backup.
+    def Invalidate(self, dsn=None):
+        with self._lock:
+            if dsn is None:
+                self._entries = {}
+                if self._path is not None:
+                    try:
+                        os.unlink(self._path)
+                    except OSError:
+                        pass
+            else:
+                self._entries = {key: timestamp for key, timestamp in self._entries.items()
+                                 if not key.startswith(f"{dsn} ")}
+                if self._path is not None:
+                    self._write_file(removed_dsn=dsn)
+
+
+# Cache shared by all SQLSchemaBuilder instances of the process created with version_cache=True.
+_process_cache = SchemaVersionCache()
+
+
+def GetProcessCache():
+    return _process_cache
@@ -0,0 +1,84 @@
+MB = 1024 * 1024
+
+# Rough throughput (bytes of table data per second) used to estimate duration of DDL operations.
+#   'scan'    - full table scan without rewrite (e.g. validating NOT NULL on PostgreSQL)
+#   'index'   - building an index
+#   'rewrite' - rebuilding the whole table with its indexes
+ESTIMATED_THROUGHPUT = {
+    'scan': 200 * MB,
+    'index': 50 * MB,
+    'rewrite': 25 * MB,
+}
+
+
+class TablePlan():
+
+    def __init__(self, table_name, is_new_table=False):
+        self.table_name = table_name
+        self.is_new_table = is_new_table
+        # List of column/index changes in order they should be applied. Each change is a dict with keys:
+        #   'op'   - 'add_column', 'drop_column', 'change_column', 'rename_column', 'add_index', 'drop_index',
+        #            'rename_index', 'add_primary_key', 'drop_primary_key', 'set_not_null' (PostgreSQL online NOT NULL),
+        #            'partition_by', 'remove_partitioning', 'resize_partitions', 'add_partition', 'drop_partition',
+        #            'reorganize_partition' (changes of partitioning have 'partition' True)
+        #   'name' - name of the column or index (new name of renamed ones, previous name is in 'old_name')
+        #   'sql'  - clause of CREATE TABLE/ALTER TABLE statement (or whole statement if 'standalone' is True)
+        # and optional details like 'old_definition'/'new_definition'.
+        # Changes annotated by dialect's AnnotateTablePlans() also have 'impact' - one of 'metadata', 'scan',
+        # 'index' or 'rewrite' (keys of ESTIMATED_THROUGHPUT).
+        self.changes = []
+        # Set by dialect's PlanTableSchema() when the existing table is migrated through shadow table: dict with
+        # 'table_name' (of the shadow table), 'old_table_name' (name of the table after swap, before it's dropped),
+        # 'key_column' ((existing name, new name) of primary key), 'columns' ([(new name, existing name)] of
+        # copied columns), 'plan' (TablePlan creating the shadow table) and details of the dialect.
+        self.shadow = None
+        # Set by AnnotateTablePlans(): {'rows', 'data_size', 'index_size'} of the existing table,
+        # SQL statements that would be executed and estimated duration in seconds.
+        self.stats = None
+        self.statements = []
+        self.estimated_duration = None
+
+    #-----------------------------------------------------------------------------------------------------------
+
+    def AddChange(self, op, name, sql, **details):
+        change = {'op': op, 'name': name, 'sql': sql}
+        change.update(details)
+        self.changes.append(change)
+        return change
+
+    def GetChanges(self, *ops):
+        return [change for change in self.changes if not ops or change['op'] in ops]
+
+    def IsEmpty(self):
+        return len(self.changes) == 0
+
+    def IsRewrite(self):
+        return any(change.get('impact') == 'rewrite' for change in self.changes)
+
+    #-----------------------------------------------------------------------------------------------------------
+
+    # Estimates duration of the plan in seconds from table size and impact of its changes.
+    def EstimateDuration(self, throughput=None):
+
+        throughput = dict(ESTIMATED_THROUGHPUT, **(throughput or {}))
+        stats = self.stats or {}
+        data_size = stats.get('data_size') or 0
+        index_size = stats.get('index_size') or 0
+
+        # Changes that are part of the single CREATE/ALTER TABLE statement share one table rewrite.
+        duration = 0.0
+        table_changes = [change for change in self.changes if not change.get('standalone')]
+        if any(change.get('impact') == 'rewrite' for change in table_changes):
+            duration += (data_size + index_size) / throughput['rewrite']
+        else:
+            for change in table_changes:
+                if change.get('impact') in ('scan', 'index'):
+                    duration += data_size / throughput[change['impact']]
+
+        # Standalone statements (e.g. CREATE INDEX on PostgreSQL) process the table on their own.
+        for change in self.changes:
+            if change.get('standalone') and change.get('impact') in ('scan', 'index'):
+                duration += data_size / throughput[change['impact']]
+
+        self.estimated_duration = duration
+        return duration
@@ -0,0 +1,40 @@
+import unittest
+from unittest import mock
+
+import psycopg
+import pymysql
+
+from sql_schema_builder.FleetSchemaBuilder import FleetSchemaBuilder
+
+
+TARGET = {'host': 'localhost', 'user': 'root', 'passwd': 'xxx', 'db': 'customer1'}
+
+
+class RetryTest(unittest.TestCase):
+
+    # Runs migration of one target whose SQLSchemaBuilder.UpdateSchema() raises error.
+    def _update_target(self, error, db_type="mysql"):
+        fleet = FleetSchemaBuilder([TARGET], db_type=db_type, retries=2, retry_delay=0)
+        with mock.patch('sql_schema_builder.FleetSchemaBuilder.SQLSchemaBuilder') as builder_class:
+            builder_class.return_value.UpdateSchema.side_effect = error
+            return fleet._update_target(TARGET, {}, 1.0, None, None)
+
+    def test_unknown_column_is_not_retried(self):
+        error = pymysql.err.OperationalError(1054, "Unknown column 'price' in 'field list'")
+        result = self._update_target(error)
+        self.assertEqual(result['attempts'], 1)
+        self.assertIs(result['error'], error)
+
+    def test_lost_connection_and_lock_errors_are_retried(self):
+        for code in (2003, 2006, 2013, 1205, 1213):
+            result = self._update_target(pymysql.err.OperationalError(code, 'error'))
+            self.assertEqual(result['attempts'], 3, code)
+
+    def test_pgsql_errors(self):
+        self.assertEqual(self._update_target(psycopg.OperationalError('connection lost'), "pgsql")['attempts'], 3)
+        self.assertEqual(self._update_target(psycopg.errors.DeadlockDetected(), "pgsql")['attempts'], 3)
+        self.assertEqual(self._update_target(psycopg.errors.UndefinedColumn(), "pgsql")['attempts'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import re
+import unittest
+
+from sql_schema_builder.CatalogSnapshot import CatalogSnapshot
+from sql_schema_builder.MySQLSchema import MySQLSchema
+
+
+TABLE_SCHEMA = """
+    id I NOTNULL DEFAULT 0,
+    price I,
+    flag I,
+    INDEX PRIMARY (id)
+"""
+
+
+# Plans changes of table t (id, price, flag) offline, against catalog snapshot of given server.
+def _get_schema(server_info, online_ddl='strict'):
+
+    schema = MySQLSchema(None, catalog=CatalogSnapshot(db_type="mysql", server_info=server_info),
+                         online_ddl=online_ddl)
+    columns = [
+        ('t', 'id', 'int(11)', 'NO', 'PRI', '0', ''),
+        ('t', 'price', 'int(11)', 'YES', '', None, ''),
+        ('t', 'flag', 'int(11)', 'YES', '', None, ''),
+    ]
+    indexes = [('t', 0, 'PRIMARY', 1, 'id', 'A', None, 'BTREE')]
+    schema.BuildCatalogSnapshot(['t'], (columns, indexes, []))
+    return schema
+
+
+def _get_statements(server_info, table_schema):
+    schema = _get_schema(server_info)
+    return schema.GetPlanStatements(schema.PlanTableSchema('t', table_schema))
+
+
+class InstantColumnChangesTest(unittest.TestCase):
+
+    def test_trailing_add_column_is_instant_since_8_0_12(self):
+        table_schema = TABLE_SCHEMA.replace('flag I,', 'flag I,\n    new1 I,')
+        self.assertEqual(_get_statements('8.0.12', table_schema),
+                         ['ALTER TABLE t ADD COLUMN `new1` INT(11), ALGORITHM=INSTANT'])
+        self.assertEqual(_get_statements('8.0.11', table_schema),
+                         ['ALTER TABLE t ADD COLUMN `new1` INT(11), ALGORITHM=INPLACE, LOCK=NONE'])
+        self.assertEqual(_get_statements('10.3.7-MariaDB', table_schema),
+                         ['ALTER TABLE t ADD COLUMN `new1` INT(11), ALGORITHM=INSTANT'])
+
+    def test_positioned_add_column_is_instant_since_8_0_29(self):
+        table_schema = TABLE_SCHEMA.replace('price I,', 'price I,\n    new1 I,')
+        self.assertEqual(_get_statements('8.0.28', table_schema),
+                         ['ALTER TABLE t ADD COLUMN `new1` INT(11) AFTER `price`, ALGORITHM=INPLACE, LOCK=NONE'])
+        self.assertEqual(_get_statements('8.0.29', table_schema),
+                         ['ALTER TABLE t ADD COLUMN `new1` INT(11) AFTER `price`, ALGORITHM=INSTANT'])
+        self.assertEqual(_get_statements('10.3.7-MariaDB', table_schema),
+                         ['ALTER TABLE t ADD COLUMN `new1` INT(11) AFTER `price`, ALGORITHM=INPLACE, LOCK=NONE'])
+        self.assertEqual(_get_statements('10.4.2-MariaDB', table_schema),
+                         ['ALTER TABLE t ADD COLUMN `new1` INT(11) AFTER `price`, ALGORITHM=INSTANT'])
+
+    def test_drop_column_is_instant_since_8_0_29(self):
+        table_schema = TABLE_SCHEMA.replace('flag I,', '')
+        self.assertEqual(_get_statements('8.0.28', table_schema),
+                         ['ALTER TABLE t DROP COLUMN `flag`, ALGORITHM=INPLACE, LOCK=NONE'])
+        self.assertEqual(_get_statements('8.0.29', table_schema),
+                         ['ALTER TABLE t DROP COLUMN `flag`, ALGORITHM=INSTANT'])
+        self.assertEqual(_get_statements('10.3.7-MariaDB', table_schema),
+                         ['ALTER TABLE t DROP COLUMN `flag`, ALGORITHM=INPLACE, LOCK=NONE'])
+        self.assertEqual(_get_statements('10.4.2-MariaDB', table_schema),
+                         ['ALTER TABLE t DROP COLUMN `flag`, ALGORITHM=INSTANT'])
+
+    def test_mixed_changes_use_the_most_expensive_algorithm(self):
+        table_schema = TABLE_SCHEMA.replace('flag I,', 'new1 I,')
+        self.assertEqual(_get_statements('8.0.20', table_schema),
+                         ['ALTER TABLE t DROP COLUMN `flag`, ADD COLUMN `new1` INT(11), ALGORITHM=INPLACE, LOCK=NONE'])
+
+
+
+class ChangeImpactTest(unittest.TestCase):
+
+    def _get_impacts(self, server_info, table_schema):
+        schema = _get_schema(server_info)
+        plan = schema.PlanTableSchema('t', table_schema)
+        return dict((change['name'], schema._get_change_impact(plan, change)) for change in plan.changes)
+
+    def test_column_add_and_drop_rewrite_table_before_8_0_29(self):
+        table_schema = TABLE_SCHEMA.replace('price I,', 'new1 I,\n    price I,').replace('flag I,', 'new2 I,')
+        self.assertEqual(self._get_impacts('8.0.20', table_schema),
+                         {'flag': 'rewrite', 'new1': 'rewrite', 'new2': 'metadata'})
+        self.assertEqual(self._get_impacts('8.0.29', table_schema),
+                         {'flag': 'metadata', 'new1': 'metadata', 'new2': 'metadata'})
+        self.assertEqual(self._get_impacts('5.7.40', table_schema),
+                         {'flag': 'rewrite', 'new1': 'rewrite', 'new2': 'rewrite'})
+
+
+class IndexTest(unittest.TestCase):
+
+    def test_postgresql_only_index_options_are_rejected(self):
+        schema = _get_schema('8.0.36')
+        for index, message in [
+            ('INDEX by_price (price) INCLUDE (flag)', 'Index by_price of table t: INCLUDE and WHERE'),
+            ('INDEX (price) WHERE flag = 1', 'Index (price) of table t: INCLUDE and WHERE'),
+            ('INDEX by_price USING gin (price)', 'Index by_price of table t: method gin'),
+        ]:
+            with self.assertRaisesRegex(ValueError, re.escape(message)):
+                schema.PlanTableSchema('t', TABLE_SCHEMA.replace('INDEX PRIMARY (id)',
+                                                                 'INDEX PRIMARY (id),\n    ' + index))
+
+
+if __name__ == '__main__':
+    unittest.main()